@@ -1,16 +1,23 @@
 #!/usr/bin/python3
 
 from datetime import datetime
+import io
 import logging
 import os
 import signal
 import sys
-import time
 
 import com2
 import com1
+import com_profile
 
 COUNTER_FIELD = "end_counter"
+TARGET_FIELD = "target"
+FLUSH_MODES = ["line", "poll", "fsync"]
+OUT_BUFFER_SIZE = 1 << 20
+READ_BLOCK_SIZE = 1 << 16
+PRIOR_COUNTER_SCAN_LIMIT = 1 << 24
+SECOND_STRINGS = ["{0:02d}".format(x) for x in range(60)]
 VERBOSE_FIELD_MAP = {
     "alerts": "Alerts bit field",
     "samples": "Parsed samples",
@@ -58,6 +65,12 @@ def parse_args():
                        default="-",
                        help="Output file path; if set, can also be used to resume from prior "
                        "history sample counter, default: write to standard output")
+    group.add_argument("--flush",
+                       choices=FLUSH_MODES,
+                       default="line",
+                       help="When to flush output: after every line, after every poll, or after "
+                       "every poll and then also fsync to disk; poll is faster for bulk history "
+                       "written to a file, default: line")
     group.add_argument("-k",
                        "--skip-query",
                        action="store_true",
@@ -80,13 +93,48 @@ def parse_args():
 
 
 def open_out_file(opts, mode):
+    buffering = 1 if opts.flush == "line" else OUT_BUFFER_SIZE
     if opts.out_file == "-":
-        return os.fdopen(sys.stdout.fileno(), "w", buffering=1, closefd=False)
-    return open(opts.out_file, mode, buffering=1)
+        return os.fdopen(sys.stdout.fileno(), "w", buffering=buffering, closefd=False)
+    return open(opts.out_file, mode, buffering=buffering)
+
+
+def flush_out_file(opts, print_file):
+    if opts.flush == "line":
+        return
+    print_file.flush()
+    if opts.flush == "fsync":
+        try:
+            os.fsync(print_file.fileno())
+        except OSError:
+            # not supported for pipes and terminals
+            pass
+
+
+def format_bulk_rows(bulk, timestamp, prefix_fields=()):
+    # Row timestamps are consecutive seconds, so only build a datetime string
+    # once per minute and append precomputed seconds strings to it.
+    columns = [["" if val is None else str(val) for val in values] for values in bulk.values()]
+    prefix = ",".join(prefix_fields)
+    if prefix:
+        prefix = "," + prefix
+    lines = []
+    minute = None
+    minute_str = ""
+    for row in zip(*columns):
+        timestamp += 1
+        if timestamp // 60 != minute:
+            minute = timestamp // 60
+            minute_str = datetime.utcfromtimestamp(minute * 60).isoformat()[:-2]
+        lines.append(minute_str + SECOND_STRINGS[timestamp % 60] + prefix + "," + ",".join(row))
+    lines.append("")
+    return "\n".join(lines)
 
 
 def print_header(opts, print_file):
     header = ["datetimestamp_utc"]
+    if opts.multi_target:
+        header.append(TARGET_FIELD)
 
     def header_add(names):
         for name in names:
@@ -100,10 +148,10 @@ def print_header(opts, print_file):
 
     if opts.status_mode:
         if opts.pure_status_mode:
-            context = starlink_grpc.ChannelContext(target=opts.target)
+            context = com1.ChannelContext(target=opts.targets[0])
             try:
-                name_groups = starlink_grpc.status_field_names(context=context)
-            except starlink_grpc.GrpcError as e:
+                name_groups = com1.status_field_names(context=context)
+            except com1.GrpcError as e:
                 com2.conn_error(opts, "Failure reflecting status field names: %s", str(e))
                 return 1
             if "status" in opts.mode:
@@ -113,15 +161,15 @@ def print_header(opts, print_file):
             if "alert_detail" in opts.mode:
                 header_add(name_groups[2])
         if "location" in opts.mode:
-            header_add(starlink_grpc.location_field_names())
+            header_add(com1.location_field_names())
 
     if opts.bulk_mode:
-        general, bulk = starlink_grpc.history_bulk_field_names()
+        general, bulk = com1.history_bulk_field_names()
         header_add(bulk)
 
     if opts.history_stats_mode:
-        groups = starlink_grpc.history_stats_field_names()
-        general, ping, runlen, latency, loaded, usage = groups[0:6]
+        groups = com1.history_stats_field_names(loaded_tail=True)
+        general, ping, runlen, latency, loaded, usage, loaded_tail = groups[0:7]
         header_add(general)
         if "ping_drop" in opts.mode:
             header_add(ping)
@@ -131,6 +179,8 @@ def print_header(opts, print_file):
             header_add(latency)
         if "ping_loaded_latency" in opts.mode:
             header_add(loaded)
+        if "ping_loaded_latency_tail" in opts.mode:
+            header_add(loaded_tail)
         if "usage" in opts.mode:
             header_add(usage)
 
@@ -138,18 +188,54 @@ def print_header(opts, print_file):
     return 0
 
 
-def get_prior_counter(opts, gstate):
+def reverse_lines(in_file, start=0):
+    # Yield lines from the end of a binary file back to offset start, last line
+    # first. The first item is whatever follows the final newline, which is
+    # empty unless a write was interrupted part way through a line.
+    in_file.seek(0, os.SEEK_END)
+    position = in_file.tell()
+    tail = b""
+    while position > start:
+        size = min(READ_BLOCK_SIZE, position - start)
+        position -= size
+        in_file.seek(position)
+        lines = (in_file.read(size) + tail).split(b"\n")
+        tail = lines[0]
+        yield from reversed(lines[1:])
+    yield tail
+
+
+def get_prior_counter(opts, gstates):
+    targets = set(gstate.target for gstate in gstates) if opts.multi_target else {None}
+    counters = {}
     try:
-        with open_out_file(opts, "r") as csv_file:
-            header = csv_file.readline().split(",")
+        with open(opts.out_file, "rb") as csv_file:
+            header = csv_file.readline().decode().rstrip("\n").split(",")
             column = header.index(COUNTER_FIELD)
-            last_line = None
-            for last_line in csv_file:
-                pass
-        if last_line is not None:
-            gstate.counter_stats = int(last_line.split(",")[column])
-    except (IndexError, OSError, ValueError):
-        pass
+            target_column = header.index(TARGET_FIELD) if opts.multi_target else None
+            lines = reverse_lines(csv_file, csv_file.tell())
+            next(lines)
+            scanned = 0
+            for line in lines:
+                scanned += len(line) + 1
+                if scanned > PRIOR_COUNTER_SCAN_LIMIT:
+                    break
+                try:
+                    fields = line.decode().split(",")
+                    target = None if target_column is None else fields[target_column]
+                    if target in targets and target not in counters:
+                        counters[target] = int(fields[column])
+                except (IndexError, UnicodeDecodeError, ValueError):
+                    continue
+                if len(counters) == len(targets):
+                    break
+    except (OSError, UnicodeDecodeError, ValueError):
+        return
+
+    for gstate in gstates:
+        counter = counters.get(gstate.target if opts.multi_target else None)
+        if counter is not None:
+            gstate.counter_stats = counter
 
 
 def loop_body(opts, gstate, print_file, shutdown=False):
@@ -187,12 +273,11 @@ def loop_body(opts, gstate, print_file, shutdown=False):
                       file=print_file)
             if opts.loop_interval > 0.0:
                 print(file=print_file)
-        else:
-            for i in range(count):
-                timestamp += 1
-                fields = [datetime.utcfromtimestamp(timestamp).isoformat()]
-                fields.extend([xform(val[i]) for val in bulk.values()])
-                print(",".join(fields), file=print_file)
+        elif count:
+            prefix_fields = [gstate.target] if opts.multi_target else []
+            print_file.write(
+                com_profile.timed("stage.output", format_bulk_rows, bulk, timestamp,
+                                  prefix_fields))
 
     rc, status_ts, hist_ts = com2.get_data(opts,
                                                   gstate,
@@ -203,18 +288,42 @@ def loop_body(opts, gstate, print_file, shutdown=False):
 
     if opts.verbose:
         if csv_data:
+            if opts.multi_target:
+                csv_data.insert(0, "{0:22} {1}".format("Target:", gstate.target))
             print("\n".join(csv_data), file=print_file)
             if opts.loop_interval > 0.0:
                 print(file=print_file)
     else:
         if csv_data:
             timestamp = status_ts if status_ts is not None else hist_ts
+            if opts.multi_target:
+                csv_data.insert(0, gstate.target)
             csv_data.insert(0, datetime.utcfromtimestamp(timestamp).isoformat())
-            print(",".join(csv_data), file=print_file)
+            com_profile.timed("stage.output", print, ",".join(csv_data), file=print_file)
 
     return rc
 
 
+def loop_all(opts, gstates, print_file, executor, shutdown=False):
+    if executor is None:
+        rc = 0
+        for gstate in gstates:
+            rc = loop_body(opts, gstate, print_file, shutdown=shutdown) or rc
+        return rc
+
+    # Each dish writes to its own buffer so output lines from concurrent polls
+    # never interleave; buffers are then written out in target order.
+    def poll(gstate):
+        out = io.StringIO()
+        return loop_body(opts, gstate, out, shutdown=shutdown), out.getvalue()
+
+    rc = 0
+    for poll_rc, output in com2.map_states(poll, gstates, executor):
+        print_file.write(output)
+        rc = poll_rc or rc
+    return rc
+
+
 def main():
     opts = parse_args()
 
@@ -229,9 +338,9 @@ def main():
             rc = 1
         sys.exit(rc)
 
-    gstate = com2.GlobalState(target=opts.target)
+    gstates = com2.create_states(opts)
     if opts.out_file != "-" and not opts.skip_query and opts.history_stats_mode:
-        get_prior_counter(opts, gstate)
+        get_prior_counter(opts, gstates)
 
     try:
         print_file = open_out_file(opts, "a")
@@ -240,23 +349,34 @@ def main():
         sys.exit(1)
     signal.signal(signal.SIGTERM, handle_sigterm)
 
+    executor = com2.create_executor(opts)
     rc = 0
+    scheduler = com2.TickScheduler(opts, gstates)
     try:
-        next_loop = time.monotonic()
         while True:
-            rc = loop_body(opts, gstate, print_file)
+            scheduler.start_tick()
+            rc = com_profile.timed("tick", loop_all, opts, gstates, print_file, executor)
+            flush_out_file(opts, print_file)
             if opts.loop_interval > 0.0:
-                now = time.monotonic()
-                next_loop = max(next_loop + opts.loop_interval, now)
-                time.sleep(next_loop - now)
+                scheduler.sleep()
             else:
                 break
     except (KeyboardInterrupt, Terminated):
         pass
     finally:
-        loop_body(opts, gstate, print_file, shutdown=True)
+        loop_all(opts, gstates, print_file, executor, shutdown=True)
+        flush_out_file(opts, print_file)
         print_file.close()
-        gstate.shutdown()
+        if executor is not None:
+            executor.shutdown()
+        if opts.verbose and opts.loop_interval > 0.0:
+            print(scheduler.report())
+        for gstate in gstates:
+            if opts.verbose and gstate.context.status_hits:
+                print("Status requests saved: {0} of {1}".format(
+                    gstate.context.status_hits,
+                    gstate.context.status_hits + gstate.context.status_misses))
+            gstate.shutdown()
 
     sys.exit(rc)
 
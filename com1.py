@@ -1,24 +1,61 @@
+from __future__ import annotations
 
+from array import array
+from functools import lru_cache
+import importlib
+import importlib.util
 from itertools import chain
+import logging
 import math
 import statistics
+import sys
+import threading
+import time
 from typing import Dict, Iterable, List, Optional, Sequence, Tuple, get_type_hints
 from typing_extensions import TypedDict, get_args
 
-import grpc
+from com_sketch import LatencyHistogram, TDigest
 
-try:
-    from yagrc import importer
-    importer.add_lazy_packages(["spacex.api.device"])
-    imports_pending = True
-except (ImportError, AttributeError):
-    imports_pending = False
 
-from spacex.api.device import device_pb2
-from spacex.api.device import device_pb2_grpc
-from spacex.api.device import dish_pb2
+class _LazyModule:
+    # Stands in for a module global until first attribute access, then imports
+    # the real module and replaces itself with it, so that runs that never make
+    # an RPC or compute history stats don't pay for the import. Unlike
+    # importlib's LazyLoader, this is safe when several threads make their
+    # first RPC at once: import_module holds the import lock until the module
+    # is fully initialized.
+    def __init__(self, global_name: str, module_name: str) -> None:
+        self._global_name = global_name
+        self._module_name = module_name
+
+    def __getattr__(self, attr: str):
+        module = importlib.import_module(self._module_name)
+        globals()[self._global_name] = module
+        return getattr(module, attr)
+
+
+grpc = _LazyModule("grpc", "grpc")
+np = _LazyModule("np", "numpy") if importlib.util.find_spec("numpy") else None
+
+# protocol modules are imported by _import_protocols on first use
+imports_pending = True
+importer = None
+com_descriptors = None
+device_pb2 = None
+device_pb2_grpc = None
+dish_pb2 = None
 
 REQUEST_TIMEOUT = 10
+# Device.Handle, as called by the generated stub
+HANDLE_METHOD = "/SpaceX.API.Device.Device/Handle"
+
+_imports_lock = threading.Lock()
+descriptor_cache_path: Optional[str] = None
+_use_descriptor_cache = False
+_descriptor_firmware: Optional[str] = None
+_descriptor_roots: Optional[List[str]] = None
+# set by com_profile.enable(); while None, nothing is timed
+profiler = None
 
 HISTORY_FIELDS = ("pop_ping_drop_rate", "pop_ping_latency_ms", "downlink_throughput_bps",
                   "uplink_throughput_bps")
@@ -115,6 +152,12 @@ LoadedLatencyDict = TypedDict(
         "load_bucket_max_latency[]": Sequence[Optional[float]],
     })
 
+LoadedLatencyTailDict = TypedDict(
+    "LoadedLatencyTailDict", {
+        "load_bucket_p90_latency[]": Sequence[Optional[float]],
+        "load_bucket_p99_latency[]": Sequence[Optional[float]],
+    })
+
 UsageDict = TypedDict("UsageDict", {
     "download_usage": int,
     "upload_usage": int,
@@ -131,36 +174,115 @@ _FIELD_NAME_MAP = {
     "load_bucket_min_latency[]": "load_bucket_min_latency[15]",
     "load_bucket_median_latency[]": "load_bucket_median_latency[15]",
     "load_bucket_max_latency[]": "load_bucket_max_latency[15]",
+    "load_bucket_p90_latency[]": "load_bucket_p90_latency[15]",
+    "load_bucket_p99_latency[]": "load_bucket_p99_latency[15]",
 }
 
 
+@lru_cache(maxsize=None)
+def _schema(hint_type):
+    def xlate(value):
+        while not isinstance(value, type):
+            args = get_args(value)
+            value = args[0] if args[0] is not type(None) else args[1]
+        return value
+
+    hints = get_type_hints(hint_type)
+    return (tuple(_FIELD_NAME_MAP.get(key, key) for key in hints),
+            tuple(key + "[]" for key in hints), tuple(xlate(val) for val in hints.values()))
+
+
 def _field_names(hint_type):
-    return list(_FIELD_NAME_MAP.get(key, key) for key in get_type_hints(hint_type))
+    return list(_schema(hint_type)[0])
 
 
 def _field_names_bulk(hint_type):
-    return list(key + "[]" for key in get_type_hints(hint_type))
+    return list(_schema(hint_type)[1])
 
 
 def _field_types(hint_type):
-    def xlate(value):
-        while not isinstance(value, type):
-            args = get_args(value)
-            value = args[0] if args[0] is not type(None) else args[1]
-        return value
+    return list(_schema(hint_type)[2])
+
 
-    return list(xlate(val) for val in get_type_hints(hint_type).values())
+def _import_protocols() -> bool:
+    # Returns whether the protocol modules still need resolving via reflection
+    global importer, com_descriptors, device_pb2, device_pb2_grpc, dish_pb2
+    try:
+        from yagrc import importer
+        importer.add_lazy_packages(["spacex.api.device"])
+        import com_descriptors
+        reflection = True
+    except (ImportError, AttributeError):
+        reflection = False
+
+    from spacex.api.device import device_pb2
+    from spacex.api.device import device_pb2_grpc
+    from spacex.api.device import dish_pb2
+    return reflection
 
 
 def resolve_imports(channel: grpc.Channel):
-    importer.resolve_lazy_imports(channel)
-    global imports_pending
-    imports_pending = False
+    global imports_pending, descriptor_cache_path, _descriptor_roots
+    with _imports_lock:
+        if imports_pending:
+            if not _import_protocols():
+                descriptor_cache_path = None
+            elif not _load_descriptor_cache():
+                roots = com_descriptors.pending_roots() if descriptor_cache_path else None
+                importer.resolve_lazy_imports(channel)
+                if descriptor_cache_path:
+                    com_descriptors.save_lazy_imports(descriptor_cache_path, roots)
+                    _descriptor_roots = roots
+            imports_pending = False
+
+
+def use_descriptor_cache(path: Optional[str] = None) -> None:
+    # The cache file is only read once the protocol modules are first needed
+    global descriptor_cache_path, _use_descriptor_cache
+    descriptor_cache_path = path
+    _use_descriptor_cache = True
+
+
+def _load_descriptor_cache() -> bool:
+    global descriptor_cache_path, _descriptor_firmware, _use_descriptor_cache
+    if not _use_descriptor_cache:
+        return False
+    if not com_descriptors.supported():
+        logging.warning("Descriptor cache disabled: unsupported yagrc version")
+        _use_descriptor_cache = False
+        descriptor_cache_path = None
+        return False
+    if descriptor_cache_path is None:
+        descriptor_cache_path = com_descriptors.DEFAULT_CACHE_PATH
+    state = com_descriptors.load_lazy_imports(descriptor_cache_path)
+    if state is None:
+        return False
+    _descriptor_firmware = state["firmware"]
+    return True
+
+
+def _check_descriptor_firmware(status, context: Optional["ChannelContext"]) -> None:
+    global _descriptor_firmware, _descriptor_roots
+    try:
+        firmware = status.device_info.software_version
+    except AttributeError:
+        return
+    if not firmware or firmware == _descriptor_firmware:
+        return
+    _descriptor_firmware = firmware
+    if _descriptor_roots is not None:
+        # descriptors were just reflected from the dish, so only need the version recorded
+        com_descriptors.save_lazy_imports(descriptor_cache_path, _descriptor_roots, firmware)
+        _descriptor_roots = None
+    else:
+        target = "192.168.100.1:9200" if context is None else context.target
+        com_descriptors.refresh_in_background(descriptor_cache_path, target, firmware)
 
 
 class GrpcError(Exception):
     def __init__(self, e, *args, **kwargs):
-        if isinstance(e, grpc.Call):
+        if isinstance(e, grpc.Call) or isinstance(e, grpc.RpcError) and hasattr(e, "details"):
+            # grpc.aio errors carry details but are not grpc.Call instances
             msg = e.details()
         elif isinstance(e, grpc.RpcError):
             msg = "Unknown communication or service error"
@@ -172,14 +294,62 @@ class GrpcError(Exception):
 
 
 class UnwrappedHistory:
+    __slots__ = HISTORY_FIELDS + ("current", "unwrapped")
 
-    unwrapped: bool
+    def __init__(self, fields: Iterable[str] = HISTORY_FIELDS) -> None:
+        for field in fields:
+            setattr(self, field, array("d"))
+        self.current = 0
+        self.unwrapped = True
+
+    def append_history(self, history, sample_range) -> None:
+        for field in HISTORY_FIELDS:
+            column = getattr(self, field, None)
+            if column is None:
+                continue
+            values = getattr(history, field, None)
+            if values is None:
+                delattr(self, field)
+                continue
+            for part in _sample_ranges(sample_range):
+                # converts float32 columns, such as PackedHistory ones
+                column.extend(array("d", values[part.start:part.stop]))
+
+    def extend(self,
+               history,
+               samples: int = -1,
+               start: Optional[int] = None,
+               verbose: bool = False) -> None:
+        # Same as concatenate_history(self, history, ...), but appends to this
+        # history in place, in amortized O(new samples), instead of copying
+        # the earlier samples into a new one
+        new_samples = _new_sample_count(self, history, verbose)
+        if new_samples is None:
+            return
+        self.trim(_compute_sample_range(self, samples, start=start)[1])
+        self.append_history(history, _compute_sample_range(history, new_samples)[0])
+        self.current = history.current
+
+    def trim(self, samples: int) -> None:
+        # Keeps only the last samples of each column
+        for field in HISTORY_FIELDS:
+            column = getattr(self, field, None)
+            if column is not None:
+                del column[:max(0, len(column) - samples)]
 
 
 class ChannelContext:
-    def __init__(self, target: Optional[str] = None) -> None:
+    def __init__(self, target: Optional[str] = None, status_ttl: float = 0.0) -> None:
         self.channel = None
         self.target = "192.168.100.1:9200" if target is None else target
+        self.status_ttl = status_ttl
+        # monotonic time by which poll requests must finish, if any
+        self.deadline: Optional[float] = None
+        self.status_hits = 0
+        self.status_misses = 0
+        self._status = None
+        self._status_time = 0.0
+        self._status_lock = threading.Lock()
 
     def get_channel(self) -> Tuple[grpc.Channel, bool]:
         reused = True
@@ -192,21 +362,75 @@ class ChannelContext:
         if self.channel is not None:
             self.channel.close()
         self.channel = None
+        self.invalidate_status()
+
+    def time_left(self) -> Optional[float]:
+        if self.deadline is None:
+            return None
+        return self.deadline - time.monotonic()
+
+    def cached_status(self, fetch):
+        # Holding the lock across the fetch makes concurrent callers wait for
+        # the one request in flight and then share its response.
+        with self._status_lock:
+            now = time.monotonic()
+            if self._status is not None and now - self._status_time < self.status_ttl:
+                self.status_hits += 1
+                return self._status
+            self.status_misses += 1
+            self._status = fetch()
+            self._status_time = now
+            return self._status
+
+    def invalidate_status(self) -> None:
+        self._status = None
 
 
 def call_with_channel(function, *args, context: Optional[ChannelContext] = None, **kwargs):
+    prof = profiler
+    if prof is None:
+        return _call_with_channel(function, args, kwargs, context)
+
+    # the grpc_call functions are named for the function that defines them
+    name = "rpc." + function.__qualname__.split(".", 1)[0]
+    start = time.perf_counter()
+    try:
+        return _call_with_channel(function, args, kwargs, context, prof)
+    except grpc.RpcError:
+        prof.count(name + ".errors")
+        raise
+    finally:
+        prof.time(name, time.perf_counter() - start)
+
+
+def _call_with_channel(function, args, kwargs, context: Optional[ChannelContext], prof=None):
     if context is None:
+        if prof is not None:
+            prof.count("channel_connects")
         with grpc.insecure_channel("192.168.100.1:9200") as channel:
             return function(channel, *args, **kwargs)
 
     while True:
         channel, reused = context.get_channel()
+        if not reused and prof is not None:
+            prof.count("channel_connects")
         try:
             return function(channel, *args, **kwargs)
         except grpc.RpcError:
             context.close()
-            if not reused:
+            time_left = context.time_left()
+            if not reused or time_left is not None and time_left <= 0.0:
                 raise
+            if prof is not None:
+                prof.count("channel_reconnects")
+
+
+def _request_timeout(context: Optional[ChannelContext]) -> float:
+    # A request timeout of 0 fails at once with DEADLINE_EXCEEDED
+    time_left = context.time_left() if context is not None else None
+    if time_left is None:
+        return REQUEST_TIMEOUT
+    return max(0.0, min(time_left, REQUEST_TIMEOUT))
 
 
 def status_field_names(context: Optional[ChannelContext] = None):
@@ -244,10 +468,17 @@ def get_status(context: Optional[ChannelContext] = None):
         if imports_pending:
             resolve_imports(channel)
         stub = device_pb2_grpc.DeviceStub(channel)
-        response = stub.Handle(device_pb2.Request(get_status={}), timeout=REQUEST_TIMEOUT)
+        response = stub.Handle(device_pb2.Request(get_status={}),
+                               timeout=_request_timeout(context))
         return response.dish_get_status
 
-    return call_with_channel(grpc_call, context=context)
+    if context is None or context.status_ttl <= 0.0:
+        status = call_with_channel(grpc_call, context=context)
+    else:
+        status = context.cached_status(lambda: call_with_channel(grpc_call, context=context))
+    if descriptor_cache_path:
+        _check_descriptor_firmware(status, context)
+    return status
 
 
 def get_id(context: Optional[ChannelContext] = None) -> str:
@@ -259,13 +490,14 @@ def get_id(context: Optional[ChannelContext] = None) -> str:
         raise GrpcError(e) from e
 
 
-def status_data(
-        context: Optional[ChannelContext] = None) -> Tuple[StatusDict, ObstructionDict, AlertDict]:
+def status_data(context: Optional[ChannelContext] = None,
+                status=None) -> Tuple[StatusDict, ObstructionDict, AlertDict]:
 
-    try:
-        status = get_status(context)
-    except (AttributeError, ValueError, grpc.RpcError) as e:
-        raise GrpcError(e) from e
+    if status is None:
+        try:
+            status = get_status(context)
+        except (AttributeError, ValueError, grpc.RpcError) as e:
+            raise GrpcError(e) from e
 
     try:
         if status.HasField("outage"):
@@ -349,24 +581,26 @@ def get_location(context: Optional[ChannelContext] = None):
         if imports_pending:
             resolve_imports(channel)
         stub = device_pb2_grpc.DeviceStub(channel)
-        response = stub.Handle(device_pb2.Request(get_location={}), timeout=REQUEST_TIMEOUT)
+        response = stub.Handle(device_pb2.Request(get_location={}),
+                               timeout=_request_timeout(context))
         return response.get_location
 
     return call_with_channel(grpc_call, context=context)
 
 
-def location_data(context: Optional[ChannelContext] = None) -> LocationDict:
+def location_data(context: Optional[ChannelContext] = None, location=None) -> LocationDict:
 
-    try:
-        location = get_location(context)
-    except (AttributeError, ValueError, grpc.RpcError) as e:
-        if isinstance(e, grpc.Call) and e.code() is grpc.StatusCode.PERMISSION_DENIED:
-            return {
-                "latitude": None,
-                "longitude": None,
-                "altitude": None,
-            }
-        raise GrpcError(e) from e
+    if location is None:
+        try:
+            location = get_location(context)
+        except (AttributeError, ValueError, grpc.RpcError) as e:
+            if isinstance(e, grpc.Call) and e.code() is grpc.StatusCode.PERMISSION_DENIED:
+                return {
+                    "latitude": None,
+                    "longitude": None,
+                    "altitude": None,
+                }
+            raise GrpcError(e) from e
 
     try:
         return {
@@ -394,16 +628,24 @@ def history_ping_field_names():
     return history_stats_field_names()[0:3]
 
 
-def history_stats_field_names():
+def history_stats_field_names(loaded_tail: bool = False):
 
-    return (_field_names(HistGeneralDict), _field_names(PingDropDict), _field_names(PingDropRlDict),
-            _field_names(PingLatencyDict), _field_names(LoadedLatencyDict), _field_names(UsageDict))
+    groups = (_field_names(HistGeneralDict), _field_names(PingDropDict),
+              _field_names(PingDropRlDict), _field_names(PingLatencyDict),
+              _field_names(LoadedLatencyDict), _field_names(UsageDict))
+    if loaded_tail:
+        return groups + (_field_names(LoadedLatencyTailDict),)
+    return groups
 
 
-def history_stats_field_types():
+def history_stats_field_types(loaded_tail: bool = False):
 
-    return (_field_types(HistGeneralDict), _field_types(PingDropDict), _field_types(PingDropRlDict),
-            _field_types(PingLatencyDict), _field_types(LoadedLatencyDict), _field_types(UsageDict))
+    groups = (_field_types(HistGeneralDict), _field_types(PingDropDict),
+              _field_types(PingDropRlDict), _field_types(PingLatencyDict),
+              _field_types(LoadedLatencyDict), _field_types(UsageDict))
+    if loaded_tail:
+        return groups + (_field_types(LoadedLatencyTailDict),)
+    return groups
 
 
 def get_history(context: Optional[ChannelContext] = None):
@@ -412,12 +654,120 @@ def get_history(context: Optional[ChannelContext] = None):
         if imports_pending:
             resolve_imports(channel)
         stub = device_pb2_grpc.DeviceStub(channel)
-        response = stub.Handle(device_pb2.Request(get_history={}), timeout=REQUEST_TIMEOUT)
+        response = stub.Handle(device_pb2.Request(get_history={}),
+                               timeout=_request_timeout(context))
         return response.dish_get_history
 
     return call_with_channel(grpc_call, context=context)
 
 
+class PackedHistory:
+    # History columns taken straight from the packed repeated floats of a raw
+    # get_history response. On little-endian hosts, each column is a float32
+    # memoryview over the response bytes, so nothing is copied or converted to
+    # Python floats until used. Fields the protocol lacks are left unset, as
+    # they are missing from the protobuf message.
+    __slots__ = HISTORY_FIELDS + ("current",)
+
+    def __init__(self, current: int = 0, columns: Optional[Dict] = None) -> None:
+        self.current = current
+        if columns:
+            for field, column in columns.items():
+                setattr(self, field, column)
+
+
+def get_packed_history(context: Optional[ChannelContext] = None):
+    # Same as get_history, but decodes the history fields without building
+    # the protobuf message; see unpack_history
+
+    def grpc_call(channel: grpc.Channel):
+        if imports_pending:
+            resolve_imports(channel)
+        handle = channel.unary_unary(HANDLE_METHOD,
+                                     request_serializer=device_pb2.Request.SerializeToString)
+        return handle(device_pb2.Request(get_history={}), timeout=_request_timeout(context))
+
+    return unpack_history(call_with_channel(grpc_call, context=context))
+
+
+def _read_varint(data, pos: int) -> Tuple[int, int]:
+    result = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _wire_fields(data, pos: int, end: int):
+    # Yields the number, wire type and value span of each field of a protobuf
+    # message; the span of a length-delimited field is just its contents
+    while pos < end:
+        key, pos = _read_varint(data, pos)
+        wire_type = key & 7
+        start = pos
+        if wire_type == 0:
+            pos = _read_varint(data, pos)[1]
+        elif wire_type == 1:
+            pos += 8
+        elif wire_type == 2:
+            length, start = _read_varint(data, pos)
+            pos = start + length
+        elif wire_type == 5:
+            pos += 4
+        else:
+            raise ValueError("Unsupported protobuf wire type: " + str(wire_type))
+        if pos > end:
+            raise ValueError("Truncated protobuf message")
+        yield key >> 3, wire_type, start, pos
+
+
+def _float_column(parts):
+    if len(parts) == 1 and sys.byteorder == "little" and not len(parts[0]) % 4:
+        return parts[0].cast("f")
+    column = array("f")
+    for part in parts:
+        column.frombytes(part)
+    if sys.byteorder != "little":
+        column.byteswap()
+    return column
+
+
+def unpack_history(data: bytes):
+    """Decode the history from a serialized get_history Response.
+
+    Returns a PackedHistory, or the dish_get_history message itself in the
+    unlikely case the float fields are not packed.
+    """
+    response_field = device_pb2.Response.DESCRIPTOR.fields_by_name["dish_get_history"]
+    fields = response_field.message_type.fields_by_name
+    current_number = fields["current"].number
+    columns = {fields[name].number: name for name in HISTORY_FIELDS if name in fields}
+
+    view = memoryview(data)
+    current = 0
+    parts = {name: [] for name in columns.values()}
+    try:
+        for number, wire_type, start, end in _wire_fields(view, 0, len(view)):
+            if number != response_field.number or wire_type != 2:
+                continue
+            # repeated occurrences of the message merge, as protobuf does
+            for field_number, field_type, field_start, field_end in _wire_fields(view, start, end):
+                if field_number == current_number and field_type == 0:
+                    current = _read_varint(view, field_start)[0]
+                elif field_number in columns:
+                    if field_type != 2:
+                        return device_pb2.Response.FromString(data).dish_get_history
+                    parts[columns[field_number]].append(view[field_start:field_end])
+    except IndexError as e:
+        raise ValueError("Truncated protobuf message") from e
+
+    return PackedHistory(current, {field: _float_column(part) for field, part in parts.items()})
+
+
 def _compute_sample_range(history,
                           parse_samples: int,
                           start: Optional[int] = None,
@@ -463,22 +813,57 @@ def _compute_sample_range(history,
     if start_offset < end_offset:
         sample_range = range(start_offset, end_offset)
     else:
-        sample_range = chain(range(start_offset, samples), range(0, end_offset))
+        sample_range = _WrappedRange(range(start_offset, samples), range(0, end_offset))
 
     return sample_range, current - start, current
 
 
+class _WrappedRange:
+    __slots__ = ("ranges",)
+
+    def __init__(self, *ranges: range) -> None:
+        self.ranges = ranges
+
+    def __iter__(self):
+        return chain.from_iterable(self.ranges)
+
+
+def _sample_ranges(sample_range) -> Sequence[range]:
+    if isinstance(sample_range, _WrappedRange):
+        return sample_range.ranges
+    return (sample_range,)
+
+
 def concatenate_history(history1,
                         history2,
                         samples1: int = -1,
                         start1: Optional[int] = None,
                         verbose: bool = False):
 
+    new_samples = _new_sample_count(history1, history2, verbose)
+    if new_samples is None:
+        return history1
+
+    sample_range, ignore1, ignore2 = _compute_sample_range(  # pylint: disable=unused-variable
+        history1, samples1, start=start1)
+    unwrapped = UnwrappedHistory(field for field in HISTORY_FIELDS if hasattr(history1, field))
+    unwrapped.append_history(history1, sample_range)
+
+    sample_range, ignore1, ignore2 = _compute_sample_range(history2, new_samples)  # pylint: disable=unused-variable
+    unwrapped.append_history(history2, sample_range)
+
+    unwrapped.current = history2.current
+    return unwrapped
+
+
+def _new_sample_count(history1, history2, verbose: bool = False) -> Optional[int]:
+    # Number of samples of history2 that follow history1, or None if either
+    # is not a usable history
     try:
         size2 = len(history2.pop_ping_drop_rate)
         new_samples = history2.current - history1.current
     except (AttributeError, TypeError):
-        return history1
+        return None
 
     if new_samples < 0:
         if verbose:
@@ -488,34 +873,7 @@ def concatenate_history(history1,
         if verbose:
             print("WARNING: Appending discontiguous samples. Polling interval probably too short.")
         new_samples = size2
-
-    unwrapped = UnwrappedHistory()
-    for field in HISTORY_FIELDS:
-        if hasattr(history1, field) and hasattr(history2, field):
-            setattr(unwrapped, field, [])
-    unwrapped.unwrapped = True
-
-    sample_range, ignore1, ignore2 = _compute_sample_range(  # pylint: disable=unused-variable
-        history1, samples1, start=start1)
-    for i in sample_range:
-        for field in HISTORY_FIELDS:
-            if hasattr(unwrapped, field):
-                try:
-                    getattr(unwrapped, field).append(getattr(history1, field)[i])
-                except (IndexError, TypeError):
-                    pass
-
-    sample_range, ignore1, ignore2 = _compute_sample_range(history2, new_samples)  # pylint: disable=unused-variable
-    for i in sample_range:
-        for field in HISTORY_FIELDS:
-            if hasattr(unwrapped, field):
-                try:
-                    getattr(unwrapped, field).append(getattr(history2, field)[i])
-                except (IndexError, TypeError):
-                    pass
-
-    unwrapped.current = history2.current
-    return unwrapped
+    return new_samples
 
 
 def history_bulk_data(parse_samples: int,
@@ -526,7 +884,7 @@ def history_bulk_data(parse_samples: int,
 
     if history is None:
         try:
-            history = get_history(context)
+            history = get_packed_history(context)
         except (AttributeError, ValueError, grpc.RpcError) as e:
             raise GrpcError(e) from e
 
@@ -535,35 +893,44 @@ def history_bulk_data(parse_samples: int,
                                                                   start=start,
                                                                   verbose=verbose)
 
-    pop_ping_drop_rate = []
-    pop_ping_latency_ms = []
-    downlink_throughput_bps = []
-    uplink_throughput_bps = []
-
-    for i in sample_range:
-        pop_ping_drop_rate.append(history.pop_ping_drop_rate[i])
-
-        latency = None
-        try:
-            if history.pop_ping_drop_rate[i] < 1:
-                latency = history.pop_ping_latency_ms[i]
-        except (AttributeError, IndexError, TypeError):
-            pass
-        pop_ping_latency_ms.append(latency)
-
-        downlink = None
-        try:
-            downlink = history.downlink_throughput_bps[i]
-        except (AttributeError, IndexError, TypeError):
-            pass
-        downlink_throughput_bps.append(downlink)
-
-        uplink = None
-        try:
-            uplink = history.uplink_throughput_bps[i]
-        except (AttributeError, IndexError, TypeError):
-            pass
-        uplink_throughput_bps.append(uplink)
+    if isinstance(history, PackedHistory):
+        pop_ping_drop_rate = _bulk_column(history, "pop_ping_drop_rate", sample_range)
+        pop_ping_latency_ms = [
+            latency if drop < 1 else None for drop, latency in zip(
+                pop_ping_drop_rate, _bulk_column(history, "pop_ping_latency_ms", sample_range))
+        ]
+        downlink_throughput_bps = _bulk_column(history, "downlink_throughput_bps", sample_range)
+        uplink_throughput_bps = _bulk_column(history, "uplink_throughput_bps", sample_range)
+    else:
+        pop_ping_drop_rate = []
+        pop_ping_latency_ms = []
+        downlink_throughput_bps = []
+        uplink_throughput_bps = []
+
+        for i in sample_range:
+            pop_ping_drop_rate.append(history.pop_ping_drop_rate[i])
+
+            latency = None
+            try:
+                if history.pop_ping_drop_rate[i] < 1:
+                    latency = history.pop_ping_latency_ms[i]
+            except (AttributeError, IndexError, TypeError):
+                pass
+            pop_ping_latency_ms.append(latency)
+
+            downlink = None
+            try:
+                downlink = history.downlink_throughput_bps[i]
+            except (AttributeError, IndexError, TypeError):
+                pass
+            downlink_throughput_bps.append(downlink)
+
+            uplink = None
+            try:
+                uplink = history.uplink_throughput_bps[i]
+            except (AttributeError, IndexError, TypeError):
+                pass
+            uplink_throughput_bps.append(uplink)
 
     return {
         "samples": parsed_samples,
@@ -579,6 +946,19 @@ def history_bulk_data(parse_samples: int,
     }
 
 
+def _bulk_column(history, field, sample_range) -> List[Optional[float]]:
+    # Slices whole sample ranges at a time, with None for samples past the
+    # end of a short or missing column
+    values = getattr(history, field, None)
+    column = []
+    for part in _sample_ranges(sample_range):
+        size = len(column)
+        if values is not None:
+            column.extend(values[part.start:part.stop].tolist())
+        column.extend([None] * (len(part) - (len(column)-size)))
+    return column
+
+
 def history_ping_stats(parse_samples: int,
                        verbose: bool = False,
                        context: Optional[ChannelContext] = None
@@ -586,173 +966,462 @@ def history_ping_stats(parse_samples: int,
     return history_stats(parse_samples, verbose=verbose, context=context)[0:3]
 
 
+def _weighted_mean_and_quantiles(data, n):
+    if not data:
+        return None, [None] * (n+1)
+    total_weight = sum(x[1] for x in data)
+    result = []
+    items = iter(data)
+    value, accum_weight = next(items)
+    accum_value = value * accum_weight
+    for boundary in (total_weight * x / n for x in range(n)):
+        while accum_weight < boundary:
+            try:
+                value, weight = next(items)
+                accum_value += value * weight
+                accum_weight += weight
+            except StopIteration:
+                break
+        result.append(value)
+    result.append(data[-1][0])
+    accum_value += sum(x[0] for x in items)
+    return accum_value / total_weight, result
+
+
+def _sample_indices(sample_range):
+    return np.concatenate([np.arange(part.start, part.stop) for part in _sample_ranges(sample_range)])
+
+
+def _history_column(history, field, indices, default=None):
+    try:
+        values = getattr(history, field)
+        if isinstance(values, array):
+            column = np.frombuffer(values, dtype=values.typecode)
+        elif isinstance(values, memoryview):
+            column = np.frombuffer(values, dtype=values.format)
+        else:
+            column = np.fromiter(values, dtype=np.float64, count=len(values))
+    except (AttributeError, TypeError, ValueError):
+        if default is None:
+            raise
+        return np.full(len(indices), default)
+
+    if default is None:
+        return column[indices].astype(np.float64, copy=False)
+    unwrapped = np.full(len(indices), default)
+    valid = indices < len(column)
+    unwrapped[valid] = column[indices[valid]]
+    return unwrapped
+
+
+def _sequential_sum(values, initial=0.0):
+    # cumsum adds strictly left to right, so this matches a Python loop bit for bit,
+    # unlike np.sum, which uses pairwise summation
+    if not len(values):
+        return initial
+    return float(np.cumsum(np.concatenate(([initial], values)))[-1])
+
+
+def _load_buckets(throughput):
+    buckets = np.zeros(len(throughput), dtype=np.intp)
+    loaded = throughput > 500000
+    ratio = throughput[loaded] / 500000
+    log2 = np.log2(ratio)
+    bucket = np.floor(log2)
+    # np.log2 may round differently from math.log2 right at a bucket boundary
+    for i in np.flatnonzero(np.abs(log2 - np.rint(log2)) < 1e-9):
+        bucket[i] = int(math.log2(ratio[i]))
+    buckets[loaded] = np.minimum(14, bucket)
+    return buckets
+
+
+def _np_weighted_mean_and_quantiles(values, weights, n):
+    if not len(values):
+        return None, [None] * (n+1)
+    accum_weight = np.cumsum(weights)
+    total_weight = float(accum_weight[-1])
+    boundaries = [total_weight * x / n for x in range(n)]
+    index = np.minimum(np.searchsorted(accum_weight, boundaries, side="left"), len(values) - 1)
+    result = values[index].tolist()
+    result.append(float(values[-1]))
+    last = int(index[-1])
+    accum_value = _sequential_sum(values[:last + 1] * weights[:last + 1])
+    accum_value += _sequential_sum(values[last + 1:], 0)
+    return accum_value / total_weight, result
+
+
+class HistoryStatsAccumulator:
+    def __init__(self, use_numpy: bool = True, sketch: bool = False) -> None:
+        self.use_numpy = use_numpy and np is not None
+        self.sketch = sketch
+        self.samples = 0
+        self.end_counter: Optional[int] = None
+
+        self.total_ping_drop = 0.0
+        self.count_full_ping_drop = 0
+        self.usage_down = 0.0
+        self.usage_up = 0.0
+
+        self.second_runs = [0] * 60
+        self.minute_runs = [0] * 60
+        self.run_length = 0
+        self.init_run_length: Optional[int] = None
+
+        self.rtt_full: List[float] = []
+        self.rtt_all: List[Tuple[float, float]] = []
+        self.rtt_buckets = [LatencyHistogram() for _ in range(15)]
+        self.latency_chunks: List[Tuple] = []
+
+        self.digest_all = TDigest()
+        self.digest_full = TDigest()
+        self.full_count = 0
+        self.full_mean = 0.0
+        self.full_m2 = 0.0
+
+    def add_history(self,
+                    history,
+                    parse_samples: int = -1,
+                    start: Optional[int] = None,
+                    verbose: bool = False) -> int:
+        if start is None:
+            start = self.end_counter
+
+        sample_range, parsed_samples, current = _compute_sample_range(history,
+                                                                      parse_samples,
+                                                                      start=start,
+                                                                      verbose=verbose)
+        if parsed_samples:
+            if self.use_numpy:
+                self._add_numpy(history, sample_range)
+            else:
+                self._add_python(history, sample_range)
+            if self.sketch:
+                self._add_sketch()
+
+        self.samples += parsed_samples
+        self.end_counter = current
+        return parsed_samples
+
+    def merge(self, other: HistoryStatsAccumulator) -> None:
+        # other must hold the samples that directly follow this one's
+        if other.sketch != self.sketch or not self.sketch and other.use_numpy != self.use_numpy:
+            raise ValueError("Cannot merge accumulators with different latency modes")
+        self.samples += other.samples
+        if other.end_counter is not None:
+            self.end_counter = other.end_counter
+
+        self.total_ping_drop += other.total_ping_drop
+        self.count_full_ping_drop += other.count_full_ping_drop
+        self.usage_down += other.usage_down
+        self.usage_up += other.usage_up
+
+        self.second_runs = [x + y for x, y in zip(self.second_runs, other.second_runs)]
+        self.minute_runs = [x + y for x, y in zip(self.minute_runs, other.minute_runs)]
+        if other.init_run_length is None:
+            self.run_length += other.run_length
+        else:
+            run_length = self.run_length + other.init_run_length
+            if run_length > 0 or self.init_run_length is None:
+                self._end_run(run_length)
+            self.run_length = other.run_length
+
+        for bucket, other_bucket in zip(self.rtt_buckets, other.rtt_buckets):
+            bucket.merge(other_bucket)
+        if self.sketch:
+            self.digest_all.merge(other.digest_all)
+            self.digest_full.merge(other.digest_full)
+            if other.full_count:
+                total = self.full_count + other.full_count
+                delta = other.full_mean - self.full_mean
+                self.full_mean += delta * other.full_count / total
+                self.full_m2 += (other.full_m2 +
+                                 delta**2 * self.full_count * other.full_count / total)
+                self.full_count = total
+        else:
+            self.latency_chunks.extend(other.latency_chunks)
+            self.rtt_full.extend(other.rtt_full)
+            self.rtt_all.extend(other.rtt_all)
+
+    def to_dict(self) -> Dict:
+        if not self.sketch:
+            raise ValueError("Only sketch mode accumulators can be serialized")
+        return {
+            "samples": self.samples,
+            "end_counter": self.end_counter,
+            "total_ping_drop": self.total_ping_drop,
+            "count_full_ping_drop": self.count_full_ping_drop,
+            "usage_down": self.usage_down,
+            "usage_up": self.usage_up,
+            "second_runs": self.second_runs,
+            "minute_runs": self.minute_runs,
+            "run_length": self.run_length,
+            "init_run_length": self.init_run_length,
+            "rtt_buckets": [bucket.to_dict() for bucket in self.rtt_buckets],
+            "digest_all": self.digest_all.to_dict(),
+            "digest_full": self.digest_full.to_dict(),
+            "full_count": self.full_count,
+            "full_mean": self.full_mean,
+            "full_m2": self.full_m2,
+        }
+
+    @classmethod
+    def from_dict(cls, state: Dict, use_numpy: bool = True) -> HistoryStatsAccumulator:
+        accum = cls(use_numpy=use_numpy, sketch=True)
+        for key in ("samples", "end_counter", "total_ping_drop", "count_full_ping_drop",
+                    "usage_down", "usage_up", "second_runs", "minute_runs", "run_length",
+                    "init_run_length", "full_count", "full_mean", "full_m2"):
+            setattr(accum, key, state[key])
+        accum.rtt_buckets = [LatencyHistogram.from_dict(x) for x in state["rtt_buckets"]]
+        accum.digest_all = TDigest.from_dict(state["digest_all"])
+        accum.digest_full = TDigest.from_dict(state["digest_full"])
+        return accum
+
+    def _end_run(self, run_length: int) -> None:
+        if self.init_run_length is None:
+            self.init_run_length = run_length
+        elif run_length <= 60:
+            self.second_runs[run_length - 1] += run_length
+        else:
+            self.minute_runs[min((run_length-1) // 60 - 1, 59)] += run_length
+
+    def _add_python(self, history, sample_range) -> None:
+        for i in sample_range:
+            d = history.pop_ping_drop_rate[i]
+            if d >= 1:
+                # just in case...
+                d = 1
+                self.count_full_ping_drop += 1
+                self.run_length += 1
+            elif self.run_length > 0 or self.init_run_length is None:
+                self._end_run(self.run_length)
+                self.run_length = 0
+            self.total_ping_drop += d
+
+            down = 0.0
+            try:
+                down = history.downlink_throughput_bps[i]
+            except (AttributeError, IndexError, TypeError):
+                pass
+            self.usage_down += down
+
+            up = 0.0
+            try:
+                up = history.uplink_throughput_bps[i]
+            except (AttributeError, IndexError, TypeError):
+                pass
+            self.usage_up += up
+
+            rtt = 0.0
+            try:
+                rtt = history.pop_ping_latency_ms[i]
+            except (AttributeError, IndexError, TypeError):
+                pass
+
+            if d == 0.0:
+                self.rtt_full.append(rtt)
+                if down + up > 500000:
+                    self.rtt_buckets[min(14, int(math.log2((down+up) / 500000)))].add(rtt)
+                else:
+                    self.rtt_buckets[0].add(rtt)
+            if d < 1.0:
+                self.rtt_all.append((rtt, 1.0 - d))
+
+    def _add_numpy(self, history, sample_range) -> None:
+        indices = _sample_indices(sample_range)
+        drop = _history_column(history, "pop_ping_drop_rate", indices)
+        down = _history_column(history, "downlink_throughput_bps", indices, 0.0)
+        up = _history_column(history, "uplink_throughput_bps", indices, 0.0)
+        rtt = _history_column(history, "pop_ping_latency_ms", indices, 0.0)
+
+        full = drop >= 1
+        drop[full] = 1.0
+        count_full = int(np.count_nonzero(full))
+        self.count_full_ping_drop += count_full
+        self.total_ping_drop = _sequential_sum(drop, self.total_ping_drop)
+        self.usage_down = _sequential_sum(down, self.usage_down)
+        self.usage_up = _sequential_sum(up, self.usage_up)
+
+        if count_full == len(full):
+            self.run_length += count_full
+        else:
+            edges = np.diff(np.concatenate(([0], full.view(np.int8), [0])))
+            run_starts = np.flatnonzero(edges == 1)
+            run_lengths = np.flatnonzero(edges == -1) - run_starts
+            lead = 0
+            if len(run_starts) and run_starts[0] == 0:
+                lead = int(run_lengths[0])
+                run_starts = run_starts[1:]
+                run_lengths = run_lengths[1:]
+            if self.run_length + lead > 0 or self.init_run_length is None:
+                self._end_run(self.run_length + lead)
+            self.run_length = 0
+            if len(run_lengths) and run_starts[-1] + run_lengths[-1] == len(full):
+                self.run_length = int(run_lengths[-1])
+                run_lengths = run_lengths[:-1]
+            short_runs = run_lengths[run_lengths <= 60]
+            self.second_runs = (np.bincount(short_runs - 1, minlength=60) * np.arange(1, 61) +
+                                self.second_runs).tolist()
+            long_runs = run_lengths[run_lengths > 60]
+            minute_runs = np.array(self.minute_runs, dtype=np.int64)
+            np.add.at(minute_runs, np.minimum((long_runs-1) // 60 - 1, 59), long_runs)
+            self.minute_runs = minute_runs.tolist()
+
+        partial = ~full
+        rtt = rtt[partial]
+        drop = drop[partial]
+        zero_drop = drop == 0.0
+        rtt_full = rtt[zero_drop]
+        buckets = _load_buckets((down + up)[partial][zero_drop])
+        for bucket in np.unique(buckets).tolist():
+            self.rtt_buckets[bucket].add_array(rtt_full[buckets == bucket])
+        self.latency_chunks.append((rtt, drop))
+
+    def _add_sketch(self) -> None:
+        if self.use_numpy:
+            rtt, drop = self.latency_chunks.pop()
+            self.digest_all.add_many(rtt.tolist(), (1.0 - drop).tolist())
+            rtt_full = rtt[drop == 0.0].tolist()
+        else:
+            self.digest_all.add_many([x[0] for x in self.rtt_all], [x[1] for x in self.rtt_all])
+            rtt_full = self.rtt_full
+            self.rtt_all = []
+            self.rtt_full = []
+        if not rtt_full:
+            return
+
+        self.digest_full.add_many(rtt_full)
+        # combine running variance with this chunk's (Chan et al.)
+        count = len(rtt_full)
+        mean = math.fsum(rtt_full) / count
+        m2 = math.fsum((x-mean)**2 for x in rtt_full)
+        total = self.full_count + count
+        delta = mean - self.full_mean
+        self.full_mean += delta * count / total
+        self.full_m2 += m2 + delta**2 * self.full_count * count / total
+        self.full_count = total
+
+    def _latency_sketch(self) -> PingLatencyDict:
+        return {
+            "mean_all_ping_latency": self.digest_all.mean(),
+            "deciles_all_ping_latency[]": self.digest_all.quantiles(10),
+            "mean_full_ping_latency": self.full_mean if self.full_count else None,
+            "deciles_full_ping_latency[]": self.digest_full.quantiles(10),
+            "stdev_full_ping_latency":
+                math.sqrt(self.full_m2 / self.full_count) if self.full_count else None,
+        }
+
+    def _latency_python(self) -> PingLatencyDict:
+        rtt_all = sorted(self.rtt_all, key=lambda x: x[0])
+        wmean_all, wdeciles_all = _weighted_mean_and_quantiles(rtt_all, 10)
+        rtt_full = sorted(self.rtt_full)
+        mean_full, deciles_full = _weighted_mean_and_quantiles(tuple((x, 1.0) for x in rtt_full), 10)
+
+        return {
+            "mean_all_ping_latency": wmean_all,
+            "deciles_all_ping_latency[]": wdeciles_all,
+            "mean_full_ping_latency": mean_full,
+            "deciles_full_ping_latency[]": deciles_full,
+            "stdev_full_ping_latency": statistics.pstdev(rtt_full) if rtt_full else None,
+        }
+
+    def _latency_numpy(self) -> PingLatencyDict:
+        if self.latency_chunks:
+            rtt, drop = (np.concatenate(x) for x in zip(*self.latency_chunks))
+        else:
+            rtt = drop = np.zeros(0)
+
+        order = np.argsort(rtt, kind="stable")
+        wmean_all, wdeciles_all = _np_weighted_mean_and_quantiles(rtt[order], (1.0 - drop)[order],
+                                                                  10)
+        rtt_full = np.sort(rtt[drop == 0.0])
+        mean_full, deciles_full = _np_weighted_mean_and_quantiles(rtt_full,
+                                                                  np.ones(len(rtt_full)), 10)
+
+        return {
+            "mean_all_ping_latency": wmean_all,
+            "deciles_all_ping_latency[]": wdeciles_all,
+            "mean_full_ping_latency": mean_full,
+            "deciles_full_ping_latency[]": deciles_full,
+            "stdev_full_ping_latency":
+                statistics.pstdev(rtt_full.tolist()) if len(rtt_full) else None,
+        }
+
+    def _loaded_latency(self) -> Tuple[LoadedLatencyDict, LoadedLatencyTailDict]:
+        return {
+            "load_bucket_samples[]": [bucket.count for bucket in self.rtt_buckets],
+            "load_bucket_min_latency[]": [bucket.percentile(0) for bucket in self.rtt_buckets],
+            "load_bucket_median_latency[]": [bucket.median() for bucket in self.rtt_buckets],
+            "load_bucket_max_latency[]": [bucket.percentile(100) for bucket in self.rtt_buckets],
+        }, {
+            "load_bucket_p90_latency[]": [bucket.percentile(90) for bucket in self.rtt_buckets],
+            "load_bucket_p99_latency[]": [bucket.percentile(99) for bucket in self.rtt_buckets],
+        }
+
+    def stats(
+        self,
+        loaded_tail: bool = False
+    ) -> Tuple[HistGeneralDict, PingDropDict, PingDropRlDict, PingLatencyDict, LoadedLatencyDict,
+               UsageDict]:
+        # With loaded_tail, a LoadedLatencyTailDict group is returned last
+        if self.init_run_length is None:
+            init_run_length = self.run_length
+            run_length = 0
+        else:
+            init_run_length = self.init_run_length
+            run_length = self.run_length
+
+        if self.sketch:
+            latency = self._latency_sketch()
+        elif self.use_numpy:
+            latency = self._latency_numpy()
+        else:
+            latency = self._latency_python()
+        loaded, loaded_tail_group = self._loaded_latency()
+
+        groups = ({
+            "samples": self.samples,
+            "end_counter": self.end_counter,
+        }, {
+            "total_ping_drop": self.total_ping_drop,
+            "count_full_ping_drop": self.count_full_ping_drop,
+            "count_obstructed": 0,
+            "total_obstructed_ping_drop": 0.0,
+            "count_full_obstructed_ping_drop": 0,
+            "count_unscheduled": 0,
+            "total_unscheduled_ping_drop": 0.0,
+            "count_full_unscheduled_ping_drop": 0,
+        }, {
+            "init_run_fragment": init_run_length,
+            "final_run_fragment": run_length,
+            "run_seconds[1,]": list(self.second_runs),
+            "run_minutes[1,]": list(self.minute_runs),
+        }, latency, loaded, {
+            "download_usage": int(round(self.usage_down / 8)),
+            "upload_usage": int(round(self.usage_up / 8)),
+        })
+        return groups + (loaded_tail_group,) if loaded_tail else groups
+
+
 def history_stats(
     parse_samples: int,
     start: Optional[int] = None,
     verbose: bool = False,
     context: Optional[ChannelContext] = None,
-    history=None
+    history=None,
+    use_numpy: bool = True,
+    sketch: bool = False,
+    loaded_tail: bool = False
 ) -> Tuple[HistGeneralDict, PingDropDict, PingDropRlDict, PingLatencyDict, LoadedLatencyDict,
            UsageDict]:
     if history is None:
         try:
-            history = get_history(context)
+            history = get_packed_history(context)
         except (AttributeError, ValueError, grpc.RpcError) as e:
             raise GrpcError(e) from e
 
-    sample_range, parsed_samples, current = _compute_sample_range(history,
-                                                                  parse_samples,
-                                                                  start=start,
-                                                                  verbose=verbose)
-
-    tot = 0.0
-    count_full_drop = 0
-    count_unsched = 0
-    total_unsched_drop = 0.0
-    count_full_unsched = 0
-    count_obstruct = 0
-    total_obstruct_drop = 0.0
-    count_full_obstruct = 0
-
-    second_runs = [0] * 60
-    minute_runs = [0] * 60
-    run_length = 0
-    init_run_length = None
-
-    usage_down = 0.0
-    usage_up = 0.0
-
-    rtt_full: List[float] = []
-    rtt_all: List[Tuple[float, float]] = []
-    rtt_buckets: List[List[float]] = [[] for _ in range(15)]
-
-    for i in sample_range:
-        d = history.pop_ping_drop_rate[i]
-        if d >= 1:
-            # just in case...
-            d = 1
-            count_full_drop += 1
-            run_length += 1
-        elif run_length > 0:
-            if init_run_length is None:
-                init_run_length = run_length
-            else:
-                if run_length <= 60:
-                    second_runs[run_length - 1] += run_length
-                else:
-                    minute_runs[min((run_length-1) // 60 - 1, 59)] += run_length
-            run_length = 0
-        elif init_run_length is None:
-            init_run_length = 0
-        tot += d
-
-        down = 0.0
-        try:
-            down = history.downlink_throughput_bps[i]
-        except (AttributeError, IndexError, TypeError):
-            pass
-        usage_down += down
-
-        up = 0.0
-        try:
-            up = history.uplink_throughput_bps[i]
-        except (AttributeError, IndexError, TypeError):
-            pass
-        usage_up += up
-
-        rtt = 0.0
-        try:
-            rtt = history.pop_ping_latency_ms[i]
-        except (AttributeError, IndexError, TypeError):
-            pass
-
-        if d == 0.0:
-            rtt_full.append(rtt)
-            if down + up > 500000:
-                rtt_buckets[min(14, int(math.log2((down+up) / 500000)))].append(rtt)
-            else:
-                rtt_buckets[0].append(rtt)
-        if d < 1.0:
-            rtt_all.append((rtt, 1.0 - d))
-
-    if init_run_length is None:
-        init_run_length = run_length
-        run_length = 0
-
-    def weighted_mean_and_quantiles(data, n):
-        if not data:
-            return None, [None] * (n+1)
-        total_weight = sum(x[1] for x in data)
-        result = []
-        items = iter(data)
-        value, accum_weight = next(items)
-        accum_value = value * accum_weight
-        for boundary in (total_weight * x / n for x in range(n)):
-            while accum_weight < boundary:
-                try:
-                    value, weight = next(items)
-                    accum_value += value * weight
-                    accum_weight += weight
-                except StopIteration:
-                    break
-            result.append(value)
-        result.append(data[-1][0])
-        accum_value += sum(x[0] for x in items)
-        return accum_value / total_weight, result
-
-    bucket_samples: List[int] = []
-    bucket_min: List[Optional[float]] = []
-    bucket_median: List[Optional[float]] = []
-    bucket_max: List[Optional[float]] = []
-    for bucket in rtt_buckets:
-        if bucket:
-            bucket_samples.append(len(bucket))
-            bucket_min.append(min(bucket))
-            bucket_median.append(statistics.median(bucket))
-            bucket_max.append(max(bucket))
-        else:
-            bucket_samples.append(0)
-            bucket_min.append(None)
-            bucket_median.append(None)
-            bucket_max.append(None)
-
-    rtt_all.sort(key=lambda x: x[0])
-    wmean_all, wdeciles_all = weighted_mean_and_quantiles(rtt_all, 10)
-    rtt_full.sort()
-    mean_full, deciles_full = weighted_mean_and_quantiles(tuple((x, 1.0) for x in rtt_full), 10)
-
-    return {
-        "samples": parsed_samples,
-        "end_counter": current,
-    }, {
-        "total_ping_drop": tot,
-        "count_full_ping_drop": count_full_drop,
-        "count_obstructed": count_obstruct,
-        "total_obstructed_ping_drop": total_obstruct_drop,
-        "count_full_obstructed_ping_drop": count_full_obstruct,
-        "count_unscheduled": count_unsched,
-        "total_unscheduled_ping_drop": total_unsched_drop,
-        "count_full_unscheduled_ping_drop": count_full_unsched,
-    }, {
-        "init_run_fragment": init_run_length,
-        "final_run_fragment": run_length,
-        "run_seconds[1,]": second_runs,
-        "run_minutes[1,]": minute_runs,
-    }, {
-        "mean_all_ping_latency": wmean_all,
-        "deciles_all_ping_latency[]": wdeciles_all,
-        "mean_full_ping_latency": mean_full,
-        "deciles_full_ping_latency[]": deciles_full,
-        "stdev_full_ping_latency": statistics.pstdev(rtt_full) if rtt_full else None,
-    }, {
-        "load_bucket_samples[]": bucket_samples,
-        "load_bucket_min_latency[]": bucket_min,
-        "load_bucket_median_latency[]": bucket_median,
-        "load_bucket_max_latency[]": bucket_max,
-    }, {
-        "download_usage": int(round(usage_down / 8)),
-        "upload_usage": int(round(usage_up / 8)),
-    }
+    accum = HistoryStatsAccumulator(use_numpy=use_numpy, sketch=sketch)
+    accum.add_history(history, parse_samples, start=start, verbose=verbose)
+    return accum.stats(loaded_tail=loaded_tail)
 
 
 def get_obstruction_map(context: Optional[ChannelContext] = None):
@@ -762,26 +1431,53 @@ def get_obstruction_map(context: Optional[ChannelContext] = None):
             resolve_imports(channel)
         stub = device_pb2_grpc.DeviceStub(channel)
         response = stub.Handle(device_pb2.Request(dish_get_obstruction_map={}),
-                               timeout=REQUEST_TIMEOUT)
+                               timeout=_request_timeout(context))
         return response.dish_get_obstruction_map
 
     return call_with_channel(grpc_call, context=context)
 
 
-def obstruction_map(context: Optional[ChannelContext] = None):
+def obstruction_map(context: Optional[ChannelContext] = None,
+                    map_data=None,
+                    as_array: bool = False):
+    if as_array and np is None:
+        raise ImportError("NumPy is required for obstruction map arrays")
 
-    try:
-        map_data = get_obstruction_map(context)
-    except (AttributeError, ValueError, grpc.RpcError) as e:
-        raise GrpcError(e) from e
+    if map_data is None:
+        try:
+            map_data = get_obstruction_map(context)
+        except (AttributeError, ValueError, grpc.RpcError) as e:
+            raise GrpcError(e) from e
 
     try:
         cols = map_data.num_cols
+        if as_array:
+            return _float_field_array(map_data, "snr").reshape(map_data.num_rows, cols)
         return tuple((map_data.snr[i:i + cols]) for i in range(0, cols * map_data.num_rows, cols))
-    except (AttributeError, IndexError, TypeError) as e:
+    except (AttributeError, IndexError, TypeError, ValueError) as e:
         raise GrpcError(e) from e
 
 
+def _float_field_array(message, field: str):
+    values = getattr(message, field)
+    if hasattr(values, "__array__"):
+        # recent protobuf versions copy the values out in one go
+        return np.array(values, dtype=np.float32)
+    # Older repeated containers only convert one element at a time, so
+    # decode the packed field from the serialized message instead, as
+    # unpack_history does
+    number = message.DESCRIPTOR.fields_by_name[field].number
+    data = memoryview(message.SerializeToString())
+    column = _float_column([
+        data[start:end]
+        for field_number, wire_type, start, end in _wire_fields(data, 0, len(data))
+        if field_number == number and wire_type == 2
+    ])
+    if len(column) != len(values):
+        return np.array(values, dtype=np.float32)
+    return np.frombuffer(column, dtype=np.float32).copy()
+
+
 def reboot(context: Optional[ChannelContext] = None) -> None:
 
     def grpc_call(channel: grpc.Channel) -> None:
@@ -795,6 +1491,9 @@ def reboot(context: Optional[ChannelContext] = None) -> None:
         call_with_channel(grpc_call, context=context)
     except (AttributeError, ValueError, grpc.RpcError) as e:
         raise GrpcError(e) from e
+    finally:
+        if context is not None:
+            context.invalidate_status()
 
 
 def set_stow_state(unstow: bool = False, context: Optional[ChannelContext] = None) -> None:
@@ -809,6 +1508,9 @@ def set_stow_state(unstow: bool = False, context: Optional[ChannelContext] = Non
         call_with_channel(grpc_call, context=context)
     except (AttributeError, ValueError, grpc.RpcError) as e:
         raise GrpcError(e) from e
+    finally:
+        if context is not None:
+            context.invalidate_status()
 
 
 def set_sleep_config(start: int,
@@ -837,3 +1539,6 @@ def set_sleep_config(start: int,
         call_with_channel(grpc_call, context=context)
     except (AttributeError, ValueError, grpc.RpcError) as e:
         raise GrpcError(e) from e
+    finally:
+        if context is not None:
+            context.invalidate_status()
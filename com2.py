@@ -1,21 +1,32 @@
 
 import argparse
+import atexit
 from datetime import datetime
 from datetime import timezone
 import logging
+import os
 import re
 import time
 from typing import List
 
-import grpc
-
 import com1
+import com_profile
 
 BRACKETS_RE = re.compile(r"([^[]*)(\[((\d+),|)(\d*)\]|)$")
 LOOP_TIME_DEFAULT = 0
+MAX_PARALLEL_DEFAULT = 16
+STATUS_TTL_DEFAULT = 0.5
+TICK_BUDGET_FRACTION = 0.9
+# adaptive history polling fetches history by the time this much of the
+# dish's ring buffer holds samples not yet fetched
+HISTORY_FILL_FRACTION = 0.5
+# requests of one kind in a row cut short by the tick budget before one is
+# let through without it
+BUDGET_MISSES_MAX = 2
 STATUS_MODES: List[str] = ["status", "obstruction_detail", "alert_detail", "location"]
 HISTORY_STATS_MODES: List[str] = [
-    "ping_drop", "ping_run_length", "ping_latency", "ping_loaded_latency", "usage"
+    "ping_drop", "ping_run_length", "ping_latency", "ping_loaded_latency",
+    "ping_loaded_latency_tail", "usage"
 ]
 UNGROUPED_MODES: List[str] = []
 
@@ -36,6 +47,35 @@ def create_arg_parser(output_description, bulk_history=True):
                        "--target",
                        help="host:port of dish to query, default is the standard IP address "
                        "and port (192.168.100.1:9200)")
+    group.add_argument("--targets",
+                       help="Comma separated list of host:port of dishes to query concurrently; "
+                       "output then includes a target column")
+    group.add_argument("--targets-file",
+                       help="File containing host:port of dishes to query concurrently, one per "
+                       "line; may be combined with --targets")
+    group.add_argument("--max-parallel",
+                       type=int,
+                       default=MAX_PARALLEL_DEFAULT,
+                       help="Maximum number of dishes to query at the same time when querying "
+                       "multiple targets, default: " + str(MAX_PARALLEL_DEFAULT))
+    group.add_argument("--status-ttl",
+                       type=float,
+                       default=STATUS_TTL_DEFAULT,
+                       help="Reuse a dish status response for this many seconds instead of "
+                       "requesting it again, or 0 to always request it; limited to half the loop "
+                       "interval, default: " + str(STATUS_TTL_DEFAULT))
+    group.add_argument("--descriptor-cache",
+                       help="File in which to cache the dish protocol descriptors between runs, "
+                       "default: starlink-grpc/descriptors.json in the user cache directory",
+                       metavar="FILE")
+    group.add_argument("--no-descriptor-cache",
+                       action="store_true",
+                       help="Always query the dish for its protocol descriptors instead of using "
+                       "the descriptor cache file")
+    group.add_argument("--profile",
+                       action="store_true",
+                       help="Time dish requests and each stage of polling, and print a summary "
+                       "of the timings to stderr on exit")
     group.add_argument("-h", "--help", action="help", help="Be helpful")
     group.add_argument("-N",
                        "--numeric",
@@ -47,6 +87,13 @@ def create_arg_parser(output_description, bulk_history=True):
                        default=float(LOOP_TIME_DEFAULT),
                        help="Loop interval in seconds or 0 for no loop, default: " +
                        str(LOOP_TIME_DEFAULT))
+    group.add_argument("--tick-budget",
+                       type=float,
+                       help="Seconds that dish requests of each loop iteration must finish within, "
+                       "or 0 for no limit; once location is known, it is reused instead of "
+                       "requested when the time left after getting status would not fit both it "
+                       "and the history request, default: {0:.0f}%% of the loop interval".format(
+                           TICK_BUDGET_FRACTION * 100))
     group.add_argument("-v", "--verbose", action="store_true", help="Be verbose")
 
     group = parser.add_argument_group(title="History mode options")
@@ -76,7 +123,33 @@ def create_arg_parser(output_description, bulk_history=True):
         no_counter_help = ("Don't track sample counter across loop iterations; keep using "
                            "samples option value instead")
     group.add_argument("-s", "--samples", type=int, help=sample_help)
+    if bulk_history:
+        group.add_argument("--store-dir",
+                           help="Also keep bulk history samples in a memory-mapped sample store "
+                           "in this directory, one subdirectory per target when querying multiple "
+                           "targets",
+                           metavar="DIR")
+        group.add_argument("--rollup-file",
+                           help="Also keep per-minute, per-hour and per-day rollups of bulk "
+                           "history statistics in this file, with the target appended to the "
+                           "file name when querying multiple targets",
+                           metavar="FILE")
     group.add_argument("-j", "--no-counter", action="store_true", help=no_counter_help)
+    group.add_argument("--adaptive-history",
+                       action="store_true",
+                       help="Request history only as often as needed to not miss samples, "
+                       "going by the dish's history buffer size and sample rate, instead of "
+                       "every loop iteration; samples not yet collected are lost if the dish "
+                       "reboots")
+    group.add_argument("--max-history-interval",
+                       type=float,
+                       default=0.0,
+                       help="With --adaptive-history, request history at least this often, in "
+                       "seconds, or 0 for no limit, default: 0")
+    group.add_argument("--latency-sketch",
+                       action="store_true",
+                       help="Compute ping latency deciles with a mergeable t-digest sketch "
+                       "instead of sorting every sample; deciles are then approximate")
 
     return parser
 
@@ -89,7 +162,10 @@ def run_arg_parser(parser, need_id=False, no_stdout_errors=False, modes=None):
     parser.add_argument("mode",
                         nargs="+",
                         choices=modes,
-                        help="The data group to record, one or more of: " + ", ".join(modes),
+                        help="The data group to record, one or more of: " + ", ".join(modes) +
+                        "; the ping_loaded_latency and ping_loaded_latency_tail medians and "
+                        "percentiles come from histograms, so are within 0.1%% of the exact "
+                        "sample values",
                         metavar="mode")
 
     opts = parser.parse_args()
@@ -105,6 +181,35 @@ def run_arg_parser(parser, need_id=False, no_stdout_errors=False, modes=None):
     opts.pure_status_mode = bool(status_set.intersection(opts.mode))
     opts.history_stats_mode = bool(set(HISTORY_STATS_MODES).intersection(opts.mode))
     opts.bulk_mode = "bulk_history" in opts.mode
+    if not parser.bulk_history:
+        opts.store_dir = None
+        opts.rollup_file = None
+    elif opts.store_dir and not opts.bulk_mode:
+        parser.error("--store-dir requires bulk_history mode")
+    elif opts.rollup_file and not opts.bulk_mode:
+        parser.error("--rollup-file requires bulk_history mode")
+
+    if opts.adaptive_history:
+        if not (opts.history_stats_mode or opts.bulk_mode):
+            parser.error("--adaptive-history requires a history mode")
+        if opts.loop_interval <= 0.0:
+            parser.error("--adaptive-history requires a loop interval")
+        if opts.poll_loops > 1:
+            parser.error("--adaptive-history and --poll-loops cannot be used together")
+        if opts.no_counter:
+            parser.error("--adaptive-history requires the sample counter")
+    if opts.max_history_interval < 0.0:
+        parser.error("Max history interval must be 0 or greater")
+
+    if opts.tick_budget is None:
+        opts.tick_budget = max(opts.loop_interval, 0.0) * TICK_BUDGET_FRACTION
+    elif opts.tick_budget < 0.0:
+        parser.error("Tick budget must be 0 or greater")
+
+    if opts.status_ttl < 0.0:
+        parser.error("Status TTL must be 0 or greater")
+    if opts.loop_interval > 0.0:
+        opts.status_ttl = min(opts.status_ttl, opts.loop_interval / 2)
 
     if opts.samples is None:
         opts.samples = int(opts.loop_interval) if opts.loop_interval >= 1.0 else -1
@@ -113,13 +218,49 @@ def run_arg_parser(parser, need_id=False, no_stdout_errors=False, modes=None):
         opts.skip_query = True
         opts.bulk_samples = opts.samples
 
+    targets = []
+    if opts.targets:
+        targets.extend(x.strip() for x in opts.targets.split(",") if x.strip())
+    if opts.targets_file:
+        try:
+            with open(opts.targets_file, "r") as targets_file:
+                for line in targets_file:
+                    line = line.split("#", 1)[0].strip()
+                    if line:
+                        targets.append(line)
+        except OSError as e:
+            parser.error("Failed reading targets file: " + str(e))
+    opts.multi_target = bool(opts.targets or opts.targets_file)
+    if opts.multi_target:
+        if opts.target is not None:
+            targets.insert(0, opts.target)
+        if not targets:
+            parser.error("No targets specified")
+        if len(set(targets)) != len(targets):
+            parser.error("Duplicate target specified")
+        if opts.max_parallel < 1:
+            parser.error("Max parallel must be 1 or greater")
+        opts.targets = targets
+    else:
+        opts.targets = [opts.target]
+
+    if not opts.no_descriptor_cache:
+        com1.use_descriptor_cache(opts.descriptor_cache)
+
+    if opts.profile:
+        com_profile.enable()
+        atexit.register(com_profile.print_summary)
+
     opts.no_stdout_errors = no_stdout_errors
     opts.need_id = need_id
 
     return opts
 
 
-def conn_error(opts, msg, *args):
+def conn_error(opts, msg, *args, gstate=None):
+    if gstate is not None and opts.multi_target:
+        msg = "%s: " + msg
+        args = (gstate.target,) + args
     if opts.loop_interval > 0.0 and not opts.no_stdout_errors:
         print(msg % args)
     else:
@@ -127,24 +268,118 @@ def conn_error(opts, msg, *args):
 
 
 class GlobalState:
-    def __init__(self, target=None):
+    def __init__(self, target=None, status_ttl=0.0):
         self.counter = None
         self.timestamp = None
         self.counter_stats = None
         self.timestamp_stats = None
         self.dish_id = None
-        self.context = com1.ChannelContext(target=target)
+        self.target = target
+        self.context = com1.ChannelContext(target=target, status_ttl=status_ttl)
         self.poll_count = 0
-        self.accum_history = None
+        self.accum_stats = None
         self.first_poll = True
         self.warn_once_location = True
+        self.store = None
+        self.rollups = None
+        self.location = None
+        self.deferred_locations = 0
+        # how long the last request of each kind took, and how many in a row
+        # ran out of tick budget
+        self.request_seconds = {"status": 0.0, "location": 0.0, "history": 0.0}
+        self.budget_misses = {"status": 0, "location": 0, "history": 0}
+        # adaptive history polling state: time and counter of the last
+        # history fetch, estimated samples per second, and when to fetch next
+        self.history_fetch = None
+        self.history_rate = None
+        self.next_history = 0.0
+        # history fetched this tick, shared by the stats and bulk modes
+        self.tick_history = None
 
     def shutdown(self):
         self.context.close()
+        if self.store is not None:
+            self.store.close()
+            self.store = None
+        if self.rollups is not None:
+            try:
+                self.rollups.save()
+            except OSError as e:
+                logging.error("Failed writing rollup file: %s", str(e))
+            self.rollups = None
+
+
+def create_states(opts):
+    return [GlobalState(target=target, status_ttl=opts.status_ttl) for target in opts.targets]
+
+
+def create_executor(opts):
+    if len(opts.targets) < 2:
+        return None
+    from concurrent.futures import ThreadPoolExecutor
+    return ThreadPoolExecutor(max_workers=min(opts.max_parallel, len(opts.targets)),
+                              thread_name_prefix="poll")
+
+
+def map_states(function, gstates, executor=None):
+    if executor is None:
+        return [function(gstate) for gstate in gstates]
+    return list(executor.map(function, gstates))
+
+
+class TickScheduler:
+    # Runs loop iterations (ticks) on a fixed grid of loop interval slots.
+    # Dish requests of a tick are cut short by the tick budget, so a slow dish
+    # can't hold up the next tick. A tick that still ends after its slot makes
+    # the next one late, and slots it ran more than halfway into are skipped,
+    # rather than run back to back to catch up.
+    def __init__(self, opts, gstates) -> None:
+        self.interval = opts.loop_interval
+        self.budget = opts.tick_budget
+        self.gstates = gstates
+        self.next_tick = time.monotonic()
+        self.ticks = 0
+        self.late_ticks = 0
+        self.missed_ticks = 0
+
+    def start_tick(self) -> None:
+        deadline = time.monotonic() + self.budget if self.budget > 0.0 else None
+        for gstate in self.gstates:
+            gstate.context.deadline = deadline
+
+    def end_tick(self) -> None:
+        for gstate in self.gstates:
+            gstate.context.deadline = None
+        self.ticks += 1
+        if self.interval <= 0.0:
+            return
+        self.next_tick += self.interval
+        lateness = time.monotonic() - self.next_tick
+        if lateness > 0.0:
+            self.late_ticks += 1
+            com_profile.count("late_ticks")
+            missed = int(lateness / self.interval + 0.5)
+            if missed:
+                self.missed_ticks += missed
+                com_profile.count("missed_ticks", missed)
+                self.next_tick += missed * self.interval
+
+    def report(self) -> str:
+        return "Loop iterations: {0}, late: {1}, intervals skipped: {2}".format(
+            self.ticks, self.late_ticks, self.missed_ticks)
+
+    def wait(self) -> None:
+        time.sleep(max(self.next_tick - time.monotonic(), 0.0))
+
+    def sleep(self) -> None:
+        self.end_tick()
+        self.wait()
 
 
 def get_data(opts, gstate, add_item, add_sequence, add_bulk=None, flush_history=False):
-    if flush_history and opts.poll_loops < 2:
+    # In adaptive history mode, flushing fetches the samples not yet collected
+    final_fetch = flush_history and opts.adaptive_history
+    if flush_history and opts.poll_loops < 2 and not final_fetch:
         return 0, None, None
 
     rc = 0
@@ -152,19 +387,102 @@ def get_data(opts, gstate, add_item, add_sequence, add_bulk=None, flush_history=
     hist_ts = None
 
     if not flush_history:
-        rc, status_ts = get_status_data(opts, gstate, add_item, add_sequence)
+        rc, status_ts = com_profile.timed("stage.status", get_status_data, opts, gstate, add_item,
+                                          add_sequence)
 
-    if opts.history_stats_mode and (not rc or opts.poll_loops > 1):
-        hist_rc, hist_ts = get_history_stats(opts, gstate, add_item, add_sequence, flush_history)
-        if not rc:
-            rc = hist_rc
+    fetch_history = final_fetch or history_due(opts, gstate)
+    if not fetch_history and not flush_history:
+        com_profile.count("history_polls_skipped")
 
-    if not flush_history and opts.bulk_mode and add_bulk and not rc:
-        rc = get_bulk_data(opts, gstate, add_bulk)
+    try:
+        if opts.history_stats_mode and (not rc or opts.poll_loops > 1) and fetch_history:
+            hist_rc, hist_ts = com_profile.timed("stage.history_stats", get_history_stats, opts,
+                                                 gstate, add_item, add_sequence, flush_history and
+                                                 not final_fetch)
+            if not rc:
+                rc = hist_rc
+
+        bulk_fetch = fetch_history and (final_fetch or not flush_history)
+        if opts.bulk_mode and add_bulk and not rc and bulk_fetch:
+            rc = com_profile.timed("stage.bulk_history", get_bulk_data, opts, gstate, add_bulk)
+    finally:
+        gstate.tick_history = None
 
     return rc, status_ts, hist_ts
 
 
+def budget_call(gstate, kind, function):
+    # Calls function with the dish context, timing it for location deferral.
+    # If requests of this kind keep running out of tick budget, as when the
+    # dish is too slow for it, they are let through late instead of never
+    # getting the data, until one fits in the budget again.
+    context = gstate.context
+    deadline = context.deadline
+    if deadline is not None and gstate.budget_misses[kind] >= BUDGET_MISSES_MAX:
+        context.deadline = None
+    start = time.monotonic()
+    try:
+        result = function(context=context)
+    except (com1.GrpcError, com1.grpc.RpcError) as e:
+        error = e.__cause__ if isinstance(e, com1.GrpcError) else e
+        if (context.deadline is not None and isinstance(error, com1.grpc.Call) and
+                error.code() == com1.grpc.StatusCode.DEADLINE_EXCEEDED):
+            gstate.budget_misses[kind] += 1
+        raise
+    finally:
+        context.deadline = deadline
+    end = time.monotonic()
+    gstate.request_seconds[kind] = end - start
+    if deadline is None or end <= deadline:
+        gstate.budget_misses[kind] = 0
+    return result
+
+
+def get_history(opts, gstate):
+    # Fetches the history at most once per tick, so stats and bulk modes
+    # together learn the sample rate from fetches a whole tick apart
+    if gstate.tick_history is None:
+        fetch_time = time.monotonic()
+        try:
+            history = budget_call(gstate, "history", com1.get_packed_history)
+        except (AttributeError, ValueError, com1.grpc.RpcError) as e:
+            raise com1.GrpcError(e) from e
+        learn_history(opts, gstate, history, fetch_time)
+        gstate.tick_history = history
+    return gstate.tick_history
+
+
+def history_due(opts, gstate):
+    return not opts.adaptive_history or time.monotonic() >= gstate.next_history
+
+
+def learn_history(opts, gstate, history, fetch_time):
+    # Schedules the next history fetch, from the ring buffer size and the
+    # sample rate seen between fetches
+    if not opts.adaptive_history:
+        return
+    try:
+        current = int(history.current)
+        ring_size = len(history.pop_ping_drop_rate)
+    except (AttributeError, TypeError):
+        return
+    last = gstate.history_fetch
+    gstate.history_fetch = (fetch_time, current)
+    if last is not None and current > last[1] and fetch_time > last[0]:
+        # counting one sample more than seen errs toward fetching too early
+        gstate.history_rate = (current - last[1] + 1) / (fetch_time - last[0])
+    if gstate.history_rate is None or not ring_size:
+        # fetch again next time, to learn the rate
+        gstate.next_history = fetch_time
+        return
+    interval = ring_size * HISTORY_FILL_FRACTION / gstate.history_rate
+    if opts.max_history_interval > 0.0:
+        interval = min(interval, opts.max_history_interval)
+    gstate.next_history = fetch_time + interval
+    if opts.verbose:
+        print("Next history request in {0:.0f} seconds".format(interval))
+
+
 def add_data_normal(data, category, add_item, add_sequence):
     for key, val in data.items():
         name, start, seq = BRACKETS_RE.match(key).group(1, 4, 5)
@@ -192,18 +510,20 @@ def get_status_data(opts, gstate, add_item, add_sequence):
         add_data = add_data_numeric if opts.numeric else add_data_normal
         if opts.pure_status_mode or opts.need_id and gstate.dish_id is None:
             try:
-                groups = com1.status_data(context=gstate.context)
+                groups = budget_call(gstate, "status", com1.status_data)
                 status_data, obstruct_detail, alert_detail = groups[0:3]
             except com1.GrpcError as e:
                 if "status" in opts.mode:
                     if opts.need_id and gstate.dish_id is None:
-                        conn_error(opts, "Dish unreachable and ID unknown, so not recording state")
+                        conn_error(opts,
+                                   "Dish unreachable and ID unknown, so not recording state",
+                                   gstate=gstate)
                         return 1, None
                     if opts.verbose:
                         print("Dish unreachable")
                     add_item("state", "DISH_UNREACHABLE", "status")
                     return 0, timestamp
-                conn_error(opts, "Failure getting status: %s", str(e))
+                conn_error(opts, "Failure getting status: %s", str(e), gstate=gstate)
                 return 1, None
             if opts.need_id:
                 gstate.dish_id = status_data["id"]
@@ -215,21 +535,34 @@ def get_status_data(opts, gstate, add_item, add_sequence):
             if "alert_detail" in opts.mode:
                 add_data(alert_detail, "status", add_item, add_sequence)
         if "location" in opts.mode:
-            try:
-                location = com1.location_data(context=gstate.context)
-            except com1.GrpcError as e:
-                conn_error(opts, "Failure getting location: %s", str(e))
-                return 1, None
-            if location["latitude"] is None and gstate.warn_once_location:
-                logging.warning("Location data not enabled. See README for more details.")
-                gstate.warn_once_location = False
+            time_left = gstate.context.time_left()
+            history_next = (opts.history_stats_mode or opts.bulk_mode) and history_due(opts, gstate)
+            if (gstate.location is not None and time_left is not None and history_next and
+                (time_left < gstate.request_seconds["location"] + gstate.request_seconds["history"]
+                 or gstate.budget_misses["history"])):
+                # leave the time for history, if both won't fit or history ran
+                # out of time last tick; the dish rarely moves, so the last
+                # location stands in
+                gstate.deferred_locations += 1
+                com_profile.count("deferred_locations")
+                location = gstate.location
+            else:
+                try:
+                    location = budget_call(gstate, "location", com1.location_data)
+                except com1.GrpcError as e:
+                    conn_error(opts, "Failure getting location: %s", str(e), gstate=gstate)
+                    return 1, None
+                gstate.location = location
+                if location["latitude"] is None and gstate.warn_once_location:
+                    logging.warning("Location data not enabled. See README for more details.")
+                    gstate.warn_once_location = False
             add_data(location, "status", add_item, add_sequence)
         return 0, timestamp
     elif opts.need_id and gstate.dish_id is None:
         try:
             gstate.dish_id = com1.get_id(context=gstate.context)
         except com1.GrpcError as e:
-            conn_error(opts, "Failure getting dish ID: %s", str(e))
+            conn_error(opts, "Failure getting dish ID: %s", str(e), gstate=gstate)
             return 1, None
         if opts.verbose:
             print("Using dish ID: " + gstate.dish_id)
@@ -243,36 +576,37 @@ def get_history_stats(opts, gstate, add_item, add_sequence, flush_history):
     else:
         try:
             timestamp = int(time.time())
-            history = com1.get_history(context=gstate.context)
+            history = get_history(opts, gstate)
             gstate.timestamp_stats = timestamp
-        except (AttributeError, ValueError, grpc.RpcError) as e:
-            conn_error(opts, "Failure getting history: %s", str(com1.GrpcError(e)))
+        except com1.GrpcError as e:
+            conn_error(opts, "Failure getting history: %s", str(e), gstate=gstate)
             history = None
 
-    parse_samples = opts.samples if gstate.counter_stats is None else -1
-    start = gstate.counter_stats if gstate.counter_stats else None
-
-    if gstate.accum_history:
-        if history is not None:
-            gstate.accum_history = com1.concatenate_history(gstate.accum_history,
-                                                                     history,
-                                                                     samples1=parse_samples,
-                                                                     start1=start,
-                                                                     verbose=opts.verbose)
-            if not opts.no_counter:
-                gstate.counter_stats = 0
-    else:
-        gstate.accum_history = history
-
-    if gstate.first_poll and gstate.accum_history:
-        if opts.poll_loops > 1 and gstate.counter_stats:
-            new_samples = gstate.accum_history.current - gstate.counter_stats
-            if new_samples < 0:
-                new_samples = gstate.accum_history.current
-            if new_samples > len(gstate.accum_history.pop_ping_drop_rate):
-                new_samples = len(gstate.accum_history.pop_ping_drop_rate)
-            gstate.poll_count = max(gstate.poll_count, int((new_samples-1) / opts.loop_interval))
-        gstate.first_poll = False
+    if history is not None:
+        if gstate.first_poll:
+            if opts.poll_loops > 1 and gstate.counter_stats:
+                new_samples = history.current - gstate.counter_stats
+                if new_samples < 0:
+                    new_samples = history.current
+                if new_samples > len(history.pop_ping_drop_rate):
+                    new_samples = len(history.pop_ping_drop_rate)
+                gstate.poll_count = max(gstate.poll_count, int((new_samples-1) / opts.loop_interval))
+            gstate.first_poll = False
+
+        if gstate.accum_stats is None or opts.no_counter:
+            gstate.accum_stats = com1.HistoryStatsAccumulator(sketch=opts.latency_sketch)
+        parse_samples = opts.samples if gstate.counter_stats is None else -1
+        start = gstate.counter_stats if gstate.counter_stats else None
+        samples = gstate.accum_stats.samples
+        com_profile.timed("stage.history_parse",
+                          gstate.accum_stats.add_history,
+                          history,
+                          parse_samples,
+                          start=start,
+                          verbose=opts.verbose)
+        com_profile.observe("history_samples", gstate.accum_stats.samples - samples)
+        if not opts.no_counter:
+            gstate.counter_stats = gstate.accum_stats.end_counter
 
     if gstate.poll_count < opts.poll_loops - 1 and not flush_history:
         gstate.poll_count += 1
@@ -280,14 +614,13 @@ def get_history_stats(opts, gstate, add_item, add_sequence, flush_history):
 
     gstate.poll_count = 0
 
-    if gstate.accum_history is None:
+    if gstate.accum_stats is None:
         return (0, None) if flush_history else (1, None)
 
-    groups = com1.history_stats(parse_samples,
-                                         start=start,
-                                         verbose=opts.verbose,
-                                         history=gstate.accum_history)
-    general, ping, runlen, latency, loaded, usage = groups[0:6]
+    groups = com_profile.timed("stage.history_compute",
+                               gstate.accum_stats.stats,
+                               loaded_tail=True)
+    general, ping, runlen, latency, loaded, usage, loaded_tail = groups[0:7]
     add_data = add_data_numeric if opts.numeric else add_data_normal
     add_data(general, "ping_stats", add_item, add_sequence)
     if "ping_drop" in opts.mode:
@@ -298,14 +631,14 @@ def get_history_stats(opts, gstate, add_item, add_sequence, flush_history):
         add_data(latency, "ping_stats", add_item, add_sequence)
     if "ping_loaded_latency" in opts.mode:
         add_data(loaded, "ping_stats", add_item, add_sequence)
+    if "ping_loaded_latency_tail" in opts.mode:
+        add_data(loaded_tail, "ping_stats", add_item, add_sequence)
     if "usage" in opts.mode:
         add_data(usage, "usage", add_item, add_sequence)
-    if not opts.no_counter:
-        gstate.counter_stats = general["end_counter"]
 
     timestamp = gstate.timestamp_stats
     gstate.timestamp_stats = None
-    gstate.accum_history = None
+    gstate.accum_stats = None
 
     return 0, timestamp
 
@@ -316,16 +649,18 @@ def get_bulk_data(opts, gstate, add_bulk):
     start = gstate.counter
     parse_samples = opts.bulk_samples if start is None else -1
     try:
+        history = get_history(opts, gstate)
         general, bulk = com1.history_bulk_data(parse_samples,
                                                         start=start,
                                                         verbose=opts.verbose,
-                                                        context=gstate.context)
+                                                        history=history)
     except com1.GrpcError as e:
-        conn_error(opts, "Failure getting history: %s", str(e))
+        conn_error(opts, "Failure getting history: %s", str(e), gstate=gstate)
         return 1
 
     after = time.time()
     parsed_samples = general["samples"]
+    com_profile.observe("bulk_samples", parsed_samples)
     new_counter = general["end_counter"]
     timestamp = gstate.timestamp
     if gstate.counter is not None and new_counter != gstate.counter + parsed_samples:
@@ -342,6 +677,11 @@ def get_bulk_data(opts, gstate, add_bulk):
                 new_counter, datetime.fromtimestamp(timestamp, tz=timezone.utc)))
         timestamp -= parsed_samples
 
+    if opts.store_dir:
+        store_samples(opts, gstate, bulk, parsed_samples, timestamp, new_counter - parsed_samples)
+    if opts.rollup_file:
+        rollup_samples(opts, gstate, bulk, parsed_samples, timestamp, new_counter - parsed_samples)
+
     if opts.numeric:
         add_bulk(
             {
@@ -354,3 +694,30 @@ def get_bulk_data(opts, gstate, add_bulk):
     gstate.counter = new_counter
     gstate.timestamp = timestamp + parsed_samples
     return 0
+
+
+def store_samples(opts, gstate, bulk, count, timestamp, counter):
+    try:
+        if gstate.store is None:
+            import com_store
+            path = opts.store_dir
+            if opts.multi_target:
+                path = os.path.join(path, re.sub(r"[^\w.-]", "_", gstate.target))
+            gstate.store = com_store.SampleStore(path)
+        gstate.store.append(bulk, count, timestamp, counter)
+    except (OSError, ValueError) as e:
+        logging.error("Failed writing sample store: %s", str(e))
+
+
+def rollup_samples(opts, gstate, bulk, count, timestamp, counter):
+    try:
+        if gstate.rollups is None:
+            import com_rollup
+            path = opts.rollup_file
+            if opts.multi_target:
+                root, ext = os.path.splitext(path)
+                path = "{0}.{1}{2}".format(root, re.sub(r"[^\w.-]", "_", gstate.target), ext)
+            gstate.rollups = com_rollup.RollupStore(path)
+        gstate.rollups.add_bulk(bulk, count, timestamp, counter)
+    except (OSError, ValueError, KeyError) as e:
+        logging.error("Failed updating rollup file: %s", str(e))
@@ -0,0 +1,223 @@
+
+import asyncio
+from typing import Optional, Tuple
+
+import grpc
+from grpc import aio
+
+import com1
+
+
+class AsyncChannelContext:
+    def __init__(self, target: Optional[str] = None) -> None:
+        self.channel = None
+        self.target = "192.168.100.1:9200" if target is None else target
+        self._imports_lock = None
+
+    def get_channel(self) -> Tuple[aio.Channel, bool]:
+        reused = True
+        if self.channel is None:
+            self.channel = aio.insecure_channel(self.target)
+            reused = False
+        return self.channel, reused
+
+    async def resolve_imports(self) -> None:
+        # The lazy importer only has a blocking implementation, so run it once
+        # in an executor thread against a short-lived synchronous channel.
+        if self._imports_lock is None:
+            self._imports_lock = asyncio.Lock()
+        async with self._imports_lock:
+            if not com1.imports_pending:
+                return
+            context = com1.ChannelContext(self.target)
+            try:
+                await asyncio.get_running_loop().run_in_executor(
+                    None, lambda: com1.call_with_channel(com1.resolve_imports, context=context))
+            finally:
+                context.close()
+
+    async def close(self) -> None:
+        channel = self.channel
+        self.channel = None
+        if channel is not None:
+            await channel.close()
+
+    async def __aenter__(self) -> "AsyncChannelContext":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+
+async def call_with_channel(function,
+                            *args,
+                            context: Optional[AsyncChannelContext] = None,
+                            **kwargs):
+    if context is None:
+        async with AsyncChannelContext() as context:
+            return await call_with_channel(function, *args, context=context, **kwargs)
+
+    if com1.imports_pending:
+        await context.resolve_imports()
+
+    while True:
+        channel, reused = context.get_channel()
+        try:
+            return await function(channel, *args, **kwargs)
+        except grpc.RpcError:
+            await context.close()
+            if not reused:
+                raise
+
+
+async def _handle(channel: aio.Channel, **request):
+    stub = com1.device_pb2_grpc.DeviceStub(channel)
+    return await stub.Handle(com1.device_pb2.Request(**request), timeout=com1.REQUEST_TIMEOUT)
+
+
+async def get_status(context: Optional[AsyncChannelContext] = None):
+    response = await call_with_channel(_handle, context=context, get_status={})
+    return response.dish_get_status
+
+
+async def get_id(context: Optional[AsyncChannelContext] = None) -> str:
+
+    try:
+        status = await get_status(context)
+        return status.device_info.id
+    except (AttributeError, ValueError, grpc.RpcError) as e:
+        raise com1.GrpcError(e) from e
+
+
+async def status_data(
+    context: Optional[AsyncChannelContext] = None
+) -> Tuple[com1.StatusDict, com1.ObstructionDict, com1.AlertDict]:
+
+    try:
+        status = await get_status(context)
+    except (AttributeError, ValueError, grpc.RpcError) as e:
+        raise com1.GrpcError(e) from e
+
+    return com1.status_data(status=status)
+
+
+async def get_location(context: Optional[AsyncChannelContext] = None):
+    response = await call_with_channel(_handle, context=context, get_location={})
+    return response.get_location
+
+
+async def location_data(context: Optional[AsyncChannelContext] = None) -> com1.LocationDict:
+
+    try:
+        location = await get_location(context)
+    except (AttributeError, ValueError, grpc.RpcError) as e:
+        if isinstance(e, aio.AioRpcError) and e.code() is grpc.StatusCode.PERMISSION_DENIED:
+            return {
+                "latitude": None,
+                "longitude": None,
+                "altitude": None,
+            }
+        raise com1.GrpcError(e) from e
+
+    return com1.location_data(location=location)
+
+
+async def get_history(context: Optional[AsyncChannelContext] = None):
+    response = await call_with_channel(_handle, context=context, get_history={})
+    return response.dish_get_history
+
+
+async def _handle_raw(channel: aio.Channel, **request):
+    handle = channel.unary_unary(com1.HANDLE_METHOD,
+                                 request_serializer=com1.device_pb2.Request.SerializeToString)
+    return await handle(com1.device_pb2.Request(**request), timeout=com1.REQUEST_TIMEOUT)
+
+
+async def get_packed_history(context: Optional[AsyncChannelContext] = None):
+    data = await call_with_channel(_handle_raw, context=context, get_history={})
+    return com1.unpack_history(data)
+
+
+async def _history_or_error(context: Optional[AsyncChannelContext]):
+    try:
+        return await get_packed_history(context)
+    except (AttributeError, ValueError, grpc.RpcError) as e:
+        raise com1.GrpcError(e) from e
+
+
+async def history_bulk_data(
+        parse_samples: int,
+        start: Optional[int] = None,
+        verbose: bool = False,
+        context: Optional[AsyncChannelContext] = None
+) -> Tuple[com1.HistGeneralDict, com1.HistBulkDict]:
+
+    history = await _history_or_error(context)
+    return com1.history_bulk_data(parse_samples, start=start, verbose=verbose, history=history)
+
+
+async def history_stats(parse_samples: int,
+                        start: Optional[int] = None,
+                        verbose: bool = False,
+                        context: Optional[AsyncChannelContext] = None,
+                        use_numpy: bool = True,
+                        sketch: bool = False,
+                        loaded_tail: bool = False):
+
+    history = await _history_or_error(context)
+    return com1.history_stats(parse_samples,
+                              start=start,
+                              verbose=verbose,
+                              history=history,
+                              use_numpy=use_numpy,
+                              sketch=sketch,
+                              loaded_tail=loaded_tail)
+
+
+async def get_obstruction_map(context: Optional[AsyncChannelContext] = None):
+    response = await call_with_channel(_handle, context=context, dish_get_obstruction_map={})
+    return response.dish_get_obstruction_map
+
+
+async def obstruction_map(context: Optional[AsyncChannelContext] = None, as_array: bool = False):
+
+    try:
+        map_data = await get_obstruction_map(context)
+    except (AttributeError, ValueError, grpc.RpcError) as e:
+        raise com1.GrpcError(e) from e
+
+    return com1.obstruction_map(map_data=map_data, as_array=as_array)
+
+
+async def _command(context: Optional[AsyncChannelContext], **request) -> None:
+    # response is empty message in these cases, so just ignore it
+    try:
+        await call_with_channel(_handle, context=context, **request)
+    except (AttributeError, ValueError, grpc.RpcError) as e:
+        raise com1.GrpcError(e) from e
+
+
+async def reboot(context: Optional[AsyncChannelContext] = None) -> None:
+    await _command(context, reboot={})
+
+
+async def set_stow_state(unstow: bool = False,
+                         context: Optional[AsyncChannelContext] = None) -> None:
+    await _command(context, dish_stow={"unstow": unstow})
+
+
+async def set_sleep_config(start: int,
+                           duration: int,
+                           enable: bool = True,
+                           context: Optional[AsyncChannelContext] = None) -> None:
+
+    if not enable:
+        start = 0
+        duration = 1
+
+    await _command(context,
+                   dish_power_save={
+                       "power_save_start_minutes": start,
+                       "power_save_duration_minutes": duration,
+                       "enable_power_save": enable
+                   })
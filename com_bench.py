@@ -0,0 +1,420 @@
+#!/usr/bin/python3
+"""Benchmarks for the dish data collection scripts.
+
+Run one or more named benchmarks and print their results as JSON, for
+example:
+
+    python3 com_bench.py startup --target 192.168.100.1:9200
+
+The startup benchmark times whole process runs of com.py, so it includes
+interpreter start and module import time. Cases that need a dish are only run
+when --target is given. All other benchmarks run offline, on synthetic
+history responses, status data and obstruction maps.
+
+Results include the git commit and time of the run, so that saved results
+can be compared across commits.
+"""
+
+import argparse
+from array import array
+from datetime import datetime, timezone
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+from typing import Dict, List
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+REPEAT_DEFAULT = 10
+BULK_ROWS = 100000
+BULK_START = 1700000000
+HISTORY_SAMPLES_DEFAULT = 43200
+OBSTRUCTION_MAP_SIZE = 123
+OBSTRUCTION_MAP_CHANGES = 40
+OBSTRUCTION_MAPS = 2000
+
+
+def _run_times(args: List[str], repeat: int) -> Dict:
+    times = []
+    rc = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = subprocess.run(args,
+                                cwd=SCRIPT_DIR,
+                                stdout=subprocess.DEVNULL,
+                                stderr=subprocess.DEVNULL,
+                                check=False)
+        times.append(time.perf_counter() - start)
+        rc = rc or result.returncode
+    return {
+        "median_ms": statistics.median(times) * 1000,
+        "min_ms": min(times) * 1000,
+        "max_ms": max(times) * 1000,
+        "rc": rc,
+    }
+
+
+def _import_times(module: str) -> Dict[str, float]:
+    # cumulative import time of the module and each of its direct imports,
+    # from the -X importtime tree, which lists children before their parent
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module],
+                            cwd=SCRIPT_DIR,
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE,
+                            text=True,
+                            check=False)
+    children = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        try:
+            cumulative = int(line.split("|")[1]) / 1000
+        except (IndexError, ValueError):
+            continue
+        name = line.split("|")[2]
+        depth = (len(name) - len(name.lstrip(" ")) - 1) // 2
+        if depth == 1:
+            children[name.strip()] = cumulative
+        elif depth == 0:
+            if name.strip() == module:
+                return dict(children, total=cumulative)
+            children = {}
+    return {}
+
+
+def bench_startup(opts) -> Dict:
+    com = [sys.executable, os.path.join(SCRIPT_DIR, "com.py")]
+    target = ["--target", opts.target] if opts.target else []
+    results = {
+        "import_ms": _import_times("com2"),
+        "help": _run_times(com + ["--help"], opts.repeat),
+        "print_header": _run_times(com + ["--print-header", "ping_drop", "ping_latency", "usage"],
+                                   opts.repeat),
+    }
+    if opts.target:
+        results["print_header_status"] = _run_times(
+            com + target + ["--print-header", "status", "alert_detail"], opts.repeat)
+        results["status_poll"] = _run_times(com + target + ["status"], opts.repeat)
+    return results
+
+
+def synthetic_bulk(samples: int, seed: int = 0) -> Dict[str, List]:
+    rand = random.Random(seed)
+    drop = [rand.choice([0.0, 0.0, 0.0, 0.0625, 0.5, 1.0]) for _ in range(samples)]
+    return {
+        "pop_ping_drop_rate": drop,
+        "pop_ping_latency_ms": [rand.uniform(20.0, 90.0) if x < 1 else None for x in drop],
+        "downlink_throughput_bps": [rand.uniform(0.0, 2e8) for _ in range(samples)],
+        "uplink_throughput_bps": [rand.uniform(0.0, 2e7) for _ in range(samples)],
+        "snr": [None] * samples,
+        "scheduled": [None] * samples,
+        "obstructed": [None] * samples,
+    }
+
+
+def _legacy_bulk_write(print_file, bulk, count, timestamp):
+    # bulk_history CSV output as it was written before batching, for comparison
+    for i in range(count):
+        timestamp += 1
+        fields = [datetime.utcfromtimestamp(timestamp).isoformat()]
+        fields.extend(["" if val[i] is None else str(val[i]) for val in bulk.values()])
+        print(",".join(fields), file=print_file)
+
+
+def bench_bulk_csv(opts) -> Dict:
+    import com
+    bulk = synthetic_bulk(BULK_ROWS)
+    def batched_bulk_write(print_file, bulk, count, timestamp):
+        print_file.write(com.format_bulk_rows(bulk, timestamp))
+
+    cases = {
+        "line_buffered_per_row": (_legacy_bulk_write, 1),
+        "batched": (batched_bulk_write, com.OUT_BUFFER_SIZE),
+    }
+    results = {"rows": BULK_ROWS}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "bulk.csv")
+        for name, (write, buffering) in cases.items():
+            times = []
+            for _ in range(max(1, opts.repeat // 5)):
+                start = time.perf_counter()
+                with open(path, "w", buffering=buffering) as print_file:
+                    write(print_file, bulk, BULK_ROWS, BULK_START)
+                times.append(time.perf_counter() - start)
+            results[name] = {
+                "median_ms": statistics.median(times) * 1000,
+                "rows_per_sec": BULK_ROWS / statistics.median(times),
+            }
+    results["speedup"] = (results["batched"]["rows_per_sec"] /
+                          results["line_buffered_per_row"]["rows_per_sec"])
+    return results
+
+
+class SyntheticHistory:
+    # Same shape as a dish_get_history response: a ring buffer of samples,
+    # in which the sample with counter c is at index c % buffer size.
+    def __init__(self, current: int, samples: int, seed: int = 0) -> None:
+        rand = random.Random(seed)
+        self.current = current
+        self.pop_ping_drop_rate = []
+        self.pop_ping_latency_ms = []
+        self.downlink_throughput_bps = []
+        self.uplink_throughput_bps = []
+        outage = 0
+        for _ in range(samples):
+            # occasional outage runs of 1 second to several minutes
+            if not outage and rand.random() < 0.005:
+                outage = rand.choice([1, 2, 5, 30, 90, 300])
+            if outage:
+                outage -= 1
+                drop = 1.0
+            else:
+                drop = rand.choice([0.0] * 12 + [0.0625, 0.25, 0.5, 1.0])
+            self.pop_ping_drop_rate.append(drop)
+            self.pop_ping_latency_ms.append(rand.uniform(20.0, 90.0) if drop < 1 else 0.0)
+            # idle, light and heavily loaded samples, across all load buckets
+            self.downlink_throughput_bps.append(rand.choice([0.0, rand.uniform(0.0, 5e5),
+                                                             rand.uniform(5e5, 2e9)]))
+            self.uplink_throughput_bps.append(rand.uniform(0.0, 3e7))
+
+
+def synthetic_histories(samples: int) -> Dict[str, SyntheticHistory]:
+    return {
+        # buffer only partly filled since the dish booted
+        "unwrapped": SyntheticHistory(samples // 2, samples, seed=1),
+        # buffer wrapped, with the newest sample in the middle of it
+        "wrapped": SyntheticHistory(samples*7 + samples//3, samples, seed=2),
+    }
+
+
+def packed_history(history: SyntheticHistory):
+    # The same samples as com1.unpack_history gives them, as float32 views
+    import com1
+    return com1.PackedHistory(
+        history.current,
+        {field: memoryview(array("f", getattr(history, field))) for field in com1.HISTORY_FIELDS})
+
+
+def _time_call(function, repeat: int) -> Dict:
+    timer = timeit.Timer(function)
+    number = timer.autorange()[0]
+    times = [x / number for x in timer.repeat(repeat=repeat, number=number)]
+    return {
+        "median_us": statistics.median(times) * 1e6,
+        "min_us": min(times) * 1e6,
+    }
+
+
+def bench_history(opts) -> Dict:
+    import com1
+    samples = opts.history_samples
+    results = {"samples": samples}
+    for name, history in synthetic_histories(samples).items():
+        # the next poll, some time later
+        next_history = SyntheticHistory(history.current + samples//4, samples, seed=3)
+        # counter reset, as from a dish reboot, when resuming from a prior counter
+        reset_start = history.current + samples
+        packed = packed_history(history)
+        # polls that keep following on from each other, each a quarter of the
+        # buffer on, for appending to a running unwrapped history
+        stream = SyntheticHistory(history.current, samples, seed=3)
+        unwrapped = com1.concatenate_history(history, stream)
+
+        def extend_unwrapped():
+            stream.current += samples // 4
+            unwrapped.extend(stream, samples=samples)
+
+        cases = {
+            "history_stats_numpy": lambda: com1.history_stats(-1, history=history),
+            "history_stats_numpy_packed": lambda: com1.history_stats(-1, history=packed),
+            "history_stats_python": lambda: com1.history_stats(-1, history=history,
+                                                               use_numpy=False),
+            "history_stats_sketch": lambda: com1.history_stats(-1, history=history, sketch=True),
+            "history_stats_counter_reset": lambda: com1.history_stats(
+                -1, start=reset_start, history=history),
+            "history_bulk_data": lambda: com1.history_bulk_data(-1, history=history),
+            "history_bulk_data_packed": lambda: com1.history_bulk_data(-1, history=packed),
+            "compute_sample_range": lambda: com1._compute_sample_range(history, -1),
+            "concatenate_history": lambda: com1.concatenate_history(history, next_history),
+            "unwrapped_history_extend": extend_unwrapped,
+        }
+        if com1.np is None:
+            del cases["history_stats_numpy"]
+            del cases["history_stats_numpy_packed"]
+        results[name] = {case: _time_call(function, opts.repeat)
+                         for case, function in cases.items()}
+    return results
+
+
+def bench_add_data(opts) -> Dict:
+    import com1
+    import com2
+    history = synthetic_histories(opts.history_samples)["wrapped"]
+    groups = com1.history_stats(-1, history=history, loaded_tail=True)
+    status = {
+        "state": "CONNECTED",
+        "uptime": 123456,
+        "currently_obstructed": False,
+        "wedges_fraction_obstructed[]": [0.0] * 12,
+        "raw_wedges_fraction_obstructed[]": [0.0] * 12,
+    }
+    status.update(("alert_" + str(x), False) for x in range(20))
+
+    def run(add_data):
+        items = []
+        add_item = lambda name, val, category: items.append(val)
+        add_sequence = lambda name, val, category, start: items.extend(val)
+        add_data(status, "status", add_item, add_sequence)
+        for group in groups:
+            add_data(group, "ping_stats", add_item, add_sequence)
+
+    return {
+        "add_data_normal": _time_call(lambda: run(com2.add_data_normal), opts.repeat),
+        "add_data_numeric": _time_call(lambda: run(com2.add_data_numeric), opts.repeat),
+    }
+
+
+def synthetic_obstruction_maps(count: int, seed: int = 0) -> List[List[List[float]]]:
+    # A map that fills in and changes a little between polls, with some polls
+    # returning it unchanged, roughly as a dish map evolves
+    rand = random.Random(seed)
+    cells = OBSTRUCTION_MAP_SIZE * OBSTRUCTION_MAP_SIZE
+    flat = [rand.choice([-1.0, -1.0, 0.0, 1.0, 1.0, 1.0]) for _ in range(cells)]
+    maps = []
+    for i in range(count):
+        if i % 4:
+            for cell in rand.sample(range(cells), OBSTRUCTION_MAP_CHANGES):
+                flat[cell] = rand.choice([0.0, 0.25, 1.0])
+        maps.append([
+            flat[j:j + OBSTRUCTION_MAP_SIZE] for j in range(0, cells, OBSTRUCTION_MAP_SIZE)
+        ])
+    return maps
+
+
+def bench_obstruction_archive(opts) -> Dict:
+    import com1
+    import com_maparchive
+    maps = synthetic_obstruction_maps(OBSTRUCTION_MAPS)
+    if com1.np is not None:
+        maps = [com1.np.array(x, dtype=com1.np.float32) for x in maps]
+    raw_bytes = OBSTRUCTION_MAP_SIZE * OBSTRUCTION_MAP_SIZE * 4
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "maps.bin")
+        start = time.perf_counter()
+        with com_maparchive.MapArchive(path) as archive:
+            for i, snr_map in enumerate(maps):
+                archive.append(snr_map, BULK_START + i * 60)
+        append_time = time.perf_counter() - start
+        size = os.path.getsize(path)
+
+        rand = random.Random(0)
+        times = [
+            BULK_START + rand.randrange(OBSTRUCTION_MAPS) * 60 for _ in range(opts.repeat * 10)
+        ]
+        with com_maparchive.MapArchive(path) as archive:
+            records = len(archive)
+            start = time.perf_counter()
+            for timestamp in times:
+                archive.obstruction_map(timestamp, as_array=com1.np is not None)
+            random_time = (time.perf_counter() - start) / len(times)
+            start = time.perf_counter()
+            for i in range(OBSTRUCTION_MAPS):
+                archive.obstruction_map(BULK_START + i * 60, as_array=com1.np is not None)
+            sequential_time = (time.perf_counter() - start) / OBSTRUCTION_MAPS
+
+    return {
+        "snapshots": OBSTRUCTION_MAPS,
+        "records": records,
+        "raw_bytes_per_snapshot": raw_bytes,
+        "bytes_per_snapshot": size / OBSTRUCTION_MAPS,
+        "compression_ratio": raw_bytes * OBSTRUCTION_MAPS / size,
+        "append_ms": append_time / OBSTRUCTION_MAPS * 1000,
+        "random_decode_ms": random_time * 1000,
+        "sequential_decode_ms": sequential_time * 1000,
+    }
+
+
+BENCHMARKS = {
+    "add_data": bench_add_data,
+    "bulk_csv": bench_bulk_csv,
+    "history": bench_history,
+    "obstruction_archive": bench_obstruction_archive,
+    "startup": bench_startup,
+}
+
+
+def _git_commit():
+    # so results can be tracked across commits
+    try:
+        result = subprocess.run(["git", "rev-parse", "HEAD"],
+                                cwd=SCRIPT_DIR,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL,
+                                text=True,
+                                check=True)
+        return result.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run performance benchmarks and print the "
+                                     "results in JSON format")
+    parser.add_argument("benchmark",
+                        nargs="*",
+                        help="Benchmarks to run, default: all; one or more of: " +
+                        ", ".join(sorted(BENCHMARKS)),
+                        metavar="benchmark")
+    parser.add_argument("-g",
+                        "--target",
+                        help="host:port of dish to use for benchmarks that need one; those are "
+                        "skipped if not set")
+    parser.add_argument("-n",
+                        "--repeat",
+                        type=int,
+                        default=REPEAT_DEFAULT,
+                        help="Number of times to repeat each timed run, default: " +
+                        str(REPEAT_DEFAULT))
+    parser.add_argument("-s",
+                        "--history-samples",
+                        type=int,
+                        default=HISTORY_SAMPLES_DEFAULT,
+                        help="Size of the synthetic history buffers, default: " +
+                        str(HISTORY_SAMPLES_DEFAULT))
+    parser.add_argument("-O", "--out-file", help="Write results to this file instead of stdout")
+    opts = parser.parse_args()
+    if opts.repeat < 1:
+        parser.error("Repeat count must be 1 or greater")
+    if opts.history_samples < 4:
+        parser.error("History samples must be 4 or greater")
+    for name in opts.benchmark:
+        if name not in BENCHMARKS:
+            parser.error("Unknown benchmark: " + name)
+    if not opts.benchmark:
+        opts.benchmark = sorted(BENCHMARKS)
+    return opts
+
+
+def main():
+    opts = parse_args()
+    results = {
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "commit": _git_commit(),
+        "python": sys.version.split()[0],
+        "benchmarks": {name: BENCHMARKS[name](opts) for name in opts.benchmark},
+    }
+    output = json.dumps(results, indent=2)
+    if opts.out_file:
+        with open(opts.out_file, "w") as out_file:
+            print(output, file=out_file)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
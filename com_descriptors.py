@@ -0,0 +1,191 @@
+"""On-disk cache of the dish protocol descriptors.
+
+The dish does not ship its .proto files, so com1 normally asks the dish for
+them via gRPC server reflection before the first real request. This module
+saves the reflected file descriptors to a local JSON file so that later
+process starts can resolve the lazy protocol imports without a dish, and
+refreshes that file in the background when the dish firmware changes.
+"""
+
+import base64
+import json
+import os
+import sys
+import tempfile
+import threading
+from typing import Dict, Iterable, Optional
+
+import grpc
+from google.protobuf import descriptor_pb2
+from google.protobuf.message import DecodeError
+from yagrc import importer
+from yagrc import reflector
+
+CACHE_VERSION = 1
+DEFAULT_CACHE_PATH = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+    "starlink-grpc", "descriptors.json")
+
+_refresh_lock = threading.Lock()
+_refresh_thread = None
+
+
+def supported() -> bool:
+    # The cache works through yagrc's lazy import internals, which are not
+    # part of its public API, so check they are all there before using them
+    finder = getattr(importer, "_lazy_finder", None)
+    lazy_importer = getattr(importer, "_lazy_importer", None)
+    engine = getattr(lazy_importer, "reflector", None)
+    return (hasattr(finder, "pb2_imports") and hasattr(finder, "pb2_grpc_imports") and
+            hasattr(getattr(lazy_importer, "_finder", None), "configure_files") and
+            hasattr(engine, "pool") and hasattr(engine, "methods_by_file") and
+            hasattr(engine, "file_descriptor") and
+            callable(getattr(importer, "_exec_pb2_module", None)) and
+            callable(getattr(importer, "_exec_pb2_grpc_module", None)))
+
+
+def _pending_files():
+    finder = importer._lazy_finder
+    pb2_modules = [(module.__name__[:-4].replace(".", "/") + ".proto", module)
+                   for module in finder.pb2_imports]
+    pb2_grpc_modules = [(module.__name__[:-9].replace(".", "/") + ".proto", module)
+                        for module in finder.pb2_grpc_imports]
+    return pb2_modules, pb2_grpc_modules
+
+
+def read_cache(path: str) -> Optional[Dict]:
+    try:
+        with open(path, "r") as cache_file:
+            state = json.load(cache_file)
+        if state.get("version") != CACHE_VERSION:
+            return None
+        state["protos"] = {
+            name: descriptor_pb2.FileDescriptorProto.FromString(base64.b64decode(data))
+            for name, data in state["files"].items()
+        }
+        return state
+    except (OSError, ValueError, KeyError, TypeError, AttributeError, DecodeError):
+        return None
+
+
+def pending_roots():
+    pb2_modules, pb2_grpc_modules = _pending_files()
+    return sorted(set(filename for filename, _ in pb2_modules + pb2_grpc_modules))
+
+
+def write_cache(path: str, engine, roots: Iterable[str], firmware: Optional[str]) -> None:
+    files = {}
+    for name in engine.methods_by_file:
+        files[name] = base64.b64encode(engine.file_descriptor(name).serialized_pb).decode("ascii")
+    state = {
+        "version": CACHE_VERSION,
+        "firmware": firmware,
+        "roots": sorted(roots),
+        "files": files,
+    }
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory or None, prefix=".descriptors-")
+    try:
+        with os.fdopen(fd, "w") as cache_file:
+            json.dump(state, cache_file, separators=(",", ":"))
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def save_lazy_imports(path: str, roots: Iterable[str], firmware: Optional[str] = None) -> None:
+    try:
+        write_cache(path, importer._lazy_importer.reflector, roots, firmware)
+    except (OSError, AttributeError):
+        pass
+
+
+def _add_to_pool(engine, protos: Dict) -> None:
+    added = set()
+
+    def add(name):
+        if name in added:
+            return
+        added.add(name)
+        proto = protos[name]
+        for dep in proto.dependency:
+            if dep in protos:
+                add(dep)
+        try:
+            engine.pool.FindFileByName(name)
+        except KeyError:
+            engine.pool.Add(proto)
+        engine.methods_by_file[name] = {service.name: service.method for service in proto.service}
+
+    for name in protos:
+        add(name)
+
+
+def load_lazy_imports(path: str) -> Optional[Dict]:
+    # Same steps as yagrc's resolve_lazy_imports, but with the reflection
+    # engine filled from the cache file instead of from the dish.
+    state = read_cache(path)
+    if state is None:
+        return None
+    protos = state["protos"]
+    pb2_modules, pb2_grpc_modules = _pending_files()
+    if not all(filename in protos for filename, _ in pb2_modules + pb2_grpc_modules):
+        return None
+
+    lazy_importer = importer._lazy_importer
+    finder = importer._lazy_finder
+    orig_meta_path = sys.meta_path.copy()
+    if finder in sys.meta_path:
+        sys.meta_path.remove(finder)
+    try:
+        _add_to_pool(lazy_importer.reflector, protos)
+        lazy_importer._finder.configure_files(protos.keys())
+        if lazy_importer._finder not in sys.meta_path:
+            sys.meta_path.append(lazy_importer._finder)
+        for filename, module in pb2_modules:
+            del module.__getattr__
+            importer._exec_pb2_module(module, lazy_importer.reflector, filename)
+        for filename, module in pb2_grpc_modules:
+            del module.__getattr__
+            importer._exec_pb2_grpc_module(module, lazy_importer.reflector, filename)
+    except (KeyError, TypeError, ValueError, ImportError, AttributeError):
+        sys.meta_path = orig_meta_path
+        return None
+
+    finder.pb2_imports.clear()
+    finder.pb2_grpc_imports.clear()
+    sys.meta_path.append(finder)
+    return state
+
+
+def _refresh(path: str, target: str, firmware: str) -> None:
+    state = read_cache(path)
+    roots = state["roots"] if state is not None else ["spacex/api/device/device.proto"]
+    engine = reflector.GrpcReflectionEngine()
+    try:
+        with grpc.insecure_channel(target) as channel:
+            engine.load_protocols(channel, filenames=roots)
+        write_cache(path, engine, roots, firmware)
+    except (grpc.RpcError, reflector.ServiceError, KeyError, TypeError, OSError):
+        pass
+
+
+def refresh_in_background(path: str, target: str, firmware: str) -> Optional[threading.Thread]:
+    # The running process keeps the descriptors it already loaded, so only the
+    # next start sees the refreshed file. At most one refresh runs per process.
+    global _refresh_thread
+    with _refresh_lock:
+        if _refresh_thread is not None:
+            return None
+        _refresh_thread = threading.Thread(target=_refresh,
+                                           args=(path, target, firmware),
+                                           name="descriptor-refresh",
+                                           daemon=True)
+        _refresh_thread.start()
+        return _refresh_thread
@@ -0,0 +1,734 @@
+#!/usr/bin/python3
+"""Run fake Starlink dishes, for load and soak testing the collectors.
+
+Each virtual dish is a gRPC server on its own port that answers the
+Device.Handle get_status, get_history, get_location and
+dish_get_obstruction_map requests with synthetic data. It also serves
+gRPC server reflection, so com1 resolves its protocol imports from a fake
+dish the same way it does from a real one.
+
+The protocol descriptors are built in, and cover the fields the collectors
+read. A descriptor cache file saved by com1 from a real dish (see
+com_descriptors) can be served instead with --descriptors.
+
+Each dish records one history sample per second into a ring buffer of
+--ring-size samples. Sample values come from a pattern of outages, latency
+and throughput shared by all dishes, with each dish starting at its own
+offset. Responses can be slowed, failed or stalled at random, and dishes
+can reboot at random, which resets their history counter and leaves them
+unreachable for a while.
+
+All dishes in a process share one event loop. For thousands of dishes,
+--processes spreads them over several processes.
+"""
+
+import argparse
+import asyncio
+from array import array
+import logging
+import math
+import multiprocessing
+import queue
+import random
+import signal
+import sys
+import time
+from typing import Dict, List, Optional
+
+import grpc
+from grpc import aio
+from google.protobuf import descriptor_pb2
+from google.protobuf import descriptor_pool
+from google.protobuf import message_factory
+
+ADDRESS_DEFAULT = "127.0.0.1"
+PORT_DEFAULT = 9200
+RING_SIZE_DEFAULT = 43200
+FIRMWARE_DEFAULT = "fake-firmware"
+REBOOT_DOWNTIME_DEFAULT = 30.0
+MAP_SIZE = 123
+MAP_CHANGE_SECONDS = 60
+SERVICE_NAME = "SpaceX.API.Device.Device"
+
+_F = descriptor_pb2.FieldDescriptorProto
+_TYPES = {
+    "bool": _F.TYPE_BOOL,
+    "float": _F.TYPE_FLOAT,
+    "int64": _F.TYPE_INT64,
+    "string": _F.TYPE_STRING,
+    "uint32": _F.TYPE_UINT32,
+    "uint64": _F.TYPE_UINT64,
+}
+_PACKAGE = "SpaceX.API.Device"
+_HISTORY_FIELDS = ("pop_ping_drop_rate", "pop_ping_latency_ms", "downlink_throughput_bps",
+                   "uplink_throughput_bps")
+_OUTAGE_CAUSES = ("UNKNOWN", "BOOTING", "STOWED", "THERMAL_SHUTDOWN", "NO_SCHEDULE", "NO_SATS",
+                  "OBSTRUCTED", "NO_DOWNLINK", "NO_PINGS", "ACTUATOR_ACTIVITY", "CABLE_TEST",
+                  "SLEEPING")
+_ALERTS = ("motors_stuck", "thermal_shutdown", "thermal_throttle", "unexpected_location",
+           "mast_not_near_vertical", "slow_ethernet_speeds", "roaming", "install_pending",
+           "is_heating", "power_supply_thermal_throttle")
+
+
+def _message(file_proto, name, fields, oneof=None):
+    # fields is a list of (name, number, type, repeated), where type is
+    # either a scalar type name or the name of a message or enum
+    message = file_proto.message_type.add(name=name)
+    if oneof is not None:
+        message.oneof_decl.add(name=oneof)
+    for field_name, number, field_type, repeated in fields:
+        field = message.field.add(name=field_name,
+                                  number=number,
+                                  label=_F.LABEL_REPEATED if repeated else _F.LABEL_OPTIONAL)
+        if field_type in _TYPES:
+            field.type = _TYPES[field_type]
+        else:
+            field.type = _F.TYPE_ENUM if field_type.endswith("Cause") else _F.TYPE_MESSAGE
+            field.type_name = "." + _PACKAGE + "." + field_type
+        if oneof is not None and number > 1:
+            field.oneof_index = 0
+    return message
+
+
+def builtin_protos() -> Dict[str, descriptor_pb2.FileDescriptorProto]:
+    # A cut down version of the dish protocol, with the same names and field
+    # numbers for everything it includes
+    common = descriptor_pb2.FileDescriptorProto(name="spacex/api/device/common.proto",
+                                                package=_PACKAGE,
+                                                syntax="proto3")
+    _message(common, "DeviceInfo", [("id", 1, "string", False),
+                                    ("hardware_version", 2, "string", False),
+                                    ("software_version", 3, "string", False)])
+    _message(common, "DeviceState", [("uptime_s", 1, "uint64", False)])
+    _message(common, "LLAPosition", [("lat", 1, "float", False), ("lon", 2, "float", False),
+                                     ("alt", 3, "float", False)])
+
+    dish = descriptor_pb2.FileDescriptorProto(name="spacex/api/device/dish.proto",
+                                              package=_PACKAGE,
+                                              syntax="proto3",
+                                              dependency=[common.name])
+    _message(dish, "DishAlerts", [(name, i, "bool", False) for i, name in enumerate(_ALERTS, 1)])
+    outage = _message(dish, "DishOutage", [("cause", 1, "DishOutage.Cause", False),
+                                           ("start_timestamp_ns", 2, "int64", False),
+                                           ("duration_ns", 3, "uint64", False),
+                                           ("did_switch", 4, "bool", False)])
+    cause = outage.enum_type.add(name="Cause")
+    for i, name in enumerate(_OUTAGE_CAUSES):
+        cause.value.add(name=name, number=i)
+    _message(dish, "DishObstructionStats", [("fraction_obstructed", 1, "float", False),
+                                            ("valid_s", 4, "float", False),
+                                            ("currently_obstructed", 5, "bool", False),
+                                            ("avg_prolonged_obstruction_duration_s", 6, "float",
+                                             False),
+                                            ("avg_prolonged_obstruction_interval_s", 7, "float",
+                                             False)])
+    _message(dish, "DishGetStatusResponse", [
+        ("device_info", 1, "DeviceInfo", False),
+        ("device_state", 2, "DeviceState", False),
+        ("seconds_to_first_nonempty_slot", 1002, "float", False),
+        ("pop_ping_drop_rate", 1003, "float", False),
+        ("obstruction_stats", 1004, "DishObstructionStats", False),
+        ("alerts", 1005, "DishAlerts", False),
+        ("downlink_throughput_bps", 1007, "float", False),
+        ("uplink_throughput_bps", 1008, "float", False),
+        ("pop_ping_latency_ms", 1009, "float", False),
+        ("boresight_azimuth_deg", 1011, "float", False),
+        ("boresight_elevation_deg", 1012, "float", False),
+        ("outage", 1014, "DishOutage", False),
+        ("is_snr_above_noise_floor", 1018, "bool", False),
+    ])
+    _message(dish, "DishGetHistoryResponse", [("current", 1, "uint64", False)] +
+             [(name, i, "float", True) for i, name in enumerate(_HISTORY_FIELDS, 1001)])
+    _message(dish, "DishGetObstructionMapRequest", [])
+    _message(dish, "DishGetObstructionMapResponse", [("num_rows", 1, "uint32", False),
+                                                     ("num_cols", 2, "uint32", False),
+                                                     ("snr", 3, "float", True)])
+    _message(dish, "DishStowRequest", [("unstow", 1, "bool", False)])
+    _message(dish, "DishPowerSaveRequest", [("power_save_start_minutes", 1, "uint32", False),
+                                            ("power_save_duration_minutes", 2, "uint32", False),
+                                            ("enable_power_save", 3, "bool", False)])
+
+    device = descriptor_pb2.FileDescriptorProto(name="spacex/api/device/device.proto",
+                                                package=_PACKAGE,
+                                                syntax="proto3",
+                                                dependency=[common.name, dish.name])
+    for name in ("GetStatusRequest", "GetHistoryRequest", "GetLocationRequest", "RebootRequest",
+                 "RebootResponse"):
+        _message(device, name, [])
+    _message(device, "GetLocationResponse", [("lla", 1, "LLAPosition", False)])
+    _message(device, "Request", [
+        ("id", 1, "uint64", False),
+        ("reboot", 1001, "RebootRequest", False),
+        ("get_status", 1004, "GetStatusRequest", False),
+        ("get_history", 1007, "GetHistoryRequest", False),
+        ("get_location", 1017, "GetLocationRequest", False),
+        ("dish_stow", 2002, "DishStowRequest", False),
+        ("dish_get_obstruction_map", 2008, "DishGetObstructionMapRequest", False),
+        ("dish_power_save", 2013, "DishPowerSaveRequest", False),
+    ],
+             oneof="request")
+    _message(device, "Response", [
+        ("id", 1, "uint64", False),
+        ("reboot", 1001, "RebootResponse", False),
+        ("get_location", 1017, "GetLocationResponse", False),
+        ("dish_get_status", 2004, "DishGetStatusResponse", False),
+        ("dish_get_history", 2006, "DishGetHistoryResponse", False),
+        ("dish_get_obstruction_map", 2008, "DishGetObstructionMapResponse", False),
+    ],
+             oneof="response")
+    service = device.service.add(name="Device")
+    service.method.add(name="Handle",
+                       input_type="." + _PACKAGE + ".Request",
+                       output_type="." + _PACKAGE + ".Response")
+
+    return {proto.name: proto for proto in (common, dish, device)}
+
+
+def _build_pool(protos: Dict[str, descriptor_pb2.FileDescriptorProto]):
+    pool = descriptor_pool.DescriptorPool()
+    added = set()
+
+    def add(name):
+        if name in added:
+            return
+        added.add(name)
+        for dep in protos[name].dependency:
+            if dep in protos:
+                add(dep)
+        pool.Add(protos[name])
+
+    for name in protos:
+        add(name)
+    return pool
+
+
+def _varint(value: int) -> bytes:
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _packed_field(number: int, data: bytes) -> bytes:
+    # wire format of a length delimited field, which is also how packed
+    # repeated floats are encoded
+    return _varint(number << 3 | 2) + _varint(len(data)) + data
+
+
+def _float_bytes(values: array) -> bytes:
+    if sys.byteorder != "little":
+        values = array("f", values)
+        values.byteswap()
+    return values.tobytes()
+
+
+class SamplePattern:
+    # History sample values shared by all dishes. The pattern is longer than
+    # the ring buffer and stored twice over, so any run of counters maps to a
+    # single slice.
+    def __init__(self, ring_size: int, seed: int = 0) -> None:
+        self.ring_size = ring_size
+        self.size = ring_size*2 + 1
+        rng = random.Random(seed)
+        columns = {name: array("f") for name in _HISTORY_FIELDS}
+        outage_left = 0
+        busy_left = 0
+        for _ in range(self.size):
+            if outage_left == 0 and rng.random() < 1 / 3600:
+                outage_left = rng.randint(2, 30)
+            if busy_left == 0 and rng.random() < 1 / 600:
+                busy_left = rng.randint(5, 120)
+            if outage_left:
+                outage_left -= 1
+                drop, latency = 1.0, 0.0
+            else:
+                drop = rng.choice((0.05, 0.1, 0.25)) if rng.random() < 0.01 else 0.0
+                latency = max(15.0, rng.gauss(38.0, 6.0))
+            if busy_left:
+                busy_left -= 1
+                downlink = rng.uniform(2e7, 2e8)
+                latency += rng.uniform(0.0, 40.0) if latency else 0.0
+            else:
+                downlink = rng.lognormvariate(math.log(1e5), 1.0)
+            columns["pop_ping_drop_rate"].append(drop)
+            columns["pop_ping_latency_ms"].append(latency)
+            columns["downlink_throughput_bps"].append(0.0 if drop >= 1.0 else downlink)
+            columns["uplink_throughput_bps"].append(0.0 if drop >= 1.0 else downlink / 10.0)
+        self.columns = columns
+        self.doubled = {name: _float_bytes(column) * 2 for name, column in columns.items()}
+        self.zeros = bytes(4 * ring_size)
+
+    def value(self, name: str, counter: int, offset: int) -> float:
+        return self.columns[name][(counter+offset) % self.size]
+
+    def _run(self, name: str, counter: int, count: int, offset: int) -> bytes:
+        start = (counter+offset) % self.size * 4
+        return self.doubled[name][start:start + count*4]
+
+    def ring_buffer(self, name: str, current: int, offset: int) -> bytes:
+        # The buffer contents after current samples, sample n being stored
+        # at index n % ring_size
+        ring = self.ring_size
+        if current < ring:
+            return self._run(name, 0, current, offset) + self.zeros[current * 4:]
+        end = current % ring
+        return (self._run(name, current - end, end, offset) +
+                self._run(name, current - ring, ring - end, offset))
+
+
+class DishStats:
+    def __init__(self) -> None:
+        self.requests: Dict[str, int] = {}
+        self.errors = 0
+        self.stalls = 0
+        self.reboots = 0
+        self.unavailable = 0
+
+    def merge(self, other: "DishStats") -> None:
+        for name, count in other.requests.items():
+            self.requests[name] = self.requests.get(name, 0) + count
+        self.errors += other.errors
+        self.stalls += other.stalls
+        self.reboots += other.reboots
+        self.unavailable += other.unavailable
+
+
+class FakeDish:
+    def __init__(self, index: int, opts, pattern: SamplePattern, stats: DishStats) -> None:
+        self.opts = opts
+        self.pattern = pattern
+        self.stats = stats
+        self.rng = random.Random(opts.seed * 1000003 + index)
+        rng = self.rng
+        self.dish_id = "ut{0:08x}-{1:08x}-{2:08x}".format(index, rng.getrandbits(32),
+                                                          rng.getrandbits(32))
+        self.offset = rng.randrange(pattern.size)
+        if opts.counter_start is None:
+            # already wrapped, at no particular point in the buffer
+            self.counter_start = rng.randrange(opts.ring_size, opts.ring_size * 4)
+        else:
+            self.counter_start = opts.counter_start
+        self.boot_time = time.monotonic()
+        self.next_reboot = self._reboot_after(self.boot_time)
+        self.latitude = rng.uniform(-60.0, 60.0)
+        self.longitude = rng.uniform(-180.0, 180.0)
+        self.altitude = rng.uniform(0.0, 1000.0)
+        self.azimuth = rng.uniform(-180.0, 180.0)
+        self.elevation = rng.uniform(60.0, 90.0)
+        self.snr_map: Optional[array] = None
+        self.map_time = 0.0
+
+    def _reboot_after(self, now: float) -> Optional[float]:
+        if self.opts.reboot_interval <= 0.0:
+            return None
+        return now + self.rng.expovariate(1.0 / self.opts.reboot_interval)
+
+    def reboot(self, now: float) -> None:
+        self.stats.reboots += 1
+        self.boot_time = now + self.opts.reboot_downtime
+        self.counter_start = 0
+        self.next_reboot = self._reboot_after(self.boot_time)
+
+    def available(self, now: float) -> bool:
+        if self.next_reboot is not None and now >= self.next_reboot:
+            self.reboot(self.next_reboot)
+        return now >= self.boot_time
+
+    def current(self, now: float) -> int:
+        return self.counter_start + int(now - self.boot_time)
+
+    def status(self, response, now: float) -> None:
+        status = response.dish_get_status
+        current = self.current(now)
+        last = current - 1
+        pattern = self.pattern
+        drop_rate = pattern.value("pop_ping_drop_rate", last, self.offset) if current else 0.0
+        status.device_info.id = self.dish_id
+        status.device_info.hardware_version = "rev3_proto2"
+        status.device_info.software_version = self.opts.firmware
+        status.device_state.uptime_s = current
+        status.pop_ping_drop_rate = drop_rate
+        if current:
+            status.pop_ping_latency_ms = pattern.value("pop_ping_latency_ms", last, self.offset)
+            status.downlink_throughput_bps = pattern.value("downlink_throughput_bps", last,
+                                                           self.offset)
+            status.uplink_throughput_bps = pattern.value("uplink_throughput_bps", last,
+                                                         self.offset)
+        if drop_rate >= 1.0:
+            causes = status.outage.DESCRIPTOR.fields_by_name["cause"].enum_type
+            status.outage.cause = causes.values_by_name["NO_SATS"].number
+            status.seconds_to_first_nonempty_slot = 1.0
+        status.obstruction_stats.fraction_obstructed = 0.01
+        status.obstruction_stats.valid_s = float(min(current, 86400))
+        status.boresight_azimuth_deg = self.azimuth
+        status.boresight_elevation_deg = self.elevation
+        status.is_snr_above_noise_floor = True
+        # touch the alerts, so they are present, if all false
+        status.alerts.SetInParent()
+
+    def history(self, response, now: float, field_numbers: Dict[str, int]) -> None:
+        current = self.current(now)
+        parts = [_varint(field_numbers["current"] << 3) + _varint(current)]
+        for name in _HISTORY_FIELDS:
+            if name in field_numbers:
+                parts.append(
+                    _packed_field(field_numbers[name],
+                                  self.pattern.ring_buffer(name, current, self.offset)))
+        # parsing packed floats is a copy, where setting them one by one is not
+        response.dish_get_history.MergeFromString(b"".join(parts))
+
+    def location(self, response, now: float) -> None:
+        lla = response.get_location.lla
+        lla.lat = self.latitude
+        lla.lon = self.longitude
+        lla.alt = self.altitude
+
+    def _update_map(self, now: float) -> None:
+        rng = self.rng
+        if self.snr_map is None:
+            center = (MAP_SIZE-1) / 2
+            tree = rng.uniform(-math.pi, math.pi)
+            snr_map = array("f")
+            for row in range(MAP_SIZE):
+                for col in range(MAP_SIZE):
+                    if math.hypot(row - center, col - center) > center:
+                        snr_map.append(-1.0)
+                        continue
+                    angle = math.atan2(row - center, col - center)
+                    blocked = abs(math.remainder(angle - tree, 2 * math.pi)) < 0.3
+                    snr_map.append(rng.uniform(0.0, 0.5) if blocked else 1.0)
+            self.snr_map = snr_map
+            self.map_time = now
+            return
+        # a few more cells get data each minute
+        while now - self.map_time >= MAP_CHANGE_SECONDS:
+            self.map_time += MAP_CHANGE_SECONDS
+            for _ in range(20):
+                cell = rng.randrange(len(self.snr_map))
+                if self.snr_map[cell] >= 0.0:
+                    self.snr_map[cell] = rng.choice((1.0, rng.uniform(0.0, 1.0)))
+
+    def obstruction_map(self, response, now: float, field_numbers: Dict[str, int]) -> None:
+        self._update_map(now)
+        map_data = response.dish_get_obstruction_map
+        map_data.num_rows = MAP_SIZE
+        map_data.num_cols = MAP_SIZE
+        map_data.MergeFromString(_packed_field(field_numbers["snr"], _float_bytes(self.snr_map)))
+
+
+class DishServicer:
+    # Handles Device.Handle for one dish
+    def __init__(self, dish: FakeDish, response_class, field_numbers: Dict[str, Dict[str, int]]):
+        self.dish = dish
+        self.response_class = response_class
+        self.history_fields = field_numbers["history"]
+        self.map_fields = field_numbers["map"]
+
+    async def handle(self, request, context):
+        dish = self.dish
+        opts = dish.opts
+        rng = dish.rng
+        kind = request.WhichOneof("request")
+        stats = dish.stats
+        stats.requests[kind] = stats.requests.get(kind, 0) + 1
+
+        delay = opts.latency / 1000.0
+        if opts.jitter > 0.0:
+            delay += rng.expovariate(1000.0 / opts.jitter)
+        if delay > 0.0:
+            await asyncio.sleep(delay)
+
+        now = time.monotonic()
+        if not dish.available(now):
+            stats.unavailable += 1
+            await context.abort(grpc.StatusCode.UNAVAILABLE, "Dish is rebooting")
+        if opts.stall_rate > 0.0 and rng.random() < opts.stall_rate:
+            # never answer; the client's deadline ends the call
+            stats.stalls += 1
+            await asyncio.Event().wait()
+        if opts.error_rate > 0.0 and rng.random() < opts.error_rate:
+            stats.errors += 1
+            await context.abort(grpc.StatusCode.UNAVAILABLE, "Injected error")
+
+        response = self.response_class()
+        if kind == "get_status":
+            dish.status(response, now)
+        elif kind == "get_history":
+            dish.history(response, now, self.history_fields)
+        elif kind == "get_location":
+            if opts.no_location:
+                await context.abort(grpc.StatusCode.PERMISSION_DENIED, "Location access disabled")
+            dish.location(response, now)
+        elif kind == "dish_get_obstruction_map":
+            dish.obstruction_map(response, now, self.map_fields)
+        elif kind == "reboot":
+            dish.reboot(now)
+        elif kind not in ("dish_stow", "dish_power_save"):
+            await context.abort(grpc.StatusCode.UNIMPLEMENTED,
+                                "Unsupported request: {0}".format(kind))
+        return response
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Run fake Starlink dishes on consecutive ports, for load and soak testing "
+        "the data collection scripts")
+    parser.add_argument("--address",
+                        default=ADDRESS_DEFAULT,
+                        help="IP address to listen on, default: " + ADDRESS_DEFAULT)
+    parser.add_argument("-p",
+                        "--port",
+                        type=int,
+                        default=PORT_DEFAULT,
+                        help="Port of the first dish, default: " + str(PORT_DEFAULT))
+    parser.add_argument("-n",
+                        "--count",
+                        type=int,
+                        default=1,
+                        help="Number of dishes to run, default: 1")
+    parser.add_argument("-w",
+                        "--processes",
+                        type=int,
+                        default=1,
+                        help="Number of processes to spread the dishes over, default: 1")
+    parser.add_argument("--targets-file",
+                        help="Write the host:port of each dish to this file, one per line, for "
+                        "use with the --targets-file option of the collectors",
+                        metavar="FILE")
+    parser.add_argument("--descriptors",
+                        help="Serve the protocol descriptors from this descriptor cache file "
+                        "instead of the built in ones",
+                        metavar="FILE")
+    parser.add_argument("--firmware",
+                        default=FIRMWARE_DEFAULT,
+                        help="Software version the dishes report, default: " + FIRMWARE_DEFAULT)
+    parser.add_argument("-s",
+                        "--ring-size",
+                        type=int,
+                        default=RING_SIZE_DEFAULT,
+                        help="Number of samples in the history ring buffer, default: " +
+                        str(RING_SIZE_DEFAULT))
+    parser.add_argument("--counter-start",
+                        type=int,
+                        help="History sample counter of each dish at start, default: a random "
+                        "point after the ring buffer has wrapped; use 0 for newly booted dishes, "
+                        "or a very large value to test counter handling")
+    parser.add_argument("-l",
+                        "--latency",
+                        type=float,
+                        default=0.0,
+                        help="Fixed delay before each response, in milliseconds, default: 0")
+    parser.add_argument("-j",
+                        "--jitter",
+                        type=float,
+                        default=0.0,
+                        help="Mean of an exponentially distributed extra delay per response, in "
+                        "milliseconds, default: 0")
+    parser.add_argument("-e",
+                        "--error-rate",
+                        type=float,
+                        default=0.0,
+                        help="Fraction of requests to fail with UNAVAILABLE, default: 0")
+    parser.add_argument("--stall-rate",
+                        type=float,
+                        default=0.0,
+                        help="Fraction of requests to never answer, default: 0")
+    parser.add_argument("-r",
+                        "--reboot-interval",
+                        type=float,
+                        default=0.0,
+                        help="Mean seconds between random reboots of each dish, or 0 for no "
+                        "random reboots, default: 0")
+    parser.add_argument("--reboot-downtime",
+                        type=float,
+                        default=REBOOT_DOWNTIME_DEFAULT,
+                        help="Seconds a dish is unreachable for when it reboots, default: " +
+                        str(REBOOT_DOWNTIME_DEFAULT))
+    parser.add_argument("--no-location",
+                        action="store_true",
+                        help="Refuse location requests, as dishes do unless local location "
+                        "access is enabled")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed, default: 0")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Be verbose")
+
+    opts = parser.parse_args()
+
+    if opts.count < 1:
+        parser.error("Count must be 1 or greater")
+    if not 1 <= opts.processes <= opts.count:
+        parser.error("Processes must be between 1 and the dish count")
+    if opts.ring_size < 1:
+        parser.error("Ring size must be 1 or greater")
+    if opts.counter_start is not None and opts.counter_start < 0:
+        parser.error("Counter start must not be negative")
+    for name in ("error_rate", "stall_rate"):
+        if not 0.0 <= getattr(opts, name) <= 1.0:
+            parser.error("Rates must be between 0 and 1")
+
+    return opts
+
+
+def load_protos(opts) -> Dict[str, descriptor_pb2.FileDescriptorProto]:
+    if opts.descriptors is None:
+        return builtin_protos()
+    import com_descriptors
+    state = com_descriptors.read_cache(opts.descriptors)
+    if state is None:
+        logging.error("Failed reading descriptor cache file: %s", opts.descriptors)
+        sys.exit(1)
+    return state["protos"]
+
+
+async def serve(opts, indexes: List[int], ready=None) -> DishStats:
+    try:
+        from grpc_reflection.v1alpha import reflection
+    except ImportError:
+        logging.error("The grpcio-reflection package is required to run fake dishes")
+        sys.exit(1)
+
+    protos = load_protos(opts)
+    pool = _build_pool(protos)
+    request_class = message_factory.GetMessageClass(
+        pool.FindMessageTypeByName(_PACKAGE + ".Request"))
+    response_class = message_factory.GetMessageClass(
+        pool.FindMessageTypeByName(_PACKAGE + ".Response"))
+    service_names = [
+        "{0}.{1}".format(proto.package, service.name)
+        for proto in protos.values()
+        for service in proto.service
+    ]
+    response_fields = response_class.DESCRIPTOR.fields_by_name
+    field_numbers = {
+        "history": {
+            field.name: field.number
+            for field in response_fields["dish_get_history"].message_type.fields
+        },
+        "map": {
+            field.name: field.number
+            for field in response_fields["dish_get_obstruction_map"].message_type.fields
+        },
+    }
+
+    pattern = SamplePattern(opts.ring_size, seed=opts.seed)
+    stats = DishStats()
+    servers = []
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+    try:
+        for index in indexes:
+            servicer = DishServicer(FakeDish(index, opts, pattern, stats), response_class,
+                                    field_numbers)
+            # no port sharing, so two runs can't both take the same ports
+            server = aio.server(options=[("grpc.so_reuseport", 0)])
+            server.add_generic_rpc_handlers((grpc.method_handlers_generic_handler(
+                SERVICE_NAME, {
+                    "Handle":
+                        grpc.unary_unary_rpc_method_handler(
+                            servicer.handle,
+                            request_deserializer=request_class.FromString,
+                            response_serializer=response_class.SerializeToString)
+                }),))
+            reflection.enable_server_reflection(service_names + [reflection.SERVICE_NAME],
+                                                server,
+                                                pool=pool)
+            address = "{0}:{1}".format(opts.address, opts.port + index)
+            try:
+                bound = server.add_insecure_port(address)
+            except RuntimeError:
+                bound = 0
+            if not bound:
+                logging.error("Failed listening on %s", address)
+                sys.exit(1)
+            await server.start()
+            servers.append(server)
+        if ready is not None:
+            ready.set()
+        await stop.wait()
+    finally:
+        await asyncio.gather(*(server.stop(None) for server in servers))
+    return stats
+
+
+def run_process(opts, indexes: List[int], ready=None, results=None):
+    stats = asyncio.run(serve(opts, indexes, ready))
+    if results is not None:
+        results.put(stats)
+    else:
+        return stats
+
+
+def print_stats(stats: DishStats) -> None:
+    for name, count in sorted(stats.requests.items()):
+        print("{0} requests: {1}".format(name, count))
+    print("Injected errors: {0}, stalls: {1}".format(stats.errors, stats.stalls))
+    print("Reboots: {0}, requests while rebooting: {1}".format(stats.reboots, stats.unavailable))
+
+
+def main():
+    opts = parse_args()
+
+    logging.basicConfig(format="%(levelname)s: %(message)s")
+
+    if opts.targets_file:
+        try:
+            with open(opts.targets_file, "w") as targets_file:
+                for index in range(opts.count):
+                    targets_file.write("{0}:{1}\n".format(opts.address, opts.port + index))
+        except OSError as e:
+            logging.error("Failed writing targets file: %s", str(e))
+            sys.exit(1)
+
+    if opts.verbose:
+        print("Starting {0} fake dishes on {1}:{2}-{3}".format(opts.count, opts.address, opts.port,
+                                                               opts.port + opts.count - 1))
+
+    if opts.processes == 1:
+        stats = run_process(opts, list(range(opts.count)))
+    else:
+        ctx = multiprocessing.get_context("spawn")
+        results = ctx.Queue()
+        processes = []
+        for i in range(opts.processes):
+            ready = ctx.Event()
+            process = ctx.Process(target=run_process,
+                                  args=(opts, list(range(i, opts.count, opts.processes)), ready,
+                                        results),
+                                  name="fakedish-{0}".format(i))
+            process.start()
+            processes.append((process, ready))
+
+        stop = []
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop.append(signum))
+        try:
+            while not stop:
+                if not all(process.is_alive() for process, _ in processes):
+                    logging.error("A fake dish process exited")
+                    break
+                time.sleep(0.5)
+        except KeyboardInterrupt:
+            pass
+        stats = DishStats()
+        for process, _ in processes:
+            if process.is_alive():
+                process.terminate()
+        # read the results before joining, as a process can't exit with
+        # unread data still in the queue
+        for _ in range(sum(1 for _, ready in processes if ready.is_set())):
+            try:
+                stats.merge(results.get(timeout=10.0))
+            except queue.Empty:
+                break
+        for process, _ in processes:
+            process.join()
+
+    if opts.verbose:
+        print_stats(stats)
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,435 @@
+#!/usr/bin/python3
+"""Write Starlink user terminal data to an InfluxDB database.
+
+Points are encoded directly as InfluxDB line protocol and posted over HTTP by
+a background thread, so a slow or unreachable database never holds up dish
+polling. Data added by each poll is queued as one unit; the writer combines
+queued units into requests of up to --batch-size lines, sent once that many
+lines are pending or --flush-interval seconds after the oldest pending one
+was queued. Each bulk history poll is therefore sent as a single batch.
+Failed requests are retried, and when more than --max-pending lines are
+waiting the oldest are dropped.
+
+InfluxDB 2.x is used when --bucket is set, otherwise InfluxDB 1.x.
+"""
+
+import collections
+import functools
+import logging
+import math
+import os
+import signal
+import sys
+import threading
+import time
+from typing import Dict, Iterable, List, Optional
+import urllib.error
+import urllib.parse
+import urllib.request
+
+import com2
+
+URL_DEFAULT = "http://localhost:8086"
+DATABASE_DEFAULT = "starlinkstats"
+BATCH_SIZE_DEFAULT = 5000
+FLUSH_INTERVAL_DEFAULT = 5.0
+MAX_PENDING_DEFAULT = 100000
+REQUEST_TIMEOUT = 10.0
+RETRY_DELAY_MAX = 60.0
+# results of a write request
+POST_SENT = 0
+POST_RETRY = 1
+POST_REJECTED = 2
+MEASUREMENTS = {
+    "status": "spacex.starlink.user_terminal.status",
+    "history": "spacex.starlink.user_terminal.history",
+    "ping_stats": "spacex.starlink.user_terminal.ping_stats",
+    "usage": "spacex.starlink.user_terminal.usage",
+}
+
+
+class Terminated(Exception):
+    pass
+
+
+def handle_sigterm(signum, frame):
+    raise Terminated
+
+
+@functools.lru_cache(maxsize=None)
+def _escape_key(key: str) -> str:
+    return key.replace("\\", "\\\\").replace(",", "\\,").replace("=", "\\=").replace(" ", "\\ ")
+
+
+def _escape_measurement(name: str) -> str:
+    return name.replace("\\", "\\\\").replace(",", "\\,").replace(" ", "\\ ")
+
+
+def format_value(val) -> Optional[str]:
+    # bool before int, as bool is a subclass of int
+    if val is None:
+        return None
+    if isinstance(val, bool):
+        return "true" if val else "false"
+    if isinstance(val, int):
+        return str(val) + "i"
+    if isinstance(val, float):
+        return repr(val) if math.isfinite(val) else None
+    return '"' + str(val).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def format_tags(tags: Dict[str, str]) -> str:
+    return "".join("," + _escape_key(key) + "=" + _escape_key(str(val))
+                   for key, val in sorted(tags.items())
+                   if val is not None and val != "")
+
+
+def encode_line(measurement: str, tags: str, fields: Dict, timestamp: int) -> Optional[str]:
+    # tags as returned by format_tags; timestamp in seconds
+    field_set = ",".join(
+        _escape_key(key) + "=" + val
+        for key, val in ((key, format_value(val)) for key, val in fields.items())
+        if val is not None)
+    if not field_set:
+        return None
+    return "{0}{1} {2} {3}".format(_escape_measurement(measurement), tags, field_set, timestamp)
+
+
+def encode_bulk(measurement: str,
+                tags: str,
+                bulk: Dict[str, List],
+                count: int,
+                timestamp: int,
+                counter: int) -> List[str]:
+    # One line per sample, encoded column by column so each value is only
+    # formatted once; sample i is at time timestamp+1+i.
+    prefix = _escape_measurement(measurement) + tags + " "
+    columns = [[None if val is None else _escape_key(key) + "=" + val
+                for val in map(format_value, values)]
+               for key, values in bulk.items()]
+    columns.append(["counter={0}i".format(counter + i) for i in range(count)])
+    lines = []
+    for i, row in enumerate(zip(*columns)):
+        lines.append(prefix + ",".join(x for x in row if x is not None) + " " +
+                     str(timestamp + 1 + i))
+    return lines
+
+
+class InfluxWriter:
+    def __init__(self,
+                 url: str,
+                 bucket: Optional[str] = None,
+                 org: Optional[str] = None,
+                 token: Optional[str] = None,
+                 database: Optional[str] = None,
+                 username: Optional[str] = None,
+                 password: Optional[str] = None,
+                 batch_size: int = BATCH_SIZE_DEFAULT,
+                 flush_interval: float = FLUSH_INTERVAL_DEFAULT,
+                 max_pending: int = MAX_PENDING_DEFAULT) -> None:
+        self.headers = {"Content-Type": "text/plain; charset=utf-8"}
+        if bucket is not None:
+            params = {"bucket": bucket, "precision": "s"}
+            if org:
+                params["org"] = org
+            if token:
+                self.headers["Authorization"] = "Token " + token
+            path = "/api/v2/write"
+        else:
+            params = {"db": database or DATABASE_DEFAULT, "precision": "s"}
+            if username:
+                params["u"] = username
+            if password:
+                params["p"] = password
+            path = "/write"
+        self.write_url = url.rstrip("/") + path + "?" + urllib.parse.urlencode(params)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+
+        # pending holds (queued time, lines) units; a unit is never split
+        # across requests, but several may be combined into one.
+        self.pending = collections.deque()
+        self.pending_lines = 0
+        self.sent_lines = 0
+        self.dropped_lines = 0
+        self.rejected_lines = 0
+        self.failed_requests = 0
+        self._lock = threading.Condition()
+        self._closing = False
+        self._drop_warned = False
+        self._thread = threading.Thread(target=self._run, name="influx-writer", daemon=True)
+        self._thread.start()
+
+    def write(self, lines: Iterable[str]) -> None:
+        # Never blocks on the database; drops the oldest lines when full.
+        lines = list(lines)
+        if not lines:
+            return
+        with self._lock:
+            self.pending.append((time.monotonic(), lines))
+            self.pending_lines += len(lines)
+            while self.pending_lines > self.max_pending and len(self.pending) > 1:
+                self._drop(self.pending.popleft()[1])
+            # wake the writer to start timing a new batch, or send a full one
+            if len(self.pending) == 1 or self.pending_lines >= self.batch_size:
+                self._lock.notify()
+
+    def _drop(self, lines: List[str]) -> None:
+        self.pending_lines -= len(lines)
+        self.dropped_lines += len(lines)
+        if not self._drop_warned:
+            logging.warning("InfluxDB write queue full, dropping oldest points")
+            self._drop_warned = True
+
+    def close(self, timeout: Optional[float] = REQUEST_TIMEOUT) -> None:
+        # Gives up on points that could not be written within timeout seconds
+        with self._lock:
+            self._closing = True
+            self._lock.notify_all()
+        self._thread.join(timeout)
+        with self._lock:
+            if self.pending_lines:
+                logging.error("Failed writing %d points to InfluxDB", self.pending_lines)
+
+    def _take_batch(self) -> List[List[str]]:
+        units = []
+        count = 0
+        for _, lines in self.pending:
+            if units and count + len(lines) > self.batch_size:
+                break
+            units.append(lines)
+            count += len(lines)
+        return units
+
+    def _run(self) -> None:
+        delay = 0.0
+        while True:
+            with self._lock:
+                while True:
+                    if self.pending:
+                        full = self._closing or self.pending_lines >= self.batch_size
+                        wait = max(self.flush_interval, delay)
+                        wait += self.pending[0][0] - time.monotonic()
+                        if full and not delay or wait <= 0:
+                            break
+                    elif self._closing:
+                        return
+                    else:
+                        wait = None
+                    self._lock.wait(wait)
+                units = self._take_batch()
+
+            result = self._post(units)
+
+            with self._lock:
+                if result == POST_RETRY:
+                    # hold the batch back for the retry delay
+                    self.failed_requests += 1
+                    delay = min(max(delay * 2, 1.0), RETRY_DELAY_MAX)
+                    if self.pending and self.pending[0][1] is units[0]:
+                        self.pending[0] = (time.monotonic(), units[0])
+                    continue
+                delay = 0.0
+                self._drop_warned = False
+                # the sent units are still at the head of the queue, unless
+                # write() dropped some of them meanwhile
+                for lines in units:
+                    if self.pending and self.pending[0][1] is lines:
+                        self.pending.popleft()
+                        self.pending_lines -= len(lines)
+                        if result == POST_REJECTED:
+                            self.rejected_lines += len(lines)
+                        else:
+                            self.sent_lines += len(lines)
+
+    def _post(self, units: List[List[str]]) -> int:
+        # Returns POST_SENT, POST_RETRY if the request should be retried
+        # later, or POST_REJECTED if the database refused the points
+        data = "\n".join(line for lines in units for line in lines).encode("utf-8")
+        request = urllib.request.Request(self.write_url, data=data, headers=self.headers)
+        try:
+            with urllib.request.urlopen(request, timeout=REQUEST_TIMEOUT) as response:
+                response.read()
+            return POST_SENT
+        except urllib.error.HTTPError as e:
+            if e.code == 429 or e.code >= 500:
+                logging.warning("InfluxDB write failed, will retry: %s", str(e))
+                return POST_RETRY
+            # retrying a rejected batch would only fail again
+            logging.error("InfluxDB rejected %d points: %s %s", sum(len(x) for x in units), str(e),
+                          e.read().decode("utf-8", "replace").strip())
+            return POST_REJECTED
+        except (urllib.error.URLError, OSError) as e:
+            logging.warning("InfluxDB write failed, will retry: %s", str(e))
+            return POST_RETRY
+
+
+def parse_args():
+    parser = com2.create_arg_parser(output_description="write it to an InfluxDB database")
+
+    group = parser.add_argument_group(title="InfluxDB database options")
+    group.add_argument("-U",
+                       "--url",
+                       default=os.environ.get("INFLUXDB_URL", URL_DEFAULT),
+                       help="URL of the InfluxDB server, default: " + URL_DEFAULT)
+    group.add_argument("-B",
+                       "--bucket",
+                       default=os.environ.get("INFLUXDB_BUCKET"),
+                       help="InfluxDB 2.x bucket to write to; if not set, write to an InfluxDB "
+                       "1.x database instead")
+    group.add_argument("--org",
+                       default=os.environ.get("INFLUXDB_ORG"),
+                       help="InfluxDB 2.x organization")
+    group.add_argument("-T",
+                       "--token",
+                       default=os.environ.get("INFLUXDB_TOKEN"),
+                       help="InfluxDB 2.x API token")
+    group.add_argument("-D",
+                       "--database",
+                       default=os.environ.get("INFLUXDB_DB", DATABASE_DEFAULT),
+                       help="InfluxDB 1.x database name, default: " + DATABASE_DEFAULT)
+    group.add_argument("-u",
+                       "--username",
+                       default=os.environ.get("INFLUXDB_USER"),
+                       help="InfluxDB 1.x user name")
+    group.add_argument("-p",
+                       "--password",
+                       default=os.environ.get("INFLUXDB_PWD"),
+                       help="InfluxDB 1.x password")
+    group.add_argument("--batch-size",
+                       type=int,
+                       default=BATCH_SIZE_DEFAULT,
+                       help="Maximum number of points per write request, default: " +
+                       str(BATCH_SIZE_DEFAULT))
+    group.add_argument("--flush-interval",
+                       type=float,
+                       default=FLUSH_INTERVAL_DEFAULT,
+                       help="Maximum number of seconds to hold points before writing them, "
+                       "default: " + str(FLUSH_INTERVAL_DEFAULT))
+    group.add_argument("--max-pending",
+                       type=int,
+                       default=MAX_PENDING_DEFAULT,
+                       help="Maximum number of points to keep queued while the database is "
+                       "unreachable before dropping the oldest, default: " +
+                       str(MAX_PENDING_DEFAULT))
+
+    opts = com2.run_arg_parser(parser, need_id=True)
+
+    if opts.batch_size < 1:
+        parser.error("Batch size must be 1 or greater")
+    if opts.flush_interval < 0.0:
+        parser.error("Flush interval must be 0 or greater")
+    if opts.max_pending < opts.batch_size:
+        parser.error("Max pending must be at least the batch size")
+
+    return opts
+
+
+def dish_tags(opts, gstate) -> str:
+    return format_tags({
+        "id": gstate.dish_id,
+        "target": gstate.target if opts.multi_target else None,
+    })
+
+
+def loop_body(opts, gstate, writer, shutdown=False):
+    fields = {category: {} for category in MEASUREMENTS if category != "history"}
+    lines = []
+
+    def cb_add_item(key, val, category):
+        fields[category][key] = val
+
+    def cb_add_sequence(key, val, category, start):
+        for i, subval in enumerate(val, start=start):
+            fields[category]["{0}_{1}".format(key, i)] = subval
+
+    def cb_add_bulk(bulk, count, timestamp, counter):
+        if count:
+            lines.extend(
+                encode_bulk(MEASUREMENTS["history"], dish_tags(opts, gstate), bulk, count,
+                            timestamp, counter))
+
+    rc, status_ts, hist_ts = com2.get_data(opts,
+                                           gstate,
+                                           cb_add_item,
+                                           cb_add_sequence,
+                                           add_bulk=cb_add_bulk,
+                                           flush_history=shutdown)
+
+    tags = dish_tags(opts, gstate)
+    for category, category_fields in fields.items():
+        timestamp = status_ts if category == "status" else hist_ts
+        if category_fields and timestamp is not None:
+            line = encode_line(MEASUREMENTS[category], tags, category_fields, timestamp)
+            if line is not None:
+                lines.append(line)
+
+    if lines:
+        writer.write(lines)
+        if opts.verbose:
+            print("Queued {0} points{1}".format(
+                len(lines), " for " + gstate.target if opts.multi_target else ""))
+
+    return rc
+
+
+def loop_all(opts, gstates, writer, executor, shutdown=False):
+    rc = 0
+    for poll_rc in com2.map_states(
+            lambda gstate: loop_body(opts, gstate, writer, shutdown=shutdown), gstates, executor):
+        rc = poll_rc or rc
+    return rc
+
+
+def main():
+    opts = parse_args()
+
+    logging.basicConfig(format="%(levelname)s: %(message)s")
+
+    writer = InfluxWriter(opts.url,
+                          bucket=opts.bucket,
+                          org=opts.org,
+                          token=opts.token,
+                          database=opts.database,
+                          username=opts.username,
+                          password=opts.password,
+                          batch_size=opts.batch_size,
+                          flush_interval=opts.flush_interval,
+                          max_pending=opts.max_pending)
+    gstates = com2.create_states(opts)
+    signal.signal(signal.SIGTERM, handle_sigterm)
+
+    executor = com2.create_executor(opts)
+    rc = 0
+    scheduler = com2.TickScheduler(opts, gstates)
+    try:
+        while True:
+            scheduler.start_tick()
+            rc = loop_all(opts, gstates, writer, executor)
+            if opts.loop_interval > 0.0:
+                scheduler.sleep()
+            else:
+                break
+    except (KeyboardInterrupt, Terminated):
+        pass
+    finally:
+        loop_all(opts, gstates, writer, executor, shutdown=True)
+        if executor is not None:
+            executor.shutdown()
+        for gstate in gstates:
+            gstate.shutdown()
+        writer.close()
+        if opts.verbose:
+            print(scheduler.report())
+            print("Points written: {0}, dropped: {1}, rejected: {2}, failed requests: {3}".format(
+                writer.sent_lines, writer.dropped_lines, writer.rejected_lines,
+                writer.failed_requests))
+        if writer.pending_lines:
+            rc = rc or 1
+
+    sys.exit(rc)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+"""Compact archive of dish obstruction maps over time.
+
+Maps are appended to a single file as a series of records. A keyframe holds
+a whole map; a delta holds only the cells that changed since the previous
+record, as index gaps and new values. Both kinds are zlib compressed. A new
+keyframe is written every KEYFRAME_INTERVAL records, when the map size
+changes, or when a delta would not be much smaller than a keyframe. Polls
+that return an unchanged map add nothing.
+
+To read the map as of any time, the archive decodes the nearest keyframe at
+or before that time and applies the deltas that follow it. Record offsets
+are indexed in memory when the file is opened, and the last decoded map is
+kept, so reading forward through time only applies the new deltas.
+"""
+
+from array import array
+import bisect
+from itertools import chain
+import os
+import struct
+import sys
+import zlib
+from typing import List, Optional, Tuple
+
+import com1
+
+FILE_MAGIC = b"SLOBSMAP"
+ARCHIVE_VERSION = 1
+KEYFRAME_INTERVAL = 256
+# write a keyframe instead when a delta is at least this fraction of its size
+KEYFRAME_RATIO = 0.5
+COMPRESS_LEVEL = 6
+
+_FILE_HEADER = struct.Struct("<8sH")
+# kind, timestamp, payload length, payload crc32
+_RECORD_HEADER = struct.Struct("<BqII")
+_DIMENSIONS = struct.Struct("<HH")
+KEYFRAME = 0
+DELTA = 1
+
+
+def _flat_map(snr_map) -> Tuple[int, int, array]:
+    if com1.np is not None and isinstance(snr_map, com1.np.ndarray):
+        rows, cols = snr_map.shape
+        flat = array("f")
+        flat.frombytes(com1.np.ascontiguousarray(snr_map, dtype=com1.np.float32).tobytes())
+        return rows, cols, flat
+    rows = len(snr_map)
+    cols = len(snr_map[0]) if rows else 0
+    return rows, cols, array("f", chain.from_iterable(snr_map))
+
+
+def _little_endian(data: array) -> bytes:
+    if sys.byteorder != "little":
+        data = array(data.typecode, data)
+        data.byteswap()
+    return data.tobytes()
+
+
+def _from_little_endian(typecode: str, data: bytes) -> array:
+    result = array(typecode)
+    result.frombytes(data)
+    if sys.byteorder != "little":
+        result.byteswap()
+    return result
+
+
+def _changed_cells(prev: array, flat: array) -> Tuple[array, array]:
+    # Returns the gaps between changed cell indexes, and their new values
+    if com1.np is not None:
+        np = com1.np
+        new = np.frombuffer(flat, dtype=np.float32)
+        indices = np.flatnonzero(np.frombuffer(prev, dtype=np.float32) != new)
+        gaps = np.diff(indices, prepend=-1).astype(np.uint32)
+        return array("I", gaps.tobytes()), array("f", new[indices].tobytes())
+    gaps = array("I")
+    values = array("f")
+    last = -1
+    for i, (old, new) in enumerate(zip(prev, flat)):
+        if old != new:
+            gaps.append(i - last)
+            values.append(new)
+            last = i
+    return gaps, values
+
+
+def _apply_delta(flat: array, gaps: array, values: array) -> None:
+    if com1.np is not None:
+        np = com1.np
+        indices = np.cumsum(np.frombuffer(gaps, dtype=np.uint32), dtype=np.int64) - 1
+        np.frombuffer(flat, dtype=np.float32)[indices] = np.frombuffer(values, dtype=np.float32)
+        return
+    cell = -1
+    for gap, value in zip(gaps, values):
+        cell += gap
+        flat[cell] = value
+
+
+class MapArchive:
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.times: List[int] = []
+        self.offsets: List[int] = []
+        self.kinds: List[int] = []
+        self._file = open(path, "r+b" if os.path.exists(path) else "w+b")
+        self._scan()
+        # last decoded record, as (index, rows, cols, flat map)
+        self._decoded: Optional[Tuple[int, int, int, array]] = None
+
+    def _scan(self) -> None:
+        header = self._file.read(_FILE_HEADER.size)
+        if not header:
+            self._file.write(_FILE_HEADER.pack(FILE_MAGIC, ARCHIVE_VERSION))
+            self._file.flush()
+            self._end = _FILE_HEADER.size
+            return
+        if len(header) < _FILE_HEADER.size or _FILE_HEADER.unpack(header) != (FILE_MAGIC,
+                                                                             ARCHIVE_VERSION):
+            raise ValueError("Incompatible obstruction map archive: " + self.path)
+        offset = _FILE_HEADER.size
+        while True:
+            record = self._file.read(_RECORD_HEADER.size)
+            if len(record) < _RECORD_HEADER.size:
+                break
+            kind, timestamp, length, crc = _RECORD_HEADER.unpack(record)
+            payload = self._file.read(length)
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                break
+            self.times.append(timestamp)
+            self.offsets.append(offset)
+            self.kinds.append(kind)
+            offset += _RECORD_HEADER.size + length
+        # drop whatever an interrupted append left behind
+        self._file.truncate(offset)
+        self._end = offset
+
+    def close(self) -> None:
+        self._file.close()
+
+    def __enter__(self) -> "MapArchive":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self.times)
+
+    def _read(self, index: int) -> Tuple[int, bytes]:
+        self._file.seek(self.offsets[index])
+        kind, _, length, _ = _RECORD_HEADER.unpack(self._file.read(_RECORD_HEADER.size))
+        return kind, zlib.decompress(self._file.read(length))
+
+    def _write(self, kind: int, timestamp: int, payload: bytes) -> None:
+        self._file.seek(self._end)
+        self._file.write(_RECORD_HEADER.pack(kind, timestamp, len(payload), zlib.crc32(payload)))
+        self._file.write(payload)
+        self._file.flush()
+        self.times.append(timestamp)
+        self.offsets.append(self._end)
+        self.kinds.append(kind)
+        self._end += _RECORD_HEADER.size + len(payload)
+
+    def append(self, snr_map, timestamp: int) -> bool:
+        # snr_map is as returned by com1.obstruction_map; timestamps must not
+        # go backwards. Returns whether anything was written.
+        if self.times and timestamp < self.times[-1]:
+            raise ValueError("Obstruction map timestamp is before the last one archived")
+        rows, cols, flat = _flat_map(snr_map)
+        keyframe = _DIMENSIONS.pack(rows, cols) + _little_endian(flat)
+
+        last = self._decode(len(self.times) - 1) if self.times else None
+        if last is not None and last[:2] == (rows, cols) and last[2] == flat:
+            return False
+        since_key = len(self.kinds) - 1 - self._keyframe_index(len(self.kinds) - 1)
+        if last is not None and last[:2] == (rows, cols) and since_key < KEYFRAME_INTERVAL - 1:
+            gaps, values = _changed_cells(last[2], flat)
+            delta = struct.pack("<I", len(gaps)) + _little_endian(gaps) + _little_endian(values)
+            if len(delta) < len(keyframe) * KEYFRAME_RATIO:
+                self._write(DELTA, timestamp, zlib.compress(delta, COMPRESS_LEVEL))
+                self._decoded = (len(self.times) - 1, rows, cols, flat)
+                return True
+
+        self._write(KEYFRAME, timestamp, zlib.compress(keyframe, COMPRESS_LEVEL))
+        self._decoded = (len(self.times) - 1, rows, cols, flat)
+        return True
+
+    def append_map_data(self, map_data, timestamp: int) -> bool:
+        # map_data is a com1.get_obstruction_map response
+        return self.append(com1.obstruction_map(map_data=map_data, as_array=com1.np is not None),
+                           timestamp)
+
+    def _keyframe_index(self, index: int) -> int:
+        while index > 0 and self.kinds[index] != KEYFRAME:
+            index -= 1
+        return index
+
+    def _decode(self, index: int) -> Tuple[int, int, array]:
+        if self._decoded is not None and self._decoded[0] == index:
+            return self._decoded[1:]
+        start = self._keyframe_index(index)
+        if self._decoded is not None and start <= self._decoded[0] < index:
+            # carry on from the last decoded map instead of its keyframe
+            start, rows, cols, flat = self._decoded
+            flat = array("f", flat)
+            start += 1
+        else:
+            kind, payload = self._read(start)
+            rows, cols = _DIMENSIONS.unpack_from(payload)
+            flat = _from_little_endian("f", payload[_DIMENSIONS.size:])
+            start += 1
+        for i in range(start, index + 1):
+            kind, payload = self._read(i)
+            count = struct.unpack_from("<I", payload)[0]
+            gaps = _from_little_endian("I", payload[4:4 + count*4])
+            values = _from_little_endian("f", payload[4 + count*4:])
+            _apply_delta(flat, gaps, values)
+        self._decoded = (index, rows, cols, flat)
+        return rows, cols, flat
+
+    def index_at(self, timestamp: int) -> Optional[int]:
+        # Index of the last record at or before timestamp
+        index = bisect.bisect_right(self.times, timestamp) - 1
+        return index if index >= 0 else None
+
+    def obstruction_map(self, timestamp: int, as_array: bool = False):
+        # The map as of timestamp, in the same forms com1.obstruction_map
+        # returns, or None if nothing was archived by then
+        if as_array and com1.np is None:
+            raise ImportError("NumPy is required for obstruction map arrays")
+        index = self.index_at(timestamp)
+        if index is None:
+            return None
+        rows, cols, flat = self._decode(index)
+        if as_array:
+            return com1.np.frombuffer(flat, dtype=com1.np.float32).reshape(rows, cols).copy()
+        return tuple(flat[i:i + cols] for i in range(0, rows * cols, cols))
@@ -0,0 +1,306 @@
+#!/usr/bin/python3
+"""Publish Starlink user terminal data to an MQTT broker.
+
+Each dish gets its own topics, under starlink/dish_<category>/<dish id>/.
+By default every field is published as its own message; with --json, each
+category from one poll is sent as a single JSON object instead.
+
+Messages are handed to a bounded outbound queue and published from a
+background thread, so a slow or unreachable broker never holds up dish
+polling. The queue keeps only the newest unsent message for each topic, and
+once --max-queued topics are waiting the oldest are dropped.
+"""
+
+import collections
+import json
+import logging
+import signal
+import ssl
+import sys
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+import com2
+
+HOST_DEFAULT = "localhost"
+PORT_DEFAULT = 1883
+KEEPALIVE_DEFAULT = 60
+MAX_QUEUED_DEFAULT = 10000
+MAX_INFLIGHT = 20
+
+
+class Terminated(Exception):
+    pass
+
+
+def handle_sigterm(signum, frame):
+    raise Terminated
+
+
+def _create_client(client_id):
+    # paho-mqtt 2.x requires choosing a callback API version
+    if hasattr(mqtt, "CallbackAPIVersion"):
+        return mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=client_id)
+    return mqtt.Client(client_id=client_id)
+
+
+class MqttPublisher:
+    def __init__(self, client, qos=0, retain=False, max_queued=MAX_QUEUED_DEFAULT):
+        self.client = client
+        self.qos = qos
+        self.retain = retain
+        self.max_queued = max_queued
+
+        # topic -> payload, oldest first
+        self.pending = collections.OrderedDict()
+        self.inflight = set()
+        self._early = set()
+        self.connected = False
+        self.published = 0
+        self.merged = 0
+        self.dropped = 0
+        self._lock = threading.Condition()
+        self._closing = False
+
+        client.max_inflight_messages_set(MAX_INFLIGHT)
+        # callback arguments differ between paho-mqtt versions, so extra ones are ignored
+        client.on_connect = self._connected
+        client.on_disconnect = lambda *args: self._set_connected(False)
+        client.on_publish = lambda client, userdata, mid, *args: self._published(mid)
+        self._thread = threading.Thread(target=self._run, name="mqtt-publisher", daemon=True)
+        self._thread.start()
+
+    def _connected(self, client, userdata, flags, reason_code, *args):
+        # paho-mqtt 2.x passes a ReasonCode, 1.x an int that is 0 on success
+        if getattr(reason_code, "is_failure", reason_code != 0):
+            logging.error("MQTT broker refused connection: %s", str(reason_code))
+            return
+        self._set_connected(True)
+
+    def _set_connected(self, connected):
+        with self._lock:
+            self.connected = connected
+            if not connected and not self.qos:
+                # paho resends unacknowledged QoS 1 and 2 messages itself
+                # after reconnecting, but QoS 0 ones are lost
+                self.inflight.clear()
+            self._lock.notify_all()
+
+    def _published(self, mid):
+        with self._lock:
+            if mid in self.inflight:
+                self.inflight.discard(mid)
+                self.published += 1
+            else:
+                # acknowledged before _run got to record it
+                self._early.add(mid)
+            self._lock.notify_all()
+
+    def publish(self, messages):
+        # Never blocks on the broker; messages is a list of (topic, payload)
+        with self._lock:
+            for topic, payload in messages:
+                if self.pending.pop(topic, None) is not None:
+                    self.merged += 1
+                self.pending[topic] = payload
+            while len(self.pending) > self.max_queued:
+                self.pending.popitem(last=False)
+                self.dropped += 1
+            self._lock.notify_all()
+
+    def close(self, timeout=10.0):
+        # Gives up on messages that could not be published within timeout seconds
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            self._closing = True
+            self._lock.notify_all()
+            while self.pending or self.inflight:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._lock.wait(remaining)
+            unsent = len(self.pending) + len(self.inflight)
+        if unsent:
+            logging.error("Failed publishing %d MQTT messages", unsent)
+
+    def _run(self):
+        # client.publish() is called without holding the lock, as paho may
+        # call back into _published() from its network thread meanwhile.
+        while True:
+            with self._lock:
+                while not (self.pending and self.connected and len(self.inflight) < MAX_INFLIGHT):
+                    if self._closing and not self.pending:
+                        return
+                    self._lock.wait()
+                topic, payload = self.pending.popitem(last=False)
+            info = self.client.publish(topic, payload, qos=self.qos, retain=self.retain)
+            with self._lock:
+                # paho keeps QoS 1 and 2 messages to send once connected
+                queued = self.qos and info.rc == mqtt.MQTT_ERR_NO_CONN
+                if info.rc == mqtt.MQTT_ERR_SUCCESS or queued:
+                    if info.mid in self._early:
+                        self._early.discard(info.mid)
+                        self.published += 1
+                    else:
+                        self.inflight.add(info.mid)
+                elif info.rc == mqtt.MQTT_ERR_NO_CONN:
+                    # disconnected since the check, so try again after reconnecting
+                    if topic not in self.pending:
+                        self.pending[topic] = payload
+                        self.pending.move_to_end(topic, last=False)
+                    self.connected = False
+                else:
+                    self.dropped += 1
+
+
+def parse_args():
+    parser = com2.create_arg_parser(output_description="publish it to a MQTT broker",
+                                    bulk_history=False)
+
+    group = parser.add_argument_group(title="MQTT broker options")
+    group.add_argument("-n",
+                       "--hostname",
+                       default=HOST_DEFAULT,
+                       help="Hostname of MQTT broker, default: " + HOST_DEFAULT)
+    group.add_argument("-p",
+                       "--port",
+                       type=int,
+                       help="Port number to use on MQTT broker, default: " + str(PORT_DEFAULT) +
+                       ", or 8883 with --tls")
+    group.add_argument("-P", "--password", help="Set password for username/password authentication")
+    group.add_argument("-U", "--username", help="Set username for authentication")
+    group.add_argument("-k",
+                       "--keepalive",
+                       type=int,
+                       default=KEEPALIVE_DEFAULT,
+                       help="Seconds between MQTT keepalive pings, default: " +
+                       str(KEEPALIVE_DEFAULT))
+    group.add_argument("--tls", action="store_true", help="Use a TLS connection to the broker")
+    group.add_argument("-C",
+                       "--ca-cert",
+                       help="CA certificate file for verifying the broker's certificate with "
+                       "--tls, default: the system CA certificates",
+                       metavar="FILE")
+    group.add_argument("-q",
+                       "--qos",
+                       type=int,
+                       choices=[0, 1, 2],
+                       default=0,
+                       help="MQTT quality of service level for published messages, default: 0")
+    group.add_argument("-r",
+                       "--retain",
+                       action="store_true",
+                       help="Set the retain flag on published messages")
+    group.add_argument("-J",
+                       "--json",
+                       action="store_true",
+                       help="Publish each category of data from a poll as a single JSON object "
+                       "instead of one message per field")
+    group.add_argument("--max-queued",
+                       type=int,
+                       default=MAX_QUEUED_DEFAULT,
+                       help="Maximum number of messages waiting to be published before the "
+                       "oldest are dropped, default: " + str(MAX_QUEUED_DEFAULT))
+
+    opts = com2.run_arg_parser(parser, need_id=True)
+
+    if opts.max_queued < 1:
+        parser.error("Max queued must be 1 or greater")
+    if opts.port is None:
+        opts.port = 8883 if opts.tls else PORT_DEFAULT
+
+    return opts
+
+
+def loop_body(opts, gstate, publisher, shutdown=False):
+    data = collections.defaultdict(dict)
+
+    def cb_add_item(key, val, category):
+        data[category][key] = val
+
+    def cb_add_sequence(key, val, category, start):
+        data[category][key] = list(val)
+
+    rc = com2.get_data(opts, gstate, cb_add_item, cb_add_sequence, flush_history=shutdown)[0]
+
+    messages = []
+    for category, fields in data.items():
+        topic = "starlink/dish_{0}/{1}".format(category, gstate.dish_id)
+        if opts.json:
+            messages.append((topic, json.dumps(fields)))
+            continue
+        for key, val in fields.items():
+            if isinstance(val, list):
+                val = ",".join("" if x is None else str(x) for x in val)
+            messages.append((topic + "/" + key, "" if val is None else str(val)))
+
+    if messages:
+        publisher.publish(messages)
+        if opts.verbose:
+            print("Queued {0} messages{1}".format(
+                len(messages), " for " + gstate.target if opts.multi_target else ""))
+
+    return rc
+
+
+def loop_all(opts, gstates, publisher, executor, shutdown=False):
+    rc = 0
+    for poll_rc in com2.map_states(
+            lambda gstate: loop_body(opts, gstate, publisher, shutdown=shutdown), gstates,
+            executor):
+        rc = poll_rc or rc
+    return rc
+
+
+def main():
+    opts = parse_args()
+
+    logging.basicConfig(format="%(levelname)s: %(message)s")
+
+    client = _create_client("starlink-grpc-{0}".format(int(time.time() * 1000) % 1000000))
+    if opts.username is not None:
+        client.username_pw_set(opts.username, password=opts.password)
+    if opts.tls:
+        client.tls_set(ca_certs=opts.ca_cert, cert_reqs=ssl.CERT_REQUIRED)
+    publisher = MqttPublisher(client, qos=opts.qos, retain=opts.retain, max_queued=opts.max_queued)
+    # connect in the background, so an unreachable broker doesn't delay polling
+    client.connect_async(opts.hostname, port=opts.port, keepalive=opts.keepalive)
+    client.loop_start()
+
+    gstates = com2.create_states(opts)
+    signal.signal(signal.SIGTERM, handle_sigterm)
+
+    executor = com2.create_executor(opts)
+    rc = 0
+    scheduler = com2.TickScheduler(opts, gstates)
+    try:
+        while True:
+            scheduler.start_tick()
+            rc = loop_all(opts, gstates, publisher, executor)
+            if opts.loop_interval > 0.0:
+                scheduler.sleep()
+            else:
+                break
+    except (KeyboardInterrupt, Terminated):
+        pass
+    finally:
+        loop_all(opts, gstates, publisher, executor, shutdown=True)
+        if executor is not None:
+            executor.shutdown()
+        for gstate in gstates:
+            gstate.shutdown()
+        publisher.close()
+        client.disconnect()
+        client.loop_stop()
+        if opts.verbose:
+            print(scheduler.report())
+            print("Messages published: {0}, merged: {1}, dropped: {2}".format(
+                publisher.published, publisher.merged, publisher.dropped))
+
+    sys.exit(rc)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+#!/usr/bin/python3
+"""Render the dish obstruction map as a PNG image.
+
+Each map point is colored from red for fully obstructed to green for clear,
+with points that have no data left transparent, or black with --no-alpha.
+
+Encoded images are cached by a hash of the map contents. The dish map
+changes slowly, so most polls in loop mode hit the cache and skip PNG
+encoding. An unchanged map also leaves the output file alone, so
+downstream tools watching the file only see real changes.
+"""
+
+import argparse
+from array import array
+import collections
+import hashlib
+import io
+from itertools import chain
+import logging
+import os
+import signal
+import sys
+import time
+from typing import Tuple
+
+import png
+
+import com1
+
+LOOP_TIME_DEFAULT = 0
+CACHE_SIZE = 8
+
+
+class Terminated(Exception):
+    pass
+
+
+def handle_sigterm(signum, frame):
+    raise Terminated
+
+
+def _content_key(snr_map, alpha: bool) -> Tuple[int, int, bytes]:
+    # float32 bytes either way, so array and tuple maps hash the same
+    if com1.np is not None and isinstance(snr_map, com1.np.ndarray):
+        height, width = snr_map.shape
+        data = com1.np.ascontiguousarray(snr_map, dtype=com1.np.float32).tobytes()
+    else:
+        height = len(snr_map)
+        width = len(snr_map[0]) if height else 0
+        data = array("f", chain.from_iterable(snr_map)).tobytes()
+    digest = hashlib.blake2b(data, digest_size=16)
+    digest.update(b"%d,%d,%d" % (width, height, alpha))
+    return width, height, digest.digest()
+
+
+def _pixel_rows(snr_map, alpha: bool):
+    if com1.np is not None and isinstance(snr_map, com1.np.ndarray):
+        np = com1.np
+        values = snr_map.astype(np.float64)
+        valid = values >= 0.0
+        clear = np.clip(values, 0.0, 1.0)
+        pixels = np.zeros(values.shape + (4 if alpha else 3,), dtype=np.uint8)
+        pixels[..., 0] = np.where(valid, np.rint((1.0-clear) * 255.0), 0)
+        pixels[..., 1] = np.where(valid, np.rint(clear * 255.0), 0)
+        if alpha:
+            pixels[..., 3] = np.where(valid, 255, 0)
+        return [row.tobytes() for row in pixels]
+
+    rows = []
+    for snr_row in snr_map:
+        row = bytearray()
+        for val in snr_row:
+            # NaN counts as no data, as in the NumPy path
+            if not val >= 0.0:
+                row.extend(b"\0\0\0\0" if alpha else b"\0\0\0")
+                continue
+            val = min(val, 1.0)
+            row.append(int(round((1.0-val) * 255.0)))
+            row.append(int(round(val * 255.0)))
+            row.extend(b"\0\xff" if alpha else b"\0")
+        rows.append(bytes(row))
+    return rows
+
+
+class ObstructionMapRenderer:
+    def __init__(self, alpha: bool = True, cache_size: int = CACHE_SIZE) -> None:
+        self.alpha = alpha
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+        self.last_key = None
+        self.pending_key = None
+        self.hits = 0
+        self.misses = 0
+
+    def render(self, snr_map) -> Tuple[bytes, bool]:
+        # Returns the PNG data and whether the map differs from the one last
+        # written, as recorded by written(). snr_map is as returned by
+        # com1.obstruction_map, either as a tuple of rows or as an array.
+        width, height, key = _content_key(snr_map, self.alpha)
+        changed = key != self.last_key
+        self.pending_key = key
+        data = self.cache.get(key)
+        if data is not None:
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return data, changed
+
+        self.misses += 1
+        writer = png.Writer(width, height, alpha=self.alpha, greyscale=False)
+        out = io.BytesIO()
+        writer.write_packed(out, _pixel_rows(snr_map, self.alpha))
+        data = out.getvalue()
+        self.cache[key] = data
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return data, changed
+
+    def written(self) -> None:
+        # Records that the map last rendered was written out, so an unchanged
+        # map is only skipped once a write of it has succeeded
+        self.last_key = self.pending_key
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Collect obstruction map data from a Starlink user terminal and emit it as a "
+        "PNG image")
+    parser.add_argument("filename",
+                        help="The image file to write, or - to write to stdout; in loop mode, "
+                        "the file is only rewritten when the map changes")
+    parser.add_argument("-g",
+                        "--target",
+                        help="host:port of dish to query, default is the standard IP address "
+                        "and port (192.168.100.1:9200)")
+    parser.add_argument("-a",
+                        "--archive",
+                        help="Also append each map to this obstruction map archive file",
+                        metavar="FILE")
+    parser.add_argument("-n",
+                        "--no-alpha",
+                        action="store_true",
+                        help="Draw points with no data in black instead of transparent")
+    parser.add_argument("-t",
+                        "--loop-interval",
+                        type=float,
+                        default=float(LOOP_TIME_DEFAULT),
+                        help="Loop interval in seconds or 0 for no loop, default: " +
+                        str(LOOP_TIME_DEFAULT))
+    parser.add_argument("--no-descriptor-cache",
+                        action="store_true",
+                        help="Always query the dish for its protocol descriptors instead of using "
+                        "the descriptor cache file")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Be verbose")
+
+    opts = parser.parse_args()
+    if opts.filename == "-" and opts.loop_interval > 0.0:
+        parser.error("Loop mode requires an output file")
+    if not opts.no_descriptor_cache:
+        com1.use_descriptor_cache()
+    return opts
+
+
+def write_image(opts, data):
+    if opts.filename == "-":
+        sys.stdout.buffer.write(data)
+        sys.stdout.buffer.flush()
+        return
+    # replace the file whole, so readers never see a partly written image
+    tmp_path = opts.filename + ".tmp"
+    with open(tmp_path, "wb") as out_file:
+        out_file.write(data)
+    os.replace(tmp_path, opts.filename)
+
+
+def loop_body(opts, context, renderer, archive=None):
+    try:
+        timestamp = int(time.time())
+        snr_map = com1.obstruction_map(context, as_array=com1.np is not None)
+    except com1.GrpcError as e:
+        logging.error("Failed getting obstruction map data: %s", str(e))
+        return 1
+    if not len(snr_map):
+        logging.error("Obstruction map data is empty")
+        return 1
+
+    if archive is not None:
+        try:
+            archive.append(snr_map, timestamp)
+        except (OSError, ValueError) as e:
+            logging.error("Failed writing obstruction map archive: %s", str(e))
+
+    data, changed = renderer.render(snr_map)
+    if changed:
+        try:
+            write_image(opts, data)
+        except OSError as e:
+            logging.error("Failed writing image file: %s", str(e))
+            return 1
+        renderer.written()
+    if opts.verbose:
+        print("Obstruction map " + ("written" if changed else "unchanged"), file=sys.stderr)
+    return 0
+
+
+def main():
+    opts = parse_args()
+
+    logging.basicConfig(format="%(levelname)s: %(message)s")
+
+    context = com1.ChannelContext(target=opts.target)
+    renderer = ObstructionMapRenderer(alpha=not opts.no_alpha)
+    archive = None
+    if opts.archive:
+        import com_maparchive
+        try:
+            archive = com_maparchive.MapArchive(opts.archive)
+        except (OSError, ValueError) as e:
+            logging.error("Failed opening obstruction map archive: %s", str(e))
+            sys.exit(1)
+    signal.signal(signal.SIGTERM, handle_sigterm)
+
+    rc = 0
+    try:
+        next_loop = time.monotonic()
+        while True:
+            rc = loop_body(opts, context, renderer, archive)
+            if opts.loop_interval > 0.0:
+                now = time.monotonic()
+                next_loop = max(next_loop + opts.loop_interval, now)
+                time.sleep(next_loop - now)
+            else:
+                break
+    except (KeyboardInterrupt, Terminated):
+        pass
+    finally:
+        context.close()
+        if archive is not None:
+            archive.close()
+
+    sys.exit(rc)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""Timing instrumentation for dish polling.
+
+When enabled, com1.call_with_channel records the latency of every dish
+request, and com2.get_data the time spent in each stage of a poll. Timings
+go into log-linear histograms, as used for ping latency (see com_sketch).
+Channel connects and reconnects, request errors, and the number of history
+samples processed per poll are counted too.
+
+Nothing is recorded unless enable() is called, as the --profile option of
+the scripts does. While disabled, each request and stage only checks
+whether com1.profiler is set.
+
+Exporters can read the numbers at any time with snapshot(); --profile
+prints summary() to stderr on exit.
+"""
+
+import sys
+import threading
+import time
+from typing import Dict, Optional
+
+import com1
+from com_sketch import LatencyHistogram
+
+# about 1.5% resolution, which is plenty for timings
+PRECISION = 7
+PERCENTILES = (50, 90, 99)
+
+
+class Profiler:
+    def __init__(self) -> None:
+        self.start_time = time.monotonic()
+        self.timings: Dict[str, LatencyHistogram] = {}
+        self.values: Dict[str, LatencyHistogram] = {}
+        self.totals: Dict[str, float] = {}
+        self.counters: Dict[str, int] = {}
+        # polls of multiple dishes record from several threads
+        self._lock = threading.Lock()
+
+    def _add(self, histograms: Dict[str, LatencyHistogram], name: str, value: float) -> None:
+        with self._lock:
+            histogram = histograms.get(name)
+            if histogram is None:
+                histogram = histograms[name] = LatencyHistogram(PRECISION)
+            histogram.add(value)
+            self.totals[name] = self.totals.get(name, 0.0) + value
+
+    def time(self, name: str, seconds: float) -> None:
+        self._add(self.timings, name, seconds * 1000.0)
+
+    def observe(self, name: str, value: float) -> None:
+        self._add(self.values, name, value)
+
+    def count(self, name: str, increment: int = 1) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + increment
+
+    def _summarize(self, name: str, histogram: LatencyHistogram) -> Dict:
+        summary = {
+            "count": histogram.count,
+            "total": self.totals[name],
+            "min": histogram.min,
+            "max": histogram.max,
+        }
+        for percent in PERCENTILES:
+            summary["p{0}".format(percent)] = histogram.percentile(percent)
+        return summary
+
+    def snapshot(self) -> Dict:
+        # Timings are in milliseconds
+        with self._lock:
+            return {
+                "seconds": time.monotonic() - self.start_time,
+                "timings": {
+                    name: self._summarize(name, histogram)
+                    for name, histogram in sorted(self.timings.items())
+                },
+                "values": {
+                    name: self._summarize(name, histogram)
+                    for name, histogram in sorted(self.values.items())
+                },
+                "counters": dict(sorted(self.counters.items())),
+            }
+
+    def summary(self) -> str:
+        snapshot = self.snapshot()
+        columns = (("count", "total", "min") + tuple("p{0}".format(p) for p in PERCENTILES) +
+                   ("max",))
+        lines = ["Profile of {0:.1f} seconds".format(snapshot["seconds"])]
+        for title, group in (("Timings (ms)", "timings"), ("Values", "values")):
+            if not snapshot[group]:
+                continue
+            width = max(len(name) for name in snapshot[group])
+            lines.append("")
+            lines.append(title.ljust(width) + "".join("{0:>11}".format(c) for c in columns))
+            for name, summary in snapshot[group].items():
+                lines.append(name.ljust(width) + "{0:>11}".format(summary["count"]) +
+                             "".join("{0:>11.3f}".format(summary[c]) for c in columns[1:]))
+        if snapshot["counters"]:
+            lines.append("")
+            lines.append("Counters")
+            for name, value in snapshot["counters"].items():
+                lines.append("{0}: {1}".format(name, value))
+        return "\n".join(lines)
+
+
+def enable() -> Profiler:
+    if com1.profiler is None:
+        com1.profiler = Profiler()
+    return com1.profiler
+
+
+def disable() -> None:
+    com1.profiler = None
+
+
+def get() -> Optional[Profiler]:
+    return com1.profiler
+
+
+def timed(name: str, function, *args, **kwargs):
+    # Calls function, recording how long it takes if profiling is enabled
+    profiler = com1.profiler
+    if profiler is None:
+        return function(*args, **kwargs)
+    start = time.perf_counter()
+    try:
+        return function(*args, **kwargs)
+    finally:
+        profiler.time(name, time.perf_counter() - start)
+
+
+def observe(name: str, value: float) -> None:
+    profiler = com1.profiler
+    if profiler is not None:
+        profiler.observe(name, value)
+
+
+def count(name: str, increment: int = 1) -> None:
+    profiler = com1.profiler
+    if profiler is not None:
+        profiler.count(name, increment)
+
+
+def print_summary(file=None) -> None:
+    profiler = com1.profiler
+    if profiler is not None:
+        print(profiler.summary(), file=sys.stderr if file is None else file)
@@ -0,0 +1,270 @@
+#!/usr/bin/python3
+"""Serve Starlink user terminal data as Prometheus metrics over HTTP.
+
+Dishes are polled on the exporter's own schedule, set by --loop-interval,
+rather than once per scrape. After each round of polls the complete /metrics
+response is rendered once, along with a gzip compressed copy, and published
+as an immutable snapshot. Scrapes are answered from the current snapshot
+without making any dish requests, however many scrapers there are.
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import gzip
+from itertools import chain
+import logging
+import math
+import signal
+import sys
+import threading
+import time
+from typing import Dict, List, NamedTuple, Tuple
+
+import com2
+import com_profile
+
+ADDRESS_DEFAULT = "0.0.0.0"
+PORT_DEFAULT = 9148
+LOOP_TIME_DEFAULT = 15.0
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+PREFIX = "starlink_"
+
+
+class Terminated(Exception):
+    pass
+
+
+def handle_sigterm(signum, frame):
+    raise Terminated
+
+
+class Snapshot(NamedTuple):
+    body: bytes
+    gzip_body: bytes
+    timestamp: float
+
+
+def _escape_label(val) -> str:
+    return str(val).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join('{0}="{1}"'.format(key, _escape_label(val))
+                          for key, val in labels) + "}"
+
+
+def _format_value(val) -> str:
+    if isinstance(val, bool):
+        return "1" if val else "0"
+    if isinstance(val, int):
+        return str(val)
+    if math.isnan(val):
+        return "NaN"
+    if math.isinf(val):
+        return "+Inf" if val > 0 else "-Inf"
+    return repr(val)
+
+
+class DishMetrics:
+    # Latest data from one dish, kept per category, as only categories with
+    # new data are replaced by each poll.
+    def __init__(self, target: str) -> None:
+        self.target = target
+        self.categories: Dict[str, Dict] = {}
+        self.up = 0
+        self.poll_seconds = 0.0
+        self.last_success = None
+
+    def samples(self, multi_target: bool, dish_id):
+        labels = (("id", dish_id or ""),)
+        if multi_target:
+            labels += (("target", self.target),)
+        yield "up", labels, self.up
+        yield "poll_duration_seconds", labels, self.poll_seconds
+        if self.last_success is not None:
+            yield "last_poll_success_timestamp_seconds", labels, self.last_success
+        for category, fields in self.categories.items():
+            info = []
+            for key, val in fields.items():
+                name = category + "_" + key
+                if isinstance(val, list):
+                    for i, subval in val:
+                        if isinstance(subval, (int, float)):
+                            yield name, labels + (("index", str(i)),), subval
+                elif isinstance(val, (int, float)):
+                    yield name, labels, val
+                elif val is not None:
+                    info.append((key, val))
+            # string fields become labels of a single info metric
+            if info:
+                yield category + "_info", labels + tuple(info), 1
+
+
+def profile_samples(snapshot: Dict):
+    # snapshot is from com_profile; timings are converted to seconds
+    for name, summary in snapshot["timings"].items():
+        labels = (("name", name),)
+        yield "profile_seconds_count", labels, summary["count"]
+        yield "profile_seconds_sum", labels, summary["total"] / 1000.0
+        for key, val in summary.items():
+            if key.startswith("p"):
+                quantile = str(int(key[1:]) / 100)
+                yield "profile_seconds", labels + (("quantile", quantile),), val / 1000.0
+    for name, summary in snapshot["values"].items():
+        labels = (("name", name),)
+        yield "profile_value_count", labels, summary["count"]
+        yield "profile_value_sum", labels, summary["total"]
+    for name, val in snapshot["counters"].items():
+        yield "profile_events", (("name", name),), val
+
+
+def scheduler_samples(scheduler, gstates):
+    yield "scheduler_ticks", (), scheduler.ticks
+    yield "scheduler_late_ticks", (), scheduler.late_ticks
+    yield "scheduler_missed_ticks", (), scheduler.missed_ticks
+    yield "scheduler_deferred_locations", (), sum(gstate.deferred_locations for gstate in gstates)
+
+
+def render(dishes: List[Tuple[DishMetrics, str]], multi_target: bool, extra=()) -> bytes:
+    # extra holds more samples, as (name, labels, value)
+    metrics: Dict[str, List[str]] = {}
+    samples = [dish.samples(multi_target, dish_id) for dish, dish_id in dishes]
+    for name, labels, val in chain(chain.from_iterable(samples), extra):
+        metrics.setdefault(name, []).append(
+            PREFIX + name + _format_labels(labels) + " " + _format_value(val))
+    lines = []
+    for name in sorted(metrics):
+        lines.append("# TYPE " + PREFIX + name + " gauge")
+        lines.extend(metrics[name])
+    lines.append("")
+    return "\n".join(lines).encode("utf-8")
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body go out in separate writes
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self._send(404, b"Not found; metrics are at /metrics\n", "text/plain")
+            return
+        # a single attribute read, so always a complete snapshot
+        snapshot = self.server.snapshot
+        if snapshot is None:
+            self._send(503, b"No data yet\n", "text/plain")
+        elif "gzip" in self.headers.get("Accept-Encoding", ""):
+            self._send(200, snapshot.gzip_body, CONTENT_TYPE, gzip_encoded=True)
+        else:
+            self._send(200, snapshot.body, CONTENT_TYPE)
+
+    def _send(self, code, body, content_type, gzip_encoded=False):
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if gzip_encoded:
+            self.send_header("Content-Encoding", "gzip")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+def parse_args():
+    parser = com2.create_arg_parser(output_description="serve it as Prometheus metrics over HTTP",
+                                    bulk_history=False)
+    parser.set_defaults(loop_interval=LOOP_TIME_DEFAULT)
+
+    group = parser.add_argument_group(title="HTTP server options")
+    group.add_argument("--address",
+                       default=ADDRESS_DEFAULT,
+                       help="IP address to listen on, default: " + ADDRESS_DEFAULT)
+    group.add_argument("-p",
+                       "--port",
+                       type=int,
+                       default=PORT_DEFAULT,
+                       help="Port to listen on, default: " + str(PORT_DEFAULT))
+
+    opts = com2.run_arg_parser(parser, need_id=True)
+
+    if opts.loop_interval <= 0.0:
+        parser.error("Loop interval must be greater than 0 for an exporter; the default is " +
+                     str(LOOP_TIME_DEFAULT))
+
+    return opts
+
+
+def poll(opts, gstate, dish):
+    categories = {}
+
+    def cb_add_item(key, val, category):
+        categories.setdefault(category, {})[key] = val
+
+    def cb_add_sequence(key, val, category, start):
+        categories.setdefault(category, {})[key] = list(enumerate(val, start=start))
+
+    start = time.monotonic()
+    rc = com2.get_data(opts, gstate, cb_add_item, cb_add_sequence)[0]
+    dish.poll_seconds = time.monotonic() - start
+    dish.categories.update(categories)
+    unreachable = categories.get("status", {}).get("state") == "DISH_UNREACHABLE"
+    dish.up = 0 if rc or unreachable else 1
+    if dish.up:
+        dish.last_success = time.time()
+    return rc
+
+
+def main():
+    opts = parse_args()
+
+    logging.basicConfig(format="%(levelname)s: %(message)s")
+
+    gstates = com2.create_states(opts)
+    dishes = [DishMetrics(gstate.target) for gstate in gstates]
+    try:
+        server = ThreadingHTTPServer((opts.address, opts.port), MetricsHandler)
+    except OSError as e:
+        logging.error("Failed starting HTTP server: %s", str(e))
+        sys.exit(1)
+    server.daemon_threads = True
+    server.snapshot = None
+    server.verbose = opts.verbose
+    threading.Thread(target=server.serve_forever, name="http-server", daemon=True).start()
+    signal.signal(signal.SIGTERM, handle_sigterm)
+
+    executor = com2.create_executor(opts)
+    scheduler = com2.TickScheduler(opts, gstates)
+    try:
+        while True:
+            scheduler.start_tick()
+            com_profile.timed("tick", com2.map_states, lambda args: poll(opts, *args),
+                              list(zip(gstates, dishes)), executor)
+            scheduler.end_tick()
+            extra = [scheduler_samples(scheduler, gstates)]
+            profiler = com_profile.get()
+            if profiler is not None:
+                extra.append(profile_samples(profiler.snapshot()))
+            body = render([(dish, gstate.dish_id) for gstate, dish in zip(gstates, dishes)],
+                          opts.multi_target, chain.from_iterable(extra))
+            server.snapshot = Snapshot(body, gzip.compress(body), time.time())
+            if opts.verbose:
+                print("Rendered {0} bytes of metrics".format(len(body)))
+            scheduler.wait()
+    except (KeyboardInterrupt, Terminated):
+        pass
+    finally:
+        server.shutdown()
+        server.server_close()
+        if executor is not None:
+            executor.shutdown()
+        for gstate in gstates:
+            gstate.shutdown()
+
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
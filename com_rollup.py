@@ -0,0 +1,158 @@
+"""Per-minute, per-hour and per-day rollups of history statistics.
+
+Each rollup is a sketch mode com1.HistoryStatsAccumulator, so it holds sums,
+counts, drop run length histograms, latency t-digests and load bucket latency
+histograms, all of which can be merged. Minute rollups are built from samples
+as they arrive. Each finished minute is merged into its hour, and each
+finished hour into its day. A query for a time window merges the fewest
+rollups that exactly cover it, to whole minutes, instead of rescanning
+samples.
+"""
+
+import json
+import os
+from typing import Dict, Iterable, Optional, Tuple
+
+import com1
+
+ROLLUP_VERSION = 1
+LEVELS = (60, 3600, 86400)
+# seconds of each level to keep, or None to keep forever
+RETENTION = {60: 86400, 3600: 90 * 86400, 86400: None}
+
+
+def _chunk_history(bulk: Dict[str, Iterable], first: int, last: int, end_counter: int):
+    history = com1.UnwrappedHistory()
+    for field in com1.HISTORY_FIELDS:
+        values = bulk.get(field) or [None] * last
+        getattr(history, field).extend(0.0 if x is None else x for x in values[first:last])
+    history.current = end_counter
+    return history
+
+
+class RollupStore:
+    def __init__(self, path: Optional[str] = None, use_numpy: bool = True) -> None:
+        self.path = path
+        self.use_numpy = use_numpy
+        self.rollups: Dict[int, Dict[int, com1.HistoryStatsAccumulator]] = {x: {} for x in LEVELS}
+        self.open: Dict[int, Optional[Tuple[int, com1.HistoryStatsAccumulator]]] = {
+            x: None for x in LEVELS
+        }
+        self.last_time: Optional[int] = None
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def _new(self) -> com1.HistoryStatsAccumulator:
+        return com1.HistoryStatsAccumulator(use_numpy=self.use_numpy, sketch=True)
+
+    def add_bulk(self, bulk: Dict[str, Iterable], count: int, timestamp: int, counter: int) -> int:
+        # Arguments are as passed to the com2.get_bulk_data add_bulk callback:
+        # sample i has sample counter counter+i and UTC time timestamp+1+i.
+        # Samples not newer than the last one added are skipped.
+        first = 0
+        if self.last_time is not None:
+            first = max(0, self.last_time - timestamp)
+        i = first
+        while i < count:
+            time = timestamp + 1 + i
+            minute = time - time%60
+            end = min(count, i + minute + 60 - time)
+            self._add_minute(minute, _chunk_history(bulk, i, end, counter + end))
+            i = end
+        if count > first:
+            self.last_time = timestamp + count
+        return max(0, count - first)
+
+    def _add_minute(self, minute: int, history) -> None:
+        opened = self.open[60]
+        if opened is not None and opened[0] != minute:
+            self._close(60)
+        if self.open[60] is None:
+            self.open[60] = (minute, self._new())
+        self.open[60][1].add_history(history)
+
+    def _close(self, size: int) -> None:
+        start, accum = self.open[size]
+        self.open[size] = None
+        self.rollups[size][start] = accum
+        if RETENTION[size] is not None:
+            for old in [x for x in self.rollups[size] if x < start - RETENTION[size]]:
+                del self.rollups[size][old]
+
+        parent = LEVELS.index(size) + 1
+        if parent == len(LEVELS):
+            return
+        parent = LEVELS[parent]
+        parent_start = start - start%parent
+        opened = self.open[parent]
+        if opened is not None and opened[0] != parent_start:
+            self._close(parent)
+            if parent == 3600 and self.path is not None:
+                self.save()
+        if self.open[parent] is None:
+            self.open[parent] = (parent_start, self._new())
+        self.open[parent][1].merge(accum)
+
+    def _bucket(self, size: int, start: int) -> Optional[com1.HistoryStatsAccumulator]:
+        accum = self.rollups[size].get(start)
+        # Only minutes are used while still open; an open hour or day does
+        # not yet include the samples in its open minute or hour.
+        if accum is None and size == 60 and self.open[60] is not None and self.open[60][0] == start:
+            accum = self.open[60][1]
+        return accum
+
+    def accumulate(self, start: int, end: int) -> com1.HistoryStatsAccumulator:
+        # Merge of the rollups covering start <= time < end, widened to whole minutes
+        accum = self._new()
+        time = start - start%60
+        end = end - end%60 + (60 if end % 60 else 0)
+        while time < end:
+            for size in reversed(LEVELS):
+                if time % size or time + size > end:
+                    continue
+                bucket = self._bucket(size, time)
+                if bucket is not None or size == 60:
+                    break
+            if bucket is not None:
+                accum.merge(bucket)
+            time += size
+        return accum
+
+    def stats(self, start: int, end: int, loaded_tail: bool = False):
+        return self.accumulate(start, end).stats(loaded_tail=loaded_tail)
+
+    def to_dict(self) -> Dict:
+        return {
+            "version": ROLLUP_VERSION,
+            "last_time": self.last_time,
+            "rollups": {
+                str(size): {str(start): accum.to_dict() for start, accum in rollups.items()}
+                for size, rollups in self.rollups.items()
+            },
+            "open": {
+                str(size): [opened[0], opened[1].to_dict()]
+                for size, opened in self.open.items() if opened is not None
+            },
+        }
+
+    def load(self) -> None:
+        with open(self.path, "r") as rollup_file:
+            state = json.load(rollup_file)
+        if state.get("version") != ROLLUP_VERSION:
+            raise ValueError("Incompatible rollup file: " + self.path)
+        from_dict = com1.HistoryStatsAccumulator.from_dict
+        self.last_time = state["last_time"]
+        for size in LEVELS:
+            self.rollups[size] = {
+                int(start): from_dict(accum, self.use_numpy)
+                for start, accum in state["rollups"].get(str(size), {}).items()
+            }
+            opened = state["open"].get(str(size))
+            self.open[size] = None if opened is None else (opened[0],
+                                                          from_dict(opened[1], self.use_numpy))
+
+    def save(self) -> None:
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as rollup_file:
+            json.dump(self.to_dict(), rollup_file, separators=(",", ":"))
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,286 @@
+"""Mergeable sketches for latency statistics.
+
+TDigest is a merging t-digest using the arcsine scale function. With
+compression C, k = C/(2*pi) * asin(2q-1), and each centroid spans at most
+one unit of k, so the centroid covering quantile q holds at most about
+2*pi * sqrt(q * (1-q)) / C of the total weight. The rank error of
+quantile(q) is at most about half of that, or pi * sqrt(q * (1-q)) / C. With
+the default compression of 100, that is about 1.6% of the total weight at the
+median, under 1% at the 10th and 90th percentiles, and exact at the minimum
+and maximum.
+
+LatencyHistogram is a log-linear (HDR style) histogram of latencies with
+microsecond resolution. Each power-of-two range of values is split into
+2**(precision-1) slots, so a reported percentile is within 2**-precision of
+the true sample value (0.1% with the default precision of 10). Min and max
+are exact. Memory is bounded by the number of slots, not the number of
+samples.
+"""
+
+import math
+from typing import Dict, Iterable, List, Optional
+
+DEFAULT_COMPRESSION = 100
+DEFAULT_PRECISION = 10
+UNITS_PER_MS = 1000
+
+
+class TDigest:
+    __slots__ = ("compression", "means", "weights", "total_weight", "weighted_sum", "min", "max",
+                 "_buffer")
+
+    def __init__(self, compression: float = DEFAULT_COMPRESSION) -> None:
+        self.compression = compression
+        self.means: List[float] = []
+        self.weights: List[float] = []
+        self.total_weight = 0.0
+        self.weighted_sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self._buffer: List[tuple] = []
+
+    def add(self, value: float, weight: float = 1.0) -> None:
+        if weight <= 0.0:
+            return
+        self._buffer.append((value, weight))
+        self.total_weight += weight
+        self.weighted_sum += value * weight
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        if len(self._buffer) > 5 * self.compression:
+            self._compress()
+
+    def add_many(self, values: Iterable[float], weights: Optional[Iterable[float]] = None) -> None:
+        if weights is None:
+            items = [(value, 1.0) for value in values]
+        else:
+            items = [(value, weight) for value, weight in zip(values, weights) if weight > 0.0]
+        if not items:
+            return
+        self._buffer.extend(items)
+        self.total_weight += sum(x[1] for x in items)
+        self.weighted_sum += sum(x[0] * x[1] for x in items)
+        self.min = min(self.min, min(x[0] for x in items))
+        self.max = max(self.max, max(x[0] for x in items))
+        self._compress()
+
+    def merge(self, other: "TDigest") -> None:
+        if not other.total_weight:
+            return
+        other._compress()
+        self._buffer.extend(zip(other.means, other.weights))
+        self.total_weight += other.total_weight
+        self.weighted_sum += other.weighted_sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self._compress()
+
+    def _q_limit(self, q: float) -> float:
+        k = self.compression / (2 * math.pi) * math.asin(2*q - 1) + 1
+        if k >= self.compression / 4:
+            return 1.0
+        return (math.sin(k * 2 * math.pi / self.compression) + 1) / 2
+
+    def _compress(self) -> None:
+        if not self._buffer:
+            return
+        items = list(zip(self.means, self.weights))
+        items.extend(self._buffer)
+        items.sort()
+        self._buffer = []
+        if len(items) <= self.compression:
+            self.means = [x[0] for x in items]
+            self.weights = [x[1] for x in items]
+            return
+        total = self.total_weight
+        means: List[float] = []
+        weights: List[float] = []
+        merged_weight = 0.0
+        mean, weight = items[0]
+        q_limit = self._q_limit(0.0)
+        for next_mean, next_weight in items[1:]:
+            if (merged_weight + weight + next_weight) / total <= q_limit:
+                weight += next_weight
+                mean += (next_mean-mean) * next_weight / weight
+            else:
+                means.append(mean)
+                weights.append(weight)
+                merged_weight += weight
+                q_limit = self._q_limit(merged_weight / total)
+                mean, weight = next_mean, next_weight
+        means.append(mean)
+        weights.append(weight)
+        self.means = means
+        self.weights = weights
+
+    def mean(self) -> Optional[float]:
+        if not self.total_weight:
+            return None
+        return self.weighted_sum / self.total_weight
+
+    def quantile(self, q: float) -> Optional[float]:
+        self._compress()
+        if not self.total_weight:
+            return None
+        if q <= 0.0:
+            return self.min
+        if q >= 1.0:
+            return self.max
+
+        target = q * self.total_weight
+        means = self.means
+        weights = self.weights
+        left_value = self.min
+        left_center = 0.0
+        cumulative = 0.0
+        for mean, weight in zip(means, weights):
+            center = cumulative + weight/2
+            if target < center:
+                return left_value + (mean-left_value) * (target-left_center) / (center-left_center)
+            left_value = mean
+            left_center = center
+            cumulative += weight
+        if cumulative - left_center <= 0.0:
+            return self.max
+        return left_value + (self.max-left_value) * (target-left_center) / (cumulative-left_center)
+
+    def quantiles(self, n: int) -> List[Optional[float]]:
+        return [self.quantile(x / n) for x in range(n + 1)]
+
+    def to_dict(self) -> Dict:
+        self._compress()
+        return {
+            "compression": self.compression,
+            "total_weight": self.total_weight,
+            "weighted_sum": self.weighted_sum,
+            "min": self.min if self.total_weight else None,
+            "max": self.max if self.total_weight else None,
+            "means": list(self.means),
+            "weights": list(self.weights),
+        }
+
+    @classmethod
+    def from_dict(cls, state: Dict) -> "TDigest":
+        digest = cls(state.get("compression", DEFAULT_COMPRESSION))
+        digest.means = list(state["means"])
+        digest.weights = list(state["weights"])
+        digest.total_weight = state["total_weight"]
+        digest.weighted_sum = state["weighted_sum"]
+        if digest.total_weight:
+            digest.min = state["min"]
+            digest.max = state["max"]
+        return digest
+
+
+class LatencyHistogram:
+    __slots__ = ("precision", "counts", "count", "min", "max")
+
+    def __init__(self, precision: int = DEFAULT_PRECISION) -> None:
+        self.precision = precision
+        self.counts: Dict[int, int] = {}
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def _index(self, value: float) -> int:
+        units = int(value * UNITS_PER_MS + 0.5) if value > 0.0 else 0
+        shift = units.bit_length() - self.precision
+        if shift <= 0:
+            return units
+        return (shift << (self.precision - 1)) + (units >> shift)
+
+    def _value(self, index: int) -> float:
+        half = 1 << (self.precision - 1)
+        shift = (index >> (self.precision - 1)) - 1
+        if shift <= 0:
+            return index / UNITS_PER_MS
+        low = (index - shift*half) << shift
+        return (low + (1 << shift) / 2) / UNITS_PER_MS
+
+    def add(self, value: float, count: int = 1) -> None:
+        index = self._index(value)
+        self.counts[index] = self.counts.get(index, 0) + count
+        self.count += count
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def add_many(self, values: Iterable[float]) -> None:
+        for value in values:
+            self.add(value)
+
+    def add_array(self, values) -> None:
+        # Same as add_many for a NumPy float array, but computes the slot
+        # indexes and their counts without a Python loop per value
+        import numpy as np
+        if not len(values):
+            return
+        units = np.where(values > 0.0, np.floor(values*UNITS_PER_MS + 0.5), 0.0)
+        # exact for integers below 2**53
+        shift = np.frexp(units)[1] - self.precision
+        units = units.astype(np.int64)
+        indexes = np.where(shift <= 0, units,
+                           (shift << (self.precision - 1)) + (units >> np.maximum(shift, 0)))
+        counts = np.bincount(indexes)
+        for index in np.flatnonzero(counts).tolist():
+            self.counts[index] = self.counts.get(index, 0) + int(counts[index])
+        self.count += len(values)
+        valid = values[~np.isnan(values)]
+        if len(valid):
+            self.min = min(self.min, float(valid.min()))
+            self.max = max(self.max, float(valid.max()))
+
+    def merge(self, other: "LatencyHistogram") -> None:
+        if other.precision != self.precision:
+            raise ValueError("Cannot merge histograms with different precision")
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percent: float) -> Optional[float]:
+        if not self.count:
+            return None
+        if percent <= 0.0:
+            return self.min
+        if percent >= 100.0:
+            return self.max
+        return self._rank_value(max(1, math.ceil(self.count * percent / 100)))
+
+    def median(self) -> Optional[float]:
+        if not self.count:
+            return None
+        if self.count % 2:
+            return self._rank_value(self.count // 2 + 1)
+        return (self._rank_value(self.count // 2) + self._rank_value(self.count // 2 + 1)) / 2
+
+    def _rank_value(self, rank: int) -> float:
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(max(self._value(index), self.min), self.max)
+        return self.max
+
+    def to_dict(self) -> Dict:
+        return {
+            "precision": self.precision,
+            "count": self.count,
+            "min": self.min if self.count else None,
+            "max": self.max if self.count else None,
+            "counts": {str(index): count for index, count in self.counts.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, state: Dict) -> "LatencyHistogram":
+        histogram = cls(state.get("precision", DEFAULT_PRECISION))
+        histogram.counts = {int(index): count for index, count in state["counts"].items()}
+        histogram.count = state["count"]
+        if histogram.count:
+            histogram.min = state["min"]
+            histogram.max = state["max"]
+        return histogram
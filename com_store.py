@@ -0,0 +1,210 @@
+"""Append-only, memory-mapped store of per-second history samples.
+
+Each bulk history field is kept in its own fixed-width column file, in native
+byte order, alongside a sample counter column and a UTC time column. Rows are
+only ever appended, in time order, so a time range maps to a contiguous slice
+of every column and can be returned as memoryviews into the mapped files
+without copying or parsing. numpy.asarray() on those views is also zero-copy.
+
+Missing float values are stored as NaN and missing boolean values as -1.
+"""
+
+from array import array
+import bisect
+import json
+import math
+import mmap
+import os
+import struct
+from typing import Dict, Iterable, List, Optional, Tuple
+
+STORE_VERSION = 1
+GROW_ROWS = 86400
+# Samples from the same dish boot have a near constant (time - counter); a
+# jump of more than this many seconds means the dish rebooted.
+BOOT_TIME_SLACK = 60
+
+COLUMNS = {
+    "counter": "q",
+    "time": "q",
+    "pop_ping_drop_rate": "f",
+    "pop_ping_latency_ms": "f",
+    "downlink_throughput_bps": "f",
+    "uplink_throughput_bps": "f",
+    "snr": "f",
+    "scheduled": "b",
+    "obstructed": "b",
+}
+_ROWS_FORMAT = "<q"
+
+
+def _missing(typecode: str):
+    return math.nan if typecode in "fd" else -1
+
+
+class SampleStore:
+    def __init__(self, path: str) -> None:
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.segments: List[int] = []
+        self._read_meta()
+        self._files = {}
+        self._maps = {}
+        self._views = {}
+        self.capacity = None
+        for name, typecode in COLUMNS.items():
+            column_path = os.path.join(path, name + ".col")
+            self._files[name] = open(column_path, "r+b" if os.path.exists(column_path) else "w+b")
+            size = os.fstat(self._files[name].fileno()).st_size // array(typecode).itemsize
+            self.capacity = size if self.capacity is None else min(self.capacity, size)
+        self._rows_fd = os.open(os.path.join(path, "rows"), os.O_RDWR | os.O_CREAT, 0o644)
+        data = os.pread(self._rows_fd, struct.calcsize(_ROWS_FORMAT), 0)
+        self.rows = struct.unpack(_ROWS_FORMAT, data)[0] if len(data) == 8 else 0
+        self.rows = min(self.rows, self.capacity)
+        self.segments = [x for x in self.segments if x < self.rows]
+        self._map_columns(max(self.capacity, GROW_ROWS))
+
+    def _read_meta(self) -> None:
+        meta_path = os.path.join(self.path, "meta.json")
+        try:
+            with open(meta_path, "r") as meta_file:
+                meta = json.load(meta_file)
+        except FileNotFoundError:
+            self._write_meta()
+            return
+        if meta.get("version") != STORE_VERSION or meta.get("columns") != COLUMNS:
+            raise ValueError("Incompatible sample store: " + self.path)
+        self.segments = meta["segments"]
+
+    def _write_meta(self) -> None:
+        meta_path = os.path.join(self.path, "meta.json")
+        with open(meta_path + ".tmp", "w") as meta_file:
+            json.dump({
+                "version": STORE_VERSION,
+                "columns": COLUMNS,
+                "segments": self.segments,
+            }, meta_file)
+        os.replace(meta_path + ".tmp", meta_path)
+
+    def _map_columns(self, capacity: int) -> None:
+        # Old maps are not closed here, as readers may still hold views into
+        # them; they are released once the last view goes away.
+        for name, typecode in COLUMNS.items():
+            column_file = self._files[name]
+            size = capacity * array(typecode).itemsize
+            if os.fstat(column_file.fileno()).st_size < size:
+                column_file.truncate(size)
+            self._maps[name] = mmap.mmap(column_file.fileno(), size)
+            self._views[name] = memoryview(self._maps[name]).cast(typecode)
+        self.capacity = capacity
+
+    def close(self) -> None:
+        self._views = {}
+        for mapped in self._maps.values():
+            try:
+                mapped.close()
+            except BufferError:
+                pass
+        self._maps = {}
+        for column_file in self._files.values():
+            column_file.close()
+        os.close(self._rows_fd)
+
+    def __enter__(self) -> "SampleStore":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    @property
+    def last_counter(self) -> Optional[int]:
+        return self._views["counter"][self.rows - 1] if self.rows else None
+
+    @property
+    def last_time(self) -> Optional[int]:
+        return self._views["time"][self.rows - 1] if self.rows else None
+
+    def append(self, bulk: Dict[str, Iterable], count: int, timestamp: int, counter: int) -> int:
+        # Arguments are as passed to the com2.get_bulk_data add_bulk callback:
+        # sample i has sample counter counter+i and UTC time timestamp+1+i.
+        # Returns the number of samples actually added.
+        first = 0
+        new_boot = not self.rows
+        if self.rows:
+            last_counter = self.last_counter
+            last_time = self.last_time
+            if timestamp + 1 - counter > last_time - last_counter + BOOT_TIME_SLACK:
+                new_boot = True
+            else:
+                first = max(0, last_counter + 1 - counter)
+        if first >= count:
+            return 0
+        added = count - first
+        start_time = timestamp + 1 + first
+        if self.rows:
+            # keep the time column strictly increasing if the time base moved back
+            start_time = max(start_time, self.last_time + 1)
+
+        columns = {
+            "counter": array("q", range(counter + first, counter + count)),
+            "time": array("q", range(start_time, start_time + added)),
+        }
+        for name, typecode in COLUMNS.items():
+            if name in columns:
+                continue
+            missing = _missing(typecode)
+            values = bulk.get(name)
+            if values is None:
+                columns[name] = array(typecode, [missing]) * added
+            elif typecode == "b":
+                values = [missing if x is None else int(x) for x in values[first:count]]
+                columns[name] = array(typecode, values)
+            else:
+                values = [missing if x is None else x for x in values[first:count]]
+                columns[name] = array(typecode, values)
+
+        if self.rows + added > self.capacity:
+            grow = max(GROW_ROWS, self.capacity // 4)
+            self._map_columns(((self.rows + added) // grow + 1) * grow)
+        for name, data in columns.items():
+            itemsize = data.itemsize
+            self._maps[name][self.rows * itemsize:(self.rows+added) * itemsize] = data.tobytes()
+        if new_boot:
+            self.segments.append(self.rows)
+            self._write_meta()
+        self.rows += added
+        os.pwrite(self._rows_fd, struct.pack(_ROWS_FORMAT, self.rows), 0)
+        return added
+
+    def flush(self) -> None:
+        for mapped in self._maps.values():
+            mapped.flush()
+        os.fsync(self._rows_fd)
+
+    def time_range(self, start: Optional[int] = None, end: Optional[int] = None) -> Tuple[int, int]:
+        times = self._views["time"][:self.rows]
+        low = 0 if start is None else bisect.bisect_left(times, start)
+        high = self.rows if end is None else bisect.bisect_left(times, end)
+        return low, max(low, high)
+
+    def read(self,
+             start: Optional[int] = None,
+             end: Optional[int] = None,
+             fields: Optional[Iterable[str]] = None) -> Dict[str, memoryview]:
+        # Rows with start <= time < end, as views into the mapped column files.
+        # The views are only valid until the store is closed.
+        low, high = self.time_range(start, end)
+        if fields is None:
+            fields = COLUMNS.keys()
+        return {name: self._views[name][low:high] for name in fields}
+
+    def counter_index(self, counter: int) -> Optional[int]:
+        # Row of the most recent sample with this counter, if still stored
+        counters = self._views["counter"]
+        end = self.rows
+        for start in reversed(self.segments):
+            index = bisect.bisect_left(counters[start:end], counter) + start
+            if index < end and counters[index] == counter:
+                return index
+            end = start
+        return None